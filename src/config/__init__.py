@@ -8,6 +8,15 @@ MOTOR_GPIO = 26
 HIGH_SOLENOID_GPIO = 20
 LOW_SOLENOID_GPIO = 21
 
+# The siren model driven, by name; see the `model` package.
+SIREN_MODEL = 'fs3t22a'
+
+# Every siren driven by this timer, as (motor, high solenoid, low solenoid)
+# GPIOs.  Add an entry per siren to drive several from one panel.
+SIRENS = [
+    (MOTOR_GPIO, HIGH_SOLENOID_GPIO, LOW_SOLENOID_GPIO),
+]
+
 # Button GPIOs.
 TEST_BUTTON_GPIO = 23
 ALERT_BUTTON_GPIO = 22
@@ -15,6 +24,108 @@ FIRE_BUTTON_GPIO = 27
 ATTACK_BUTTON_GPIO = 18
 CANCEL_BUTTON_GPIO = 17
 
+# Button sampling.  After any edge, all the buttons are read together every
+# BUTTON_SAMPLE_INTERVAL seconds until they've been steady for
+# BUTTON_DEBOUNCE seconds.  The first change after they've been steady acts
+# at once; changes within BUTTON_DEBOUNCE of it are taken as bounces.
+BUTTON_SAMPLE_INTERVAL = 0.005
+BUTTON_DEBOUNCE = 0.02
+
 # LED GPIOs.
 READY_LED_GPIO = 9
-ALERT_LED_GPIO = 11
\ No newline at end of file
+ALERT_LED_GPIO = 11
+
+# WebSocket API port.
+WEBSOCKET_PORT = 12346
+
+# WebSocket event broadcasting.  Each client gets a queue of this many
+# pending events; when a slow client's queue fills up, the policy decides
+# whether to drop its oldest events ('drop_oldest') or to disconnect it
+# ('disconnect').
+WEBSOCKET_QUEUE_SIZE = 16
+WEBSOCKET_SLOW_CLIENT_POLICY = 'drop_oldest'
+
+# Control commands from the network run on a dedicated worker thread.  At
+# most COMMAND_QUEUE_SIZE commands may wait for it before new ones are
+# rejected.
+COMMAND_QUEUE_SIZE = 64
+
+# The WebSocket state stream keeps its last STATE_HISTORY deltas, so that
+# clients that missed some can catch up without a full snapshot.
+STATE_HISTORY = 256
+
+# Mode changes are arbitrated between their sources: the panel, console,
+# schedule and network, in that order of precedence.  Commands still queued
+# when a higher-priority source acts are dropped, and for ARBITER_HOLD
+# seconds after it acts, lower-priority sources' commands are refused.  Each
+# network client may send ARBITER_RATE mode changes a second, in bursts of up
+# to ARBITER_BURST; set ARBITER_RATE to 0 to disable the limit.
+ARBITER_HOLD = 1.0
+ARBITER_RATE = 10
+ARBITER_BURST = 20
+
+# The first mode change from the network runs right away; any that follow
+# within COMMAND_COALESCE_WINDOW seconds collapse into one transition to the
+# latest, at the end of the window.  Set to 0 to only collapse commands
+# already queued behind others.
+COMMAND_COALESCE_WINDOW = 0.05
+
+# Telemetry for diagnostics.  While anyone's subscribed, relay and button
+# states are sampled every TELEMETRY_INTERVAL seconds into a ring of the
+# latest TELEMETRY_CAPACITY samples, and sent to each subscriber in batches
+# every TELEMETRY_FRAME_INTERVAL seconds.
+TELEMETRY_INTERVAL = 0.01
+TELEMETRY_CAPACITY = 1024
+TELEMETRY_FRAME_INTERVAL = 0.1
+
+# Console.  Up to CONSOLE_MAX_SESSIONS clients may be connected at once.
+# Each session buffers up to CONSOLE_BUFFER_SIZE bytes of output for its
+# client; once that's full, output waits up to CONSOLE_WRITE_TIMEOUT seconds
+# for room, then is discarded.
+CONSOLE_MAX_SESSIONS = 4
+CONSOLE_BUFFER_SIZE = 65536
+CONSOLE_WRITE_TIMEOUT = 1.0
+
+# The console's sampling profiler records every thread's stack every
+# PROFILER_INTERVAL seconds while it runs.
+PROFILER_INTERVAL = 0.01
+
+# Logging.  Messages below LOG_LEVEL are discarded.  Each call site may log
+# LOG_RATE_LIMIT messages a second on average, in bursts of up to LOG_BURST;
+# set LOG_RATE_LIMIT to 0 to disable rate limiting.  At most LOG_QUEUE_SIZE
+# messages wait to be written before new ones are dropped.
+LOG_LEVEL = 'INFO'
+LOG_RATE_LIMIT = 10
+LOG_BURST = 20
+LOG_QUEUE_SIZE = 1024
+
+# Where the runtime keeps state that must survive restarts.
+STATE_DIR = '/var/lib/siren'
+
+# The AF timer's state is snapshotted to STATE_FILE on every transition.
+# After a restart, an active signal resumes from it in phase; a warning is
+# logged if that takes longer than RESUME_BUDGET seconds from the process
+# starting.  Signals started more than RESUME_MAX_AGE seconds before are
+# stale, and aren't resumed; set to None to resume them however old.
+STATE_FILE = STATE_DIR + '/state.json'
+RESUME_BUDGET = 1.0
+RESUME_MAX_AGE = 600
+
+# Scheduled activations, stored in SCHEDULE_FILE.  Activations missed while
+# the runtime was down still fire at start-up if they're no more than
+# SCHEDULE_GRACE seconds late.  The schedule re-checks the wall clock at
+# least every SCHEDULE_MAX_SLEEP seconds, to follow clock adjustments.
+SCHEDULE_FILE = STATE_DIR + '/schedules.json'
+SCHEDULE_GRACE = 60
+SCHEDULE_MAX_SLEEP = 3600
+
+# Journal of mode changes and relay writes, kept as a ring of the latest
+# JOURNAL_CAPACITY records (16 bytes each) in JOURNAL_FILE.
+JOURNAL_FILE = STATE_DIR + '/journal.bin'
+JOURNAL_CAPACITY = 65536
+
+# Multi-node synchronization.  A coordinator estimates each follower's clock
+# offset from the best (lowest round trip) of SYNC_SAMPLES exchanges, and
+# repeats the estimate every SYNC_INTERVAL seconds to track drift.
+SYNC_SAMPLES = 8
+SYNC_INTERVAL = 30
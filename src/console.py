@@ -1,14 +1,35 @@
 #!/usr/bin/python3
 
-""" Console component for access to Siren functionality. """
-
+""" Console component for access to Siren functionality.
+
+Any number of clients can be connected at once, each with its own Python
+session.  Output goes back to the session that produced it: `sys.stdout`
+and `sys.stderr` are replaced, once, by routers that write to the session
+running the current command, and straight through to the original stream
+from anywhere else.  Each session buffers its output for its client, so a
+client that stops reading holds up only its own commands, and only for
+`CONSOLE_WRITE_TIMEOUT` before its output is discarded.
+"""
+
+import asyncio
 import code
-import errno
+import contextvars
 import io
-import socket
 import sys
 import threading
-import time
+
+from config import CONSOLE_BUFFER_SIZE, CONSOLE_MAX_SESSIONS, CONSOLE_WRITE_TIMEOUT
+import log
+import metrics
+
+_log = log.get_logger('console')
+
+_SESSIONS = metrics.counter('console.sessions')
+_REFUSED = metrics.counter('console.refused')
+_DISCARDED = metrics.counter('console.discarded_bytes')
+
+# The session whose command is running in this context.
+_session = contextvars.ContextVar('console_session', default=None)
 
 
 def dump_trace():
@@ -24,91 +45,198 @@ def dump_trace():
     print(data)
 
 
-class OutputCapture(io.StringIO):
-    """ Interceptor for stdout or stderr to redirect to a socket. """
+class _Router(io.TextIOBase):
+    """ Stands in for stdout or stderr, writing to the current session if there is one. """
 
-    def __init__(self, conn, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._conn = conn
+    def __init__(self, stream):
+        self._stream = stream
 
     def write(self, text):
-        self._conn.send(text.encode())
-        super().write(text)
-        sys.__stdout__.write(text)
-
-
-class Console:
-    """ Console over TCP/IP. """
-
-    def __init__(self, host, port):
-        self._host = host
-        self._port = port
-        self._thread = None
-        self._socket = None
-
-    def listen(self, locals={}):
-        """ Open a port and crete a console connection.
-
-        This function will not block, and will spawn a thread to run the
-        console.  To close the console, delete the `Console` object.
-
-        Args:
-            locals: Dictionary of name/values to include in the interactive
-                    console.
+        session = _session.get()
+        if session is None:
+            return self._stream.write(text)
+        session.write(text)
+        return len(text)
+
+    def flush(self):
+        if _session.get() is None:
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def _install_routers():
+    if not isinstance(sys.stdout, _Router):
+        sys.stdout = _Router(sys.stdout)
+    if not isinstance(sys.stderr, _Router):
+        sys.stderr = _Router(sys.stderr)
+
+
+class _Session:
+    """ One connected client: its interpreter and its buffered output. """
+
+    def __init__(self, loop, reader, writer, locals, buffer_size, write_timeout):
+        self.peer = writer.get_extra_info('peername')
+        self.discarded = 0
+        self._loop = loop
+        self._reader = reader
+        self._writer = writer
+        self._console = code.InteractiveConsole(locals=locals)
+        self._buffer_size = buffer_size
+        self._write_timeout = write_timeout
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._size = 0
+        self._ready = asyncio.Event()
+        self._closed = False
+
+    def write(self, text, timeout=None):
+        """ Queue `text` for the client.  Safe to call from any thread.
+
+        Blocks while the buffer is full, for up to `timeout` seconds (by
+        default, the write timeout); after that, `text` is discarded.
         """
-
-        locals['dump_trace'] = dump_trace
-    
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,1)
-
-        def thread():
-            self._socket.bind((self._host, self._port))
-            self._socket.listen()
-            print('Console listening on %s:%d' % (
-                self._host, self._port))
-            conn, addr = self._socket.accept()
-            orig_stdout = sys.stdout
-            orig_stderr = sys.stderr
+        data = text.encode()
+        if timeout is None:
+            timeout = self._write_timeout
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: self._closed or self._size + len(data) <= self._buffer_size,
+                    timeout):
+                self.discarded += len(data)
+                _DISCARDED.inc(len(data))
+                return
+            if self._closed:
+                return
+            self._pending.append(data)
+            self._size += len(data)
+        self._loop.call_soon_threadsafe(self._ready.set)
+
+    async def run(self):
+        sender = asyncio.create_task(self._send())
+        try:
+            self._prompt('>>> ')
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                need_more = await asyncio.to_thread(self._push, line.decode(errors='replace').rstrip())
+                if need_more is None:
+                    break
+                self._prompt('... ' if need_more else '>>> ')
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            self._ready.set()
             try:
-                with conn:
-                    print("Connection by", addr)
-                    sys.stdout = OutputCapture(conn)
-                    sys.stderr = OutputCapture(conn)
-                    console = code.InteractiveConsole(locals=locals)
-                    conn.send(">>> ".encode())
-                    while True:
-                        data = conn.recv(1024).decode()
-                        if len(data) == 0:
-                            break
-                        need_more = console.push(data.rstrip())
-                        if need_more:
-                            conn.send("... ".encode())
-                        else:
-                            conn.send(">>> ".encode())
-            finally:
-                self._socket.shutdown(1)
-                self._socket.close()
-                self._socket = None
-                sys.stdout = orig_stdout
-                sys.stderr = orig_stderr
-                print("Client disconnected.")
-        self._thread = threading.Thread(target=thread)
-        self._thread.start()
-
-    def run_server(self, locals={}):
-        """ Blocking form of `listen()`. """
-        self.listen(locals)
-        self._thread.join()
-        print("Console thread returned")
-
-    def __del__(self):
-        if self._socket:
-            self._socket.shutdown(1)
-            self._socket.close()
+                # Give the client a last chance to take what's left.
+                await asyncio.wait_for(sender, self._write_timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _prompt(self, text):
+        # Never wait on the event loop.
+        self.write(text, timeout=0)
+
+    def _push(self, line):
+        # `to_thread` runs this in a copy of our context, so the session
+        # only applies to output from this command.
+        _session.set(self)
+        try:
+            return self._console.push(line)
+        except SystemExit:
+            return None
+
+    async def _send(self):
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                with self._cond:
+                    pending, self._pending = self._pending, []
+                    closed = self._closed
+                if pending:
+                    data = b''.join(pending)
+                    self._writer.write(data)
+                    await self._writer.drain()
+                    with self._cond:
+                        self._size -= len(data)
+                        self._cond.notify_all()
+                if closed:
+                    break
+        except ConnectionError:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+        finally:
+            self._writer.close()
+
+
+class ConsoleServer:
+    """ Python consoles over TCP/IP, for up to `max_sessions` clients at once.
+
+    Each session starts with its own copy of `locals`.  Commands run on a
+    worker thread, so a slow one holds up neither the event loop nor other
+    sessions.
+    """
+
+    def __init__(self, host, port, locals, max_sessions=CONSOLE_MAX_SESSIONS,
+                 buffer_size=CONSOLE_BUFFER_SIZE, write_timeout=CONSOLE_WRITE_TIMEOUT):
+        self._host = host
+        self._port = port
+        self._locals = dict(locals, dump_trace=dump_trace)
+        self._max_sessions = max_sessions
+        self._buffer_size = buffer_size
+        self._write_timeout = write_timeout
+        self._sessions = set()
+        self._server = None
+
+    @property
+    def sessions(self):
+        """ The addresses of the connected clients. """
+        return [session.peer for session in self._sessions]
+
+    async def start(self):
+        """ Start accepting clients. """
+        _install_routers()
+        self._server = await asyncio.start_server(self._handle, self._host, self._port)
+        _log.info('Console listening', host=self._host, port=self._port)
+
+    def close(self):
+        """ Stop accepting clients. """
+        if self._server is not None:
+            self._server.close()
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        if len(self._sessions) >= self._max_sessions:
+            _REFUSED.inc()
+            _log.warning('Console refused; too many sessions', peer=peer)
+            writer.write(b'Too many console sessions.\n')
+            writer.close()
+            return
+
+        session = _Session(
+            asyncio.get_running_loop(), reader, writer, dict(self._locals),
+            self._buffer_size, self._write_timeout)
+        self._sessions.add(session)
+        _SESSIONS.inc()
+        _log.info('Console connected', peer=peer)
+        try:
+            await session.run()
+        finally:
+            self._sessions.discard(session)
+            _log.info('Console disconnected', peer=peer, discarded=session.discarded)
 
 
 if __name__ == '__main__':
-    c = Console('127.0.0.1', 12345)
-    while True:
-        c.run_server({'c': c})
+    server = ConsoleServer('127.0.0.1', 12345, {})
+    asyncio.run(server.serve_forever())
@@ -0,0 +1,180 @@
+""" Append-only journal of mode changes and relay writes.
+
+Records are fixed-size binary structs in a ring buffer in a memory-mapped
+file, so appending one is a `struct.pack_into` with no system call, and
+the journal survives restarts.  The kernel writes dirty pages back in the
+background, coalescing any number of records into one write per page,
+which keeps SD card wear independent of the event rate.  Once the ring
+is full, the oldest records are overwritten.
+
+    journal.enable('/var/lib/siren/journal.bin')
+    journal.record_mode(Mode.fire())
+    journal.query(start=time.time() - 3600)
+
+Until `enable` is called, recording does nothing.
+
+Records are kept in the order they were appended, so a time range is
+found by binary search over their timestamps.  Times are wall-clock
+seconds since the Unix epoch, taken from the timer's clock, and never
+earlier than the record before: a Pi has no real-time clock, so its clock
+can be set back, by NTP say, and records are then stamped with the last
+time recorded until the clock catches up.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+from config import JOURNAL_CAPACITY, JOURNAL_FILE
+import metrics
+
+# Record kinds.
+MODE = 1
+RELAY = 2
+
+_KIND_NAMES = {
+    MODE : 'mode',
+    RELAY : 'relay',
+}
+
+_MAGIC = b'SRNJ'
+_VERSION = 1
+
+# Magic, version, record size, capacity, records ever appended.
+_HEADER = struct.Struct('<4sHHIQ')
+_HEADER_SIZE = 32
+
+# Time, kind, source (relay GPIO, or 0), value (mode value, or relay state).
+_RECORD = struct.Struct('<dBHB4x')
+
+_APPENDED = metrics.counter('journal.appended')
+
+
+class Journal:
+    """ A ring of journal records in the file at `path`.
+
+    An existing journal with the same capacity is reopened and appended
+    to; anything else at `path` is replaced.  Records are stamped with
+    `now()`, wall-clock seconds since the Unix epoch.
+    """
+
+    def __init__(self, path, capacity=JOURNAL_CAPACITY, now=time.time):
+        self.path = path
+        self.capacity = capacity
+        self._now = now
+        self._lock = threading.Lock()
+
+        size = _HEADER_SIZE + capacity * _RECORD.size
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fresh = os.fstat(fd).st_size != size
+            if fresh:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, version, record_size, stored_capacity, head = _HEADER.unpack_from(self._map)
+        if fresh or (magic, version, record_size, stored_capacity) != (
+                _MAGIC, _VERSION, _RECORD.size, capacity):
+            head = 0
+            self._map[:] = bytes(size)
+            _HEADER.pack_into(self._map, 0, _MAGIC, _VERSION, _RECORD.size, capacity, 0)
+        self._head = head
+        # The latest stamp, which later ones are kept at or after.
+        self._last = self._read(head - 1)[0] if head else float('-inf')
+
+    def __len__(self):
+        return min(self._head, self.capacity)
+
+    def append(self, kind, source, value):
+        with self._lock:
+            head = self._head
+            self._last = max(self._now(), self._last)
+            _RECORD.pack_into(
+                self._map, _HEADER_SIZE + (head % self.capacity) * _RECORD.size,
+                self._last, kind, source, value)
+            # Publish the record only once it's complete.
+            self._head = head + 1
+            struct.pack_into('<Q', self._map, _HEADER.size - 8, self._head)
+        _APPENDED.inc()
+
+    def query(self, start=None, end=None, limit=None):
+        """ Records with `start <= time < end`, oldest first.
+
+        Returns:
+          A list of `(time, kind, source, value)` tuples, at most `limit` long.
+        """
+        with self._lock:
+            count = len(self)
+            first = self._head - count
+            lo = 0 if start is None else self._search(first, count, start)
+            hi = count if end is None else self._search(first, count, end)
+            if limit is not None:
+                hi = min(hi, lo + limit)
+            return [self._read(first + i) for i in range(lo, hi)]
+
+    def flush(self):
+        """ Write the journal back to storage now. """
+        self._map.flush()
+
+    def close(self):
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+
+    def _read(self, index):
+        return _RECORD.unpack_from(
+            self._map, _HEADER_SIZE + (index % self.capacity) * _RECORD.size)
+
+    def _search(self, first, count, when):
+        """ The position of the first of `count` records from `first` at or after `when`. """
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._read(first + mid)[0] < when:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+_journal = None
+
+
+def enable(path=JOURNAL_FILE, capacity=JOURNAL_CAPACITY, now=time.time):
+    """ Start journalling to the file at `path`, stamping records with `now()`. """
+    global _journal
+    _journal = Journal(path, capacity, now)
+    return _journal
+
+
+def record_mode(mode):
+    journal = _journal
+    if journal is not None:
+        journal.append(MODE, 0, mode.value)
+
+
+def record_relay(gpio, on):
+    journal = _journal
+    if journal is not None:
+        journal.append(RELAY, gpio, on)
+
+
+def query(start=None, end=None, limit=None):
+    """ Journal records as dicts, oldest first.  See `Journal.query`. """
+    journal = _journal
+    if journal is None:
+        return []
+    return [
+        {'time': when, 'kind': _KIND_NAMES.get(kind, kind), 'source': source, 'value': value}
+        for when, kind, source, value in journal.query(start, end, limit)]
+
+
+def flush():
+    if _journal is not None:
+        _journal.flush()
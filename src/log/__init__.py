@@ -0,0 +1,198 @@
+""" Non-blocking structured logging.
+
+Logging calls only timestamp the message and put it on a bounded queue; a
+background thread does all formatting and I/O.  A slow sink (a pipe to
+journald, an SD card, or a console client) therefore never holds up the
+thread that logged.
+
+    log = get_logger('af_timer')
+    log.info('Change mode', mode=mode, duration=duration)
+
+Messages are rate limited per call site (logger and message text) with a
+token bucket; suppressed messages are counted and reported on the next
+message from that site that gets through.  If the queue is full, messages
+are dropped and counted rather than blocking.
+"""
+
+import queue
+import sys
+import threading
+import time
+
+from config import LOG_BURST, LOG_LEVEL, LOG_QUEUE_SIZE, LOG_RATE_LIMIT
+import metrics
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+_LEVEL_NAMES = {
+    DEBUG : 'DEBUG',
+    INFO : 'INFO',
+    WARNING : 'WARNING',
+    ERROR : 'ERROR',
+}
+
+_DROPPED = metrics.counter('log.dropped')
+_SUPPRESSED = metrics.counter('log.rate_limited')
+
+
+def level_from_name(name):
+    """ Converts a level name like 'info' to its value. """
+    for level, level_name in _LEVEL_NAMES.items():
+        if level_name == name.upper():
+            return level
+    raise ValueError('Invalid log level: %s' % name)
+
+
+class _Bucket:
+    """ Token bucket for one call site. """
+    __slots__ = ('tokens', 'updated', 'suppressed')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.suppressed = 0
+
+
+class _Sink:
+    """ The queue shared by all loggers, and the thread draining it. """
+
+    def __init__(self, level, queue_size, rate, burst):
+        self.level = level
+        self._queue = queue.Queue(queue_size)
+        self._rate = rate
+        self._burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, level, name, msg, fields):
+        now = time.time()
+        suppressed = self._admit(name, msg, now)
+        if suppressed is None:
+            return
+        if suppressed:
+            fields['suppressed'] = suppressed
+
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((now, level, name, msg, fields))
+        except queue.Full:
+            _DROPPED.inc()
+
+    def flush(self):
+        """ Wait until everything logged so far has been written. """
+        if self._thread is not None:
+            self._queue.join()
+
+    def _admit(self, name, msg, now):
+        """ Applies the rate limit.
+
+        Returns None if the message should be suppressed, otherwise the number
+        of messages suppressed from this call site since the last one written.
+        """
+        if not self._rate:
+            return 0
+        key = (name, msg)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = _Bucket(self._burst, now)
+            else:
+                bucket.tokens = min(
+                    self._burst, bucket.tokens + (now - bucket.updated) * self._rate)
+                bucket.updated = now
+            if bucket.tokens < 1:
+                bucket.suppressed += 1
+                _SUPPRESSED.inc()
+                return None
+            bucket.tokens -= 1
+            suppressed, bucket.suppressed = bucket.suppressed, 0
+            return suppressed
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='log', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            try:
+                # Look up stdout on every write, in case it's been replaced.
+                sys.stdout.write(self._format(*record))
+                sys.stdout.flush()
+            except Exception:
+                pass
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _format(when, level, name, msg, fields):
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when))
+        line = '%s.%03d %s %s: %s' % (
+            stamp, int(when * 1000) % 1000, _LEVEL_NAMES[level], name, msg)
+        if fields:
+            line += ' ' + ' '.join('%s=%s' % item for item in fields.items())
+        return line + '\n'
+
+
+_sink = _Sink(level_from_name(LOG_LEVEL), LOG_QUEUE_SIZE, LOG_RATE_LIMIT, LOG_BURST)
+
+
+class Logger:
+    """ A named logger.  Keyword arguments are logged as `key=value` fields. """
+
+    def __init__(self, name):
+        self.name = name
+
+    def is_enabled_for(self, level):
+        return level >= _sink.level
+
+    def log(self, level, msg, **fields):
+        if level >= _sink.level:
+            _sink.submit(level, self.name, msg, fields)
+
+    def debug(self, msg, **fields):
+        if DEBUG >= _sink.level:
+            _sink.submit(DEBUG, self.name, msg, fields)
+
+    def info(self, msg, **fields):
+        if INFO >= _sink.level:
+            _sink.submit(INFO, self.name, msg, fields)
+
+    def warning(self, msg, **fields):
+        if WARNING >= _sink.level:
+            _sink.submit(WARNING, self.name, msg, fields)
+
+    def error(self, msg, **fields):
+        if ERROR >= _sink.level:
+            _sink.submit(ERROR, self.name, msg, fields)
+
+
+_loggers = {}
+
+
+def get_logger(name):
+    """ Returns the logger called `name`. """
+    try:
+        return _loggers[name]
+    except KeyError:
+        return _loggers.setdefault(name, Logger(name))
+
+
+def set_level(level):
+    """ Sets the minimum level logged, as a value or a name like 'debug'. """
+    if isinstance(level, str):
+        level = level_from_name(level)
+    _sink.level = level
+
+
+def flush():
+    """ Wait until everything logged so far has been written. """
+    _sink.flush()
@@ -1,52 +1,153 @@
 #!/usr/bin/python3
 
-""" Main program for the siren and AF timer runtime. """
+""" Main program for the siren and AF timer runtime.
 
-from console import Console
-from model.fs3t22a import FS3T22A
+Start-up is staged so the siren is usable as soon as possible: only what
+the panel needs is imported before the timer is built and any interrupted
+signal resumed.  The schedule, console and network services, and the
+libraries behind them, are loaded afterwards.
+"""
+
+from config import (
+    JOURNAL_FILE, RESUME_BUDGET, SCHEDULE_FILE, SIREN_MODEL, STATE_FILE, WEBSOCKET_PORT)
+from siren import Clock
 from timer.af_timer import AFTimer, Mode, Button
 
+import argparse
 import functools
-from threading import Thread
-import asyncio
-import websocket
+import journal
+import log
+import model
+import startup
 
 
 HOST = '0.0.0.0'
 PORT = 12345
 
+_log = log.get_logger('main')
+
+
+def resume(af_timer, profile):
+    """ Resume whatever the timer was doing before a restart, and time the recovery. """
+    mode = af_timer.resume()
+    if mode is None:
+        return
+    recovery = profile.mark('resumed')
+    if recovery > RESUME_BUDGET:
+        _log.warning('Resume exceeded budget', mode=mode, recovery_ms=recovery * 1000,
+                     budget_ms=RESUME_BUDGET * 1000)
+    else:
+        _log.info('Resumed', mode=mode, recovery_ms=recovery * 1000)
+
 
-def run_console(port, af_timer: AFTimer):
+async def run_console(port, af_timer: AFTimer, schedule, profile):
+    console = profile.load('console')
+    profiler = profile.load('profiler')
     locals = af_timer.generate_console_mappings()
     locals.update({
         'Mode': Mode,
         'Button': Button,
+        'schedule': schedule,
+        'startup': profile.report,
+        'profiler': profiler.Profiler(),
+        'threads': profiler.threads,
     })
+    server = console.ConsoleServer(HOST, port, locals)
+    await server.start()
+    return server
+
+
+def _log_exit(name, task):
+    """ Done callback for background tasks, which should only stop when cancelled. """
+    if not task.cancelled() and task.exception() is not None:
+        _log.error('Task died', task=name, error=repr(task.exception()))
+
+
+async def serve(af_timer, schedule, args, profile):
+    """ Run the network services. """
+    import asyncio
+    console = await run_console(args.console_port, af_timer, schedule, profile)
 
-    def thread(port, locals):
-        while True:
-            print("Starting new console")
-            console = Console(HOST, port)
-            console.run_server(locals)
+    websocket = profile.load('websocket')
+    listening = asyncio.get_running_loop().create_future()
+    websocket_task = asyncio.create_task(
+        websocket.run_websocket(af_timer, args.websocket_port, schedule, listening))
 
-    console_thread = Thread(target=thread, kwargs={'port': port, 'locals': locals})
-    console_thread.start()
-    return console_thread
+    followers = [uri for uri in args.followers.split(",") if uri]
+    if followers:
+        sync = profile.load('sync')
+        coordinator = sync.Coordinator(af_timer, followers)
+        coordinator_task = asyncio.create_task(coordinator.run())
+        coordinator_task.add_done_callback(functools.partial(_log_exit, 'coordinator'))
 
+    # Start-up is done once the server is listening, or has failed to.
+    await asyncio.wait([listening, websocket_task], return_when=asyncio.FIRST_COMPLETED)
+    if websocket_task.done():
+        await websocket_task
+    profile.mark('network_ready')
+    _log.info('Start-up complete', ms=profile.elapsed() * 1000,
+              panel_ready_ms=profile.at('panel_ready') * 1000)
+    if args.profile_startup:
+        # Keep the log out of the middle of the report.
+        log.flush()
+        print(profile.report())
+        console.close()
+        websocket_task.cancel()
+        return
 
-async def main():
-    import argparse
-    import functools
+    await websocket_task
+
+
+def main():
+    profile = startup.StartupProfile()
     parser = argparse.ArgumentParser(description="AF Timer main runtime.")
+    parser.add_argument("--model", default=SIREN_MODEL, help="Siren model to drive (see --list_models)")
+    parser.add_argument("--list_models", action="store_true", help="List the available siren models and exit")
     parser.add_argument("--console_port", type=int, default=PORT, help="Port to run the console telnet service on")
+    parser.add_argument("--log_level", default=None, help="Minimum level to log (debug, info, warning, error)")
+    parser.add_argument("--websocket_port", type=int, default=WEBSOCKET_PORT, help="Port to run the WebSocket API on")
+    parser.add_argument("--schedule_file", default=SCHEDULE_FILE, help="File to keep scheduled activations in")
+    parser.add_argument("--state_file", default=STATE_FILE, help="File to snapshot the timer's state to, to resume from after a restart")
+    parser.add_argument("--journal_file", default=JOURNAL_FILE, help="File to journal mode changes and relay writes to")
+    parser.add_argument("--followers", default="", help="Comma-separated WebSocket URIs of follower nodes to coordinate, e.g. ws://siren2:12346")
+    parser.add_argument("--profile_startup", action="store_true", help="Print a start-up profile and exit once start-up completes")
     args = parser.parse_args()
+    if args.list_models:
+        print('\n'.join(model.available()))
+        return
+    profile.mark('imported')
 
-    af_timer = AFTimer(FS3T22A)
-    console_thread = run_console(args.console_port, af_timer)
-    websocket_task = asyncio.create_task(websocket.run_websocket(af_timer))
+    if args.log_level:
+        log.set_level(args.log_level)
 
-    await websocket_task
-    console_thread.join()
+    # Stage 1: the panel and sirens.
+    try:
+        siren_cls = model.load(args.model)
+    except model.UnknownModelError as e:
+        parser.error(str(e))
+    profile.mark('model_loaded')
+
+    # The journal is stamped from the timer's clock.
+    clock = Clock()
+    try:
+        journal.enable(args.journal_file, now=clock.time)
+    except OSError as e:
+        _log.error('Journal unavailable', path=args.journal_file, error=e)
+
+    af_timer = AFTimer(siren_cls, clock=clock, state_file=args.state_file)
+    profile.mark('panel_ready')
+    resume(af_timer, profile)
+
+    # Stage 2: everything else.
+    schedule = profile.load('timer.schedule').ActivationSchedule(af_timer, args.schedule_file)
+    schedule.start()
+    profile.mark('schedule_ready')
+
+    asyncio = profile.load('asyncio')
+    try:
+        asyncio.run(serve(af_timer, schedule, args, profile))
+    finally:
+        log.flush()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
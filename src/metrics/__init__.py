@@ -0,0 +1,147 @@
+""" Lightweight counters, latency histograms and tracing spans.
+
+Instrumented code records into the process-wide `REGISTRY`:
+
+    with metrics.span('change_mode'):
+        ...
+
+    metrics.counter('events_dropped').inc()
+
+and `snapshot()` returns everything recorded so far as plain data, suitable
+for sending over the WebSocket API.
+"""
+
+import bisect
+import threading
+import time
+
+
+# Upper bounds of the latency histogram buckets, in milliseconds.  Anything
+# slower than the last bound lands in an overflow bucket.
+LATENCY_BUCKETS_MS = (
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class Counter:
+    """ A monotonically increasing count. """
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self._value += n
+
+    @property
+    def value(self):
+        return self._value
+
+
+class Histogram:
+    """ Latency distribution over fixed buckets. """
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, ms):
+        """ Record a latency of `ms` milliseconds. """
+        index = bisect.bisect_left(self._bounds, ms)
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._sum += ms
+            if ms > self._max:
+                self._max = ms
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            count, total, largest = self._count, self._sum, self._max
+        return {
+            'count': count,
+            'sum_ms': total,
+            'max_ms': largest,
+            'buckets': [[bound, n] for bound, n in zip(self._bounds + ('+Inf',), counts)],
+        }
+
+
+class Registry:
+    """ Named counters and histograms. """
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name):
+        try:
+            return self._counters[name]
+        except KeyError:
+            with self._lock:
+                return self._counters.setdefault(name, Counter())
+
+    def histogram(self, name):
+        try:
+            return self._histograms[name]
+        except KeyError:
+            with self._lock:
+                return self._histograms.setdefault(name, Histogram())
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict(self._histograms)
+        return {
+            'counters': {name: c.value for name, c in sorted(counters.items())},
+            'histograms': {name: h.snapshot() for name, h in sorted(histograms.items())},
+        }
+
+
+class Span:
+    """ Context manager timing a block into the histogram `name`. """
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe((time.perf_counter() - self._start) * 1000)
+        return False
+
+
+REGISTRY = Registry()
+
+
+def counter(name):
+    """ The counter `name` in the process-wide registry. """
+    return REGISTRY.counter(name)
+
+
+def histogram(name):
+    """ The latency histogram `name` in the process-wide registry. """
+    return REGISTRY.histogram(name)
+
+
+def span(name):
+    """ Time a block into the histogram `name`:
+
+        with metrics.span('cancel'):
+            ...
+    """
+    return Span(REGISTRY.histogram(name))
+
+
+def snapshot():
+    """ Everything recorded in the process-wide registry. """
+    return REGISTRY.snapshot()
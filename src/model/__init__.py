@@ -1 +1,71 @@
-""" Module for the implementation of various sirens. """
\ No newline at end of file
+""" Module for the implementation of various sirens.
+
+Models are found by name, without importing any but the one asked for:
+
+ - Each module in this package is a model named after the module, such as
+   `fs3t22a`.
+ - Installed packages can add models through the `siren.models` entry
+   point group, e.g. in their `pyproject.toml`:
+
+       [project.entry-points."siren.models"]
+       thunderbolt = "thunderbolt_siren:Thunderbolt"
+
+A model module names its `Siren` subclass with a module-level `MODEL`, or
+else defines exactly one.
+"""
+
+import importlib
+import pkgutil
+
+ENTRY_POINT_GROUP = 'siren.models'
+
+
+class UnknownModelError(LookupError):
+    """ No model has the requested name. """
+
+
+def _local():
+    return {m.name for m in pkgutil.iter_modules(__path__) if not m.name.startswith('_')}
+
+
+def _entry_points():
+    # importlib.metadata is slow to import, so only go there when needed.
+    from importlib import metadata
+    return {ep.name: ep for ep in metadata.entry_points(group=ENTRY_POINT_GROUP)}
+
+
+def available():
+    """ The names of every model that can be loaded. """
+    return sorted(_local() | set(_entry_points()))
+
+
+def load(name):
+    """ Import model `name` and return its `Siren` class.
+
+    Raises:
+      UnknownModelError: If there's no such model.
+    """
+    if name in _local():
+        return _model_class(importlib.import_module(__name__ + '.' + name))
+
+    entry_point = _entry_points().get(name)
+    if entry_point is None:
+        raise UnknownModelError(
+            'Unknown siren model %r; available: %s' % (name, ', '.join(available())))
+    loaded = entry_point.load()
+    return loaded if isinstance(loaded, type) else _model_class(loaded)
+
+
+def _model_class(module):
+    from siren import Siren
+    model = getattr(module, 'MODEL', None)
+    if model is not None:
+        return model
+    candidates = [
+        value for value in vars(module).values()
+        if isinstance(value, type) and issubclass(value, Siren)
+        and value.__module__ == module.__name__]
+    if len(candidates) != 1:
+        raise UnknownModelError(
+            '%s must define exactly one Siren subclass, or set MODEL' % module.__name__)
+    return candidates[0]
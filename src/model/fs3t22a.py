@@ -4,7 +4,7 @@ try:
     from gpiozero import LED
 except:
     from test.fake_gpiozero import LED
-from siren import Motor, Siren, Solenoid
+from siren import Motor, Pattern, Siren, Solenoid
 
 class FS3T22A(Siren):
     """ Implements the various signalling modes for a Federal Signal 3T22A.
@@ -14,98 +14,66 @@ class FS3T22A(Siren):
     for a high-low or muted operation.
     """
 
-    def __init__(self, motor_gpio, high_gpio, low_gpio, lock, cond):
-        super(FS3T22A, self).__init__(lock, cond)
-        self._motor = Motor(LED(motor_gpio))
-        self._top_sol = Solenoid(LED(high_gpio))
-        self._bottom_sol = Solenoid(LED(low_gpio))
+    def __init__(self, motor_gpio, high_gpio, low_gpio, scheduler, watchdog, led_factory=LED):
+        super(FS3T22A, self).__init__(scheduler)
+        self._motor = Motor(led_factory(motor_gpio), gpio=motor_gpio)
+        self._top_sol = Solenoid(
+            led_factory(high_gpio), watchdog, name='high:%d' % high_gpio, gpio=high_gpio)
+        self._bottom_sol = Solenoid(
+            led_factory(low_gpio), watchdog, name='low:%d' % low_gpio, gpio=low_gpio)
+
+        motor, top, bottom = self._motor, self._top_sol, self._bottom_sol
+
+        # Steady tone.
+        self._alert = Pattern([
+            (0.0, [(motor, True)]),
+        ])
+
+        # Alternate the dampers every half second to warble the tone.
+        self._fire = Pattern([
+            (0.0, [(motor, True), (top, False), (bottom, True)]),
+            (0.5, [(bottom, False), (top, True)]),
+        ], period=1.0)
+
+        # Wail: four seconds on, four seconds off.
+        self._attack = Pattern([
+            (0.0, [(motor, True)]),
+            (4.0, [(motor, False)]),
+        ], period=8.0)
+
+        # Wail with the dampers warbling throughout.
+        fire_attack = []
+        for half_secs in range(16):
+            actions = []
+            if half_secs == 0:
+                actions.append((motor, True))
+            elif half_secs == 8:
+                actions.append((motor, False))
+            if half_secs % 2 == 0:
+                actions += [(top, False), (bottom, True)]
+            else:
+                actions += [(bottom, False), (top, True)]
+            fire_attack.append((half_secs * 0.5, actions))
+        self._fire_attack = Pattern(fire_attack, period=8.0)
 
     def __repr__(self):
         return '<FS3T22A: Model Federal Signal 3T22A>'
 
     def _on_test(self, duration=None):
         # Duration not used for test.
-        self._on_alert()
+        return self._on_alert()
 
     def _on_alert(self, duration=None):
-        self._motor.on()
-        self._wait_for_cancel(duration)
-        self._off()
+        return self._play(self._alert, duration)
 
     def _on_fire(self, duration=None):
-        self._motor.on()
-        while True:
-            self._top_sol.off()
-            self._bottom_sol.on()
-            if self._wait_for_cancel(0.5):
-                break
-            self._bottom_sol.off()
-            self._top_sol.on()
-            if self._wait_for_cancel(0.5):
-                break
-            if duration is not None:
-                duration -= 1
-                if duration <= 0:
-                    break
-        self._off()
+        return self._play(self._fire, duration)
 
     def _on_fire_attack(self, duration=None):
-        motor_next = True
-        cancelled = False
-        while not cancelled:
-            if motor_next:
-                self._motor.on()
-                motor_next = False
-            else:
-                self._motor.off()
-                motor_next = True
-
-            for secs in range(4):
-                self._top_sol.off()
-                self._bottom_sol.on()
-                if self._wait_for_cancel(0.5):
-                    cancelled = True
-                    break
-                self._bottom_sol.off()
-                self._top_sol.on()
-                if self._wait_for_cancel(0.5):
-                    cancelled = True
-                    break
-                if duration is not None:
-                    duration -= 1
-                    if duration <= 0:
-                        cancelled = True
-                        break
-        self._off()
+        return self._play(self._fire_attack, duration)
 
     def _on_attack(self, duration=None):
-        cancelled = False
-        while not cancelled:
-            self._motor.on()
-            for secs in range(4):
-                if self._wait_for_cancel(1):
-                    cancelled = True
-                    break
-                if duration is not None:
-                    duration -= 1
-                    if duration <= 0:
-                        cancelled = True
-                        break
-
-            self._motor.off()
-            if cancelled:
-                break
-
-            for secs in range(4):
-                if self._wait_for_cancel(1):
-                    cancelled = True
-                    break
-                if duration is not None:
-                    duration -= 1
-                    if duration <= 0:
-                        cancelled = True
-                        break
-        self._off()
+        return self._play(self._attack, duration)
 
     def _set_damper_high(self, closed):
         if closed:
@@ -0,0 +1,220 @@
+""" Sampling profiler and thread inspector, for finding jitter on a live unit.
+
+From the console:
+
+    >>> profiler.start()
+    >>> profiler.stop()
+    >>> print(profiler.report())       # per-thread CPU and waits
+    >>> profiler.save('/tmp/siren.folded')
+    >>> print(threads())               # what every thread is doing now
+
+Every `interval` seconds, a background thread records the stack of every
+other thread.  Stacks are counted in memory and written out collapsed, one
+`thread;outermost;...;innermost count` line each, for flamegraph.pl or
+speedscope.
+
+CPU and run-queue delay per thread come from the kernel's scheduler
+statistics.  Lock wait is estimated from the samples whose innermost frame
+is in `threading` or `queue`, blocked on a lock, condition or event; time
+spent acquiring a bare `Lock` can't be told from running, so it only shows
+as time off the CPU.
+"""
+
+import collections
+import os
+import sys
+import threading
+import time
+
+from config import PROFILER_INTERVAL
+
+# Innermost frames in these files are waiting, not running.
+_LOCK_WAITS = frozenset(['threading.py', 'queue.py'])
+_IO_WAITS = frozenset(['selectors.py'])
+
+
+def _sched_stats(native_id):
+    """ A thread's (CPU time, run-queue delay) in seconds, or None if unavailable. """
+    if native_id is None:
+        # Still starting.
+        return None
+    try:
+        with open('/proc/self/task/%d/schedstat' % native_id) as f:
+            on_cpu, delay = f.read().split()[:2]
+    except (OSError, ValueError):
+        return None
+    return int(on_cpu) / 1e9, int(delay) / 1e9
+
+
+def _frame_name(code):
+    return '%s:%s' % (os.path.basename(code.co_filename), getattr(code, 'co_qualname', code.co_name))
+
+
+def _wait_kind(code):
+    filename = os.path.basename(code.co_filename)
+    if filename in _LOCK_WAITS:
+        return 'lock'
+    if filename in _IO_WAITS:
+        return 'io'
+    return None
+
+
+def threads():
+    """ Every thread, with its CPU time and what it's doing right now. """
+    frames = sys._current_frames()
+    lines = ['%-24s %8s %10s %10s  %s' % ('thread', 'tid', 'cpu_ms', 'delay_ms', 'at')]
+    for thread in threading.enumerate():
+        frame = frames.get(thread.ident)
+        stats = _sched_stats(thread.native_id)
+        at = ''
+        if frame is not None:
+            at = '%s line %d' % (_frame_name(frame.f_code), frame.f_lineno)
+        lines.append('%-24s %8s %10s %10s  %s' % (
+            thread.name[:24], '-' if thread.native_id is None else thread.native_id,
+            '-' if stats is None else '%.1f' % (stats[0] * 1000),
+            '-' if stats is None else '%.1f' % (stats[1] * 1000),
+            at))
+    return '\n'.join(lines)
+
+
+class Profiler:
+    """ Samples every thread's stack every `interval` seconds while running. """
+
+    def __init__(self, interval=PROFILER_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        # Guards the counts, which the sampling thread updates.
+        self._data_lock = threading.Lock()
+        self._thread = None
+        self._running = threading.Event()
+        self._reset()
+
+    def _reset(self):
+        self._stacks = collections.Counter()
+        self._samples = collections.Counter()
+        self._waits = collections.Counter()
+        self._names = {}
+        self._baseline = {}
+        self._usage = None
+        self._started = None
+        self._elapsed = 0.0
+
+    def start(self):
+        """ Start sampling, discarding any earlier profile. """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._reset()
+            for thread in threading.enumerate():
+                self._baseline[thread.native_id] = _sched_stats(thread.native_id)
+            self._started = time.monotonic()
+            self._running.set()
+            self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """ Stop sampling.  The profile is kept until the next `start`. """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._running.clear()
+        thread.join()
+        self._elapsed = time.monotonic() - self._started
+        self._usage = self._thread_usage()
+
+    @property
+    def running(self):
+        return self._running.is_set()
+
+    def _run(self):
+        me = threading.get_ident()
+        deadline = time.monotonic()
+        while self._running.is_set():
+            self._sample(me)
+            deadline += self.interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                deadline = time.monotonic()
+
+    def _sample(self, me):
+        frames = sys._current_frames()
+        if any(ident not in self._names for ident in frames):
+            # Threads still starting have no native ID yet; they're named
+            # by a later sample.
+            self._names.update(
+                (t.ident, (t.name, t.native_id)) for t in threading.enumerate()
+                if t.native_id is not None)
+        with self._data_lock:
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                # Code objects are cheap to hash; they're only named in reports.
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                self._stacks[ident, tuple(codes)] += 1
+                self._samples[ident] += 1
+                wait = _wait_kind(codes[0])
+                if wait is not None:
+                    self._waits[ident, wait] += 1
+
+    def _thread_name(self, ident):
+        return self._names.get(ident, (str(ident), None))[0]
+
+    def collapsed(self):
+        """ The profile as collapsed stacks, most sampled first. """
+        with self._data_lock:
+            stacks = self._stacks.most_common()
+        lines = []
+        for (ident, codes), count in stacks:
+            names = [self._thread_name(ident)]
+            names.extend(_frame_name(code) for code in reversed(codes))
+            lines.append('%s %d' % (';'.join(names), count))
+        return '\n'.join(lines)
+
+    def save(self, path):
+        """ Write the collapsed stacks to `path`. """
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
+            f.write('\n')
+
+    def _thread_usage(self):
+        # CPU time and run-queue delay of each sampled thread since `start`.
+        usage = {}
+        for ident, (name, native_id) in list(self._names.items()):
+            stats = _sched_stats(native_id)
+            if stats is not None:
+                base = self._baseline.get(native_id) or (0.0, 0.0)
+                usage[ident] = (stats[0] - base[0], stats[1] - base[1])
+        return usage
+
+    def report(self):
+        """ Per-thread CPU use, run-queue delay and waits over the profile. """
+        if self.running:
+            elapsed, usage = time.monotonic() - self._started, self._thread_usage()
+        else:
+            elapsed, usage = self._elapsed, self._usage
+        if not elapsed:
+            return 'No profile; run profiler.start() first.'
+        with self._data_lock:
+            samples_by_thread = self._samples.most_common()
+            waits = dict(self._waits)
+        lines = ['%-24s %8s %6s %10s %8s %8s %8s' % (
+            'thread', 'cpu_ms', 'cpu%', 'delay_ms', 'samples', 'lock%', 'io%')]
+        for ident, samples in samples_by_thread:
+            name = self._thread_name(ident)
+            cpu, delay = usage.get(ident, (None, None))
+            lines.append('%-24s %8s %6s %10s %8d %8.1f %8.1f' % (
+                name[:24],
+                '-' if cpu is None else '%.1f' % (cpu * 1000),
+                '-' if cpu is None else '%.1f' % (100 * cpu / elapsed),
+                '-' if delay is None else '%.1f' % (delay * 1000),
+                samples,
+                100 * waits.get((ident, 'lock'), 0) / samples,
+                100 * waits.get((ident, 'io'), 0) / samples))
+        lines.append('%.1f s sampled every %.1f ms' % (elapsed, self.interval * 1000))
+        return '\n'.join(lines)
@@ -0,0 +1,284 @@
+""" Wire format of the WebSocket API.
+
+Version 1 is the original protocol: one JSON object per frame, such as
+`{"request": "set_tone", "tone": "fire"}`, with replies only to queries.
+
+Version 2 messages carry `"v": 2` and an optional request `id`, and every
+request is acknowledged with the same `id`:
+
+    {"v": 2, "id": 7, "request": "set_tone", "tone": "fire", "duration": 60}
+    {"v": 2, "id": 7, "ok": true, "mode": "FIRE", "at": 1234.5, "elapsed_ms": 0.2}
+
+A frame may also hold a JSON array of version 2 messages, which are handled
+in order and acknowledged together in one array frame.
+
+Errors carry a `status`, one of the `STATUS_` codes.  Mode changes can be
+turned down with `STATUS_PREEMPTED`, when the panel, console or schedule
+has just acted or acts before the change runs, or `STATUS_RATE_LIMITED`,
+when a client sends them too fast.
+
+Clients can subscribe to a stream of the timer's state with
+`{"v": 2, "request": "subscribe_state"}`.  They're sent a snapshot, then a
+delta of whatever changed with each update, numbered in sequence:
+
+    {"type": "state", "seq": 41, "at": 1234.5, "state": {"mode": "IDLE", ...}}
+    {"type": "state_delta", "seq": 42, "at": 1240.1, "changes": {"mode": "FIRE", ...}}
+
+Messages with a `seq` no later than the client's own can be ignored.  A
+gap in `seq` means deltas were dropped because the client fell behind; it
+can resubscribe with `"since": <seq>` to be sent just the deltas it
+missed, or a fresh snapshot if those are no longer kept.  The ack carries
+the `seq` the client is brought up to.  `unsubscribe_state` ends the
+stream.  The original `{"is_on": ...}` events are sent to every client
+regardless.
+
+Control commands can also be sent as binary frames, which are much smaller
+for dashboards driving many nodes.  A binary frame is a header followed by
+one or more fixed-size records, all big-endian:
+
+    header:   version (u8) = 2, record count (u8)
+    request:  id (u16), opcode (u8), mode (u8), duration (f64), start_at (f64)
+    ack:      id (u16), status (u8), mode (u8), at (f64), elapsed_ms (f32)
+
+Durations and start times of NaN mean "not given".  Modes are `Mode`
+values, and status is 0 for success or one of the `STATUS_` codes.
+
+Clients diagnosing the hardware can subscribe to telemetry with
+`{"v": 2, "request": "subscribe_telemetry", "rate": 50}`: samples of the
+relay and button states, up to `rate` a second, sent in batches as binary
+frames of their own, also big-endian:
+
+    header:   kind (u8) = TELEMETRY, record count (u16), relay bytes (u8)
+    sample:   at (f64), relays (relay bytes), raw buttons (u8), buttons (u8)
+
+`relays` is a bitmap as wide as the timer's group of sirens needs, given
+in the header: siren n's motor, high and low relays are bits 3n, 3n+1 and
+3n+2 of it, read as one big-endian number.  Buttons are `Button.bit`
+masks, as read and after debouncing.
+`unsubscribe_telemetry` stops the samples.  A client that falls behind
+misses telemetry frames, never events or state.
+"""
+
+import json
+import math
+import struct
+
+VERSION = 2
+
+# Binary opcodes, and the request each stands for.
+OP_TURN_ON = 1
+OP_TURN_OFF = 2
+OP_SET_TONE = 3
+OP_GET_STATE = 4
+
+_OPCODES = {
+    OP_TURN_ON : 'turn_on',
+    OP_TURN_OFF : 'turn_off',
+    OP_SET_TONE : 'set_tone',
+    OP_GET_STATE : 'get_state',
+}
+
+# Binary ack status codes.
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_INVALID_TONE = 2
+STATUS_UNSUPPORTED = 3
+STATUS_PREEMPTED = 4
+STATUS_RATE_LIMITED = 5
+
+_HEADER = struct.Struct('!BB')
+_REQUEST = struct.Struct('!HBBdd')
+_ACK = struct.Struct('!HBBdf')
+
+# Telemetry frames lead with this instead of a version, so clients can tell
+# them from acks.
+TELEMETRY = ord('T')
+_TELEMETRY_HEADER = struct.Struct('!BHB')
+# A telemetry sample without its relay bitmap.
+_TELEMETRY_FIXED = struct.Struct('!dBB')
+_TELEMETRY_MAX_RELAY_BYTES = 255
+
+
+class ProtocolError(Exception):
+    """ A frame that couldn't be decoded. """
+
+
+class Frame:
+    """ A decoded frame: its messages, and how replies should be encoded. """
+
+    def __init__(self, messages, binary=False, batched=False):
+        self.messages = messages
+        self.binary = binary
+        self.batched = batched
+
+
+def decode(data):
+    """ Decode a received WebSocket frame.
+
+    Returns:
+      A `Frame`.  Every message is a dict; those from binary frames are
+      converted to their version 2 JSON equivalents, with `mode` holding the
+      requested `Mode` value.
+
+    Raises:
+      ProtocolError: If the frame is malformed.
+    """
+    if isinstance(data, bytes):
+        return Frame(_decode_binary(data), binary=True, batched=True)
+
+    try:
+        message = json.loads(data)
+    except ValueError as e:
+        raise ProtocolError('Invalid JSON: %s' % e)
+
+    if isinstance(message, list):
+        if not all(isinstance(m, dict) for m in message):
+            raise ProtocolError('Batches must be arrays of objects')
+        for m in message:
+            m.setdefault('v', VERSION)
+        return Frame(message, batched=True)
+    if not isinstance(message, dict):
+        raise ProtocolError('Messages must be objects')
+    return Frame([message])
+
+
+def encode(frame, responses):
+    """ Encode `responses` to the messages of `frame` for sending.
+
+    A `mode` in a response may be a `Mode`, which is sent by name in JSON
+    and by value in binary.
+    """
+    if frame.binary:
+        return _encode_binary(responses)
+    if frame.batched:
+        return json.dumps(responses, default=_to_json)
+    return json.dumps(responses[0], default=_to_json)
+
+
+def _to_json(value):
+    # Modes are the only non-JSON values we send.
+    return value.name
+
+
+def version(message):
+    return message.get('v', 1)
+
+
+def ack(message, **fields):
+    """ A version 2 reply to `message`. """
+    response = {'v': VERSION, 'id': message.get('id'), 'ok': True}
+    response.update(fields)
+    return response
+
+
+def error(message, text, status=STATUS_ERROR):
+    """ An error reply to `message`, in the message's protocol version. """
+    if version(message) < VERSION:
+        return {'error': text}
+    return {'v': VERSION, 'id': message.get('id'), 'ok': False, 'error': text, 'status': status}
+
+
+def _optional(value):
+    return None if math.isnan(value) else value
+
+
+def _decode_binary(data):
+    if len(data) < _HEADER.size:
+        raise ProtocolError('Truncated binary frame')
+    frame_version, count = _HEADER.unpack_from(data)
+    if frame_version != VERSION:
+        raise ProtocolError('Unsupported binary version %d' % frame_version)
+    if len(data) != _HEADER.size + count * _REQUEST.size:
+        raise ProtocolError('Binary frame length does not match record count')
+
+    messages = []
+    for i in range(count):
+        request_id, opcode, mode, duration, start_at = _REQUEST.unpack_from(
+            data, _HEADER.size + i * _REQUEST.size)
+        messages.append({
+            'v': VERSION,
+            'id': request_id,
+            'request': _OPCODES.get(opcode, 'opcode %d' % opcode),
+            'mode': mode,
+            'duration': _optional(duration),
+            'start_at': _optional(start_at),
+        })
+    return messages
+
+
+def _encode_binary(responses):
+    parts = [_HEADER.pack(VERSION, len(responses))]
+    for response in responses:
+        if response.get('ok'):
+            status = STATUS_OK
+        else:
+            status = response.get('status', STATUS_ERROR)
+        at = response.get('at')
+        mode = response.get('mode')
+        parts.append(_ACK.pack(
+            response.get('id') or 0,
+            status,
+            0 if mode is None else mode.value,
+            math.nan if at is None else at,
+            response.get('elapsed_ms', 0.0)))
+    return b''.join(parts)
+
+
+def encode_request(request_id, opcode, mode=0, duration=None, start_at=None):
+    """ Encode one binary request record, for clients.  Prefix with `binary_header`. """
+    return _REQUEST.pack(
+        request_id, opcode, mode,
+        math.nan if duration is None else duration,
+        math.nan if start_at is None else start_at)
+
+
+def binary_header(count):
+    return _HEADER.pack(VERSION, count)
+
+
+def telemetry_sample(relays):
+    """ The `struct.Struct` of a telemetry sample with `relays` relay bits.
+
+    Pack the relay bitmap as `relay_bytes(bitmap, sample)`.
+
+    Raises:
+      ValueError: If there are too many relays to fit in a sample.
+    """
+    width = max(1, (relays + 7) // 8)
+    if width > _TELEMETRY_MAX_RELAY_BYTES:
+        raise ValueError('Too many relays for telemetry: %d' % relays)
+    return struct.Struct('!d%dsBB' % width)
+
+
+def relay_bytes(bitmap, sample):
+    """ The relay `bitmap` as bytes to pack into `sample`. """
+    return bitmap.to_bytes(sample.size - _TELEMETRY_FIXED.size, 'big')
+
+
+def telemetry_header(count, sample):
+    """ The header of a telemetry frame of `count` samples packed with `sample`. """
+    return _TELEMETRY_HEADER.pack(TELEMETRY, count, sample.size - _TELEMETRY_FIXED.size)
+
+
+def decode_telemetry(data):
+    """ Decode a telemetry frame, for clients.
+
+    Returns:
+      A list of `(at, relays, raw_buttons, buttons)` tuples.
+    """
+    _, count, width = _TELEMETRY_HEADER.unpack_from(data)
+    sample = struct.Struct('!d%dsBB' % width)
+    return [
+        (at, int.from_bytes(relays, 'big'), raw_buttons, buttons)
+        for at, relays, raw_buttons, buttons in sample.iter_unpack(
+            data[_TELEMETRY_HEADER.size:_TELEMETRY_HEADER.size + count * sample.size])]
+
+
+def decode_acks(data):
+    """ Decode a binary ack frame, for clients.
+
+    Returns:
+      A list of `(id, status, mode, at, elapsed_ms)` tuples.
+    """
+    _, count = _HEADER.unpack_from(data)
+    return [_ACK.unpack_from(data, _HEADER.size + i * _ACK.size) for i in range(count)]
@@ -4,6 +4,11 @@
 LED_READY = 9
 LED_ALARM = 11
 
+from .clock import Clock, VirtualClock
 from .motor import Motor
+from .pattern import Pattern, Playback
+from .scheduler import Scheduler, Timer
 from .siren import Siren
+from .group import SirenGroup
 from .solenoid import Solenoid
+from .watchdog import Watchdog
@@ -0,0 +1,45 @@
+""" Clock abstraction, so siren timing can run against real or virtual time. """
+
+import threading
+import time
+
+
+class Clock:
+    """ The system clock. """
+    virtual = False
+
+    def monotonic(self):
+        """ Seconds from an arbitrary epoch, never going backwards. """
+        return time.monotonic()
+
+    def time(self):
+        """ Wall-clock time, in seconds since the Unix epoch. """
+        return time.time()
+
+
+class VirtualClock(Clock):
+    """ A clock that only moves when told to.
+
+    A `Scheduler` using a virtual clock doesn't start a thread; instead,
+    `Scheduler.advance` moves the clock forward and runs every callback that
+    comes due on the way, each at exactly its deadline.  Hours of signalling
+    can then be simulated in milliseconds.
+    """
+    virtual = True
+
+    def __init__(self, start=0.0, epoch=None):
+        self._now = start
+        self._epoch = time.time() - start if epoch is None else epoch
+        self._lock = threading.Lock()
+
+    def monotonic(self):
+        return self._now
+
+    def time(self):
+        return self._epoch + self._now
+
+    def set(self, now):
+        """ Move the clock to `now`.  Time never goes backwards. """
+        with self._lock:
+            if now > self._now:
+                self._now = now
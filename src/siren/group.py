@@ -0,0 +1,72 @@
+""" Drives several sirens as one. """
+
+from .pattern import Pattern, Playback
+from .siren import Siren
+
+
+class SirenGroup(Siren):
+    """ A group of sirens signalling together from one AF timer.
+
+    Every event is forwarded to each siren in the group, and the resulting
+    patterns are merged into a single timeline played on the shared
+    scheduler.  All sirens therefore start on the same tick and stay in
+    phase, and the group costs one scheduler timer per step however many
+    sirens it has.
+
+    Sirens whose patterns can't be merged (a steady tone on one model and a
+    periodic one on another) can't be grouped for that event.
+    """
+
+    def __init__(self, sirens, scheduler):
+        super(SirenGroup, self).__init__(scheduler)
+        self._sirens = list(sirens)
+        self._merged = {}
+
+    def __repr__(self):
+        return '<SirenGroup: %s>' % ', '.join(repr(s) for s in self._sirens)
+
+    def __iter__(self):
+        return iter(self._sirens)
+
+    def __len__(self):
+        return len(self._sirens)
+
+    def _combine(self, event, duration):
+        playbacks = [p for p in (getattr(s, event)(duration) for s in self._sirens)
+                     if p is not None]
+        if not playbacks:
+            return None
+
+        # Sirens reuse their patterns, so the merged timeline is cached.
+        key = tuple(p.pattern for p in playbacks)
+        pattern = self._merged.get(key)
+        if pattern is None:
+            pattern = self._merged[key] = Pattern.merge(key)
+        return Playback.combine(self._scheduler, playbacks, pattern)
+
+    def _on_test(self, duration=None):
+        return self._combine('_on_test', duration)
+
+    def _on_alert(self, duration=None):
+        return self._combine('_on_alert', duration)
+
+    def _on_fire(self, duration=None):
+        return self._combine('_on_fire', duration)
+
+    def _on_fire_attack(self, duration=None):
+        return self._combine('_on_fire_attack', duration)
+
+    def _on_attack(self, duration=None):
+        return self._combine('_on_attack', duration)
+
+    def _set_damper_high(self, closed):
+        for siren in self._sirens:
+            siren._set_damper_high(closed)
+
+    def _set_damper_low(self, closed):
+        for siren in self._sirens:
+            siren._set_damper_low(closed)
+
+    def _off(self):
+        for siren in self._sirens:
+            siren._off()
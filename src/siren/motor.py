@@ -1,14 +1,25 @@
 """ Motor control for the AF timer. """
 
+import journal
+import metrics
+
+_RELAY_WRITE = metrics.histogram('relay.motor')
+
+
 class Motor:
-    def __init__(self, relay):
+    def __init__(self, relay, gpio=0):
         self._relay = relay
+        self._gpio = gpio
         self._relay.off()
 
     def on(self):
         """ Turn the siren motor on. """
-        self._relay.on()
+        with metrics.Span(_RELAY_WRITE):
+            self._relay.on()
+        journal.record_relay(self._gpio, True)
 
     def off(self):
         """ Turn the siren motor off. """
-        self._relay.off()
\ No newline at end of file
+        with metrics.Span(_RELAY_WRITE):
+            self._relay.off()
+        journal.record_relay(self._gpio, False)
@@ -0,0 +1,259 @@
+""" Declarative relay timelines for siren signalling patterns. """
+
+from fractions import Fraction
+import math
+import threading
+
+
+class Pattern:
+    """ A timeline of relay transitions.
+
+    A pattern is a list of steps, each an offset in seconds from the start of
+    the cycle and the relay states to apply at that offset:
+
+        Pattern([
+            (0.0, [(motor, True)]),
+            (4.0, [(motor, False)]),
+        ], period=8.0)
+
+    Relays are anything with `on()` and `off()` methods, such as `Motor` and
+    `Solenoid`.  If `period` is set, the steps repeat every `period` seconds;
+    otherwise they're applied once and the last state is held.
+    """
+
+    def __init__(self, steps, period=None):
+        self.steps = [(float(offset), tuple(actions)) for offset, actions in steps]
+        self.period = period
+
+        offsets = [offset for offset, _ in self.steps]
+        if offsets != sorted(offsets):
+            raise ValueError('Pattern steps must be in time order')
+        if offsets and offsets[0] < 0:
+            raise ValueError('Pattern steps must not have negative offsets')
+        if period is not None and offsets and offsets[-1] >= period:
+            raise ValueError('Pattern steps must fall within the period')
+
+    def __repr__(self):
+        return '<Pattern: %d steps, period %s>' % (len(self.steps), self.period)
+
+    def deadlines(self, start, since=None):
+        """ Yields `(deadline, actions)` for every step, forever if periodic.
+
+        Deadlines are absolute, computed from `start` rather than from the
+        previous step, so time spent switching relays doesn't accumulate.
+
+        If `since` is given, whole cycles that ended more than a cycle before
+        `since` are skipped.  The steps that remain before `since` are enough
+        to re-establish the pattern's state at that point.
+        """
+        if not self.steps:
+            return
+        cycle = 0
+        if since is not None and self.period and since > start:
+            cycle = max(0, math.floor((since - start) / self.period) - 1)
+        while True:
+            base = start + cycle * self.period if self.period else start
+            for offset, actions in self.steps:
+                yield base + offset, actions
+            if not self.period:
+                return
+            cycle += 1
+
+    @classmethod
+    def merge(cls, patterns):
+        """ Combine several patterns into one that plays them all in phase.
+
+        Periodic patterns with different periods are unrolled to their least
+        common multiple.  One-shot patterns can only be merged with other
+        one-shot patterns.
+        """
+        periods = set(pattern.period for pattern in patterns)
+        if len(periods) > 1 and None in periods:
+            raise ValueError('Cannot merge one-shot and periodic patterns')
+
+        if None in periods:
+            period = None
+        else:
+            period = _lcm([_to_fraction(p) for p in periods])
+
+        merged = {}
+        for pattern in patterns:
+            repeats = 1 if period is None else int(period / _to_fraction(pattern.period))
+            for cycle in range(repeats):
+                base = 0.0 if period is None else cycle * pattern.period
+                for offset, actions in pattern.steps:
+                    merged.setdefault(base + offset, []).extend(actions)
+
+        return cls(sorted(merged.items()), period=None if period is None else float(period))
+
+    @staticmethod
+    def apply(actions):
+        """ Switch each relay in `actions` to its requested state. """
+        for relay, on in actions:
+            if on:
+                relay.on()
+            else:
+                relay.off()
+
+
+def _to_fraction(seconds):
+    return Fraction(seconds).limit_denominator(1000)
+
+
+def _lcm(fractions):
+    result = fractions[0]
+    for f in fractions[1:]:
+        # lcm(a/b, c/d) = lcm(a, c) / gcd(b, d)
+        numerator = result.numerator * f.numerator // math.gcd(result.numerator, f.numerator)
+        result = Fraction(numerator, math.gcd(result.denominator, f.denominator))
+    return result
+
+
+def _catch_up(steps, now):
+    """ Collapses the steps in `steps` that are already due into one step at `now`.
+
+    Relays then switch straight to the state the pattern should be in, rather
+    than chattering through every step that was missed.
+    """
+    merged = {}
+    for deadline, actions in steps:
+        if deadline > now:
+            if merged:
+                yield now, tuple(merged.items())
+            yield deadline, actions
+            yield from steps
+            return
+        for relay, on in actions:
+            merged[relay] = on
+    if merged:
+        yield now, tuple(merged.items())
+
+
+class Playback:
+    """ A `Pattern` being played on a `Scheduler`.
+
+    Each step is a single scheduler timer armed for the step's absolute
+    deadline; no thread is tied up while the pattern plays.  `on_stop` is
+    called once when playback ends for any reason, and is where the siren
+    should turn its relays off.
+    """
+
+    def __init__(self, scheduler, pattern, duration=None, on_stop=None):
+        self._scheduler = scheduler
+        self._pattern = pattern
+        self._duration = duration
+        self._on_stop = on_stop
+        self._on_finish = None
+        self.start_time = None
+
+        self._lock = threading.Lock()
+        self._steps = None
+        self._actions = None
+        self._end = None
+        self._timer = None
+        self._done = False
+
+    def __repr__(self):
+        return '<Playback %s%s>' % (self._pattern, self._done and ' (done)' or '')
+
+    @property
+    def pattern(self):
+        return self._pattern
+
+    @property
+    def duration(self):
+        return self._duration
+
+    @classmethod
+    def combine(cls, scheduler, playbacks, pattern=None):
+        """ A single playback of several unstarted playbacks, started in phase.
+
+        Args:
+          scheduler: The scheduler to play on.
+          playbacks: The playbacks to combine.  They must share a duration.
+          pattern: Optional pre-merged pattern of the playbacks' patterns.
+        """
+        if pattern is None:
+            pattern = Pattern.merge([p.pattern for p in playbacks])
+        stops = [p._on_stop for p in playbacks if p._on_stop is not None]
+
+        def on_stop():
+            for stop in stops:
+                stop()
+
+        return cls(scheduler, pattern, playbacks[0].duration, on_stop=on_stop)
+
+    def start(self, on_finish=None, start=None):
+        """ Start playing.
+
+        Args:
+          on_finish: Optional callable run on the scheduler thread, with this
+                     playback as its argument, if the pattern plays for its
+                     whole duration.  It's not called if playback is cancelled.
+          start: Optional scheduler time the pattern starts at; defaults to
+                 now.  A time in the future delays the first step.  A time in
+                 the past joins the pattern mid-way: the steps that would have
+                 run recently are applied at once to catch up, and from then
+                 on the pattern stays in phase with `start`.
+        """
+        now = self._scheduler.time()
+        if start is None:
+            start = now
+        with self._lock:
+            self.start_time = start
+            self._on_finish = on_finish
+            self._steps = _catch_up(self._pattern.deadlines(start, since=now), now)
+            if self._duration is not None:
+                self._end = start + self._duration
+            self._schedule_next()
+
+    def cancel(self):
+        """ Stop playing.
+
+        Once this returns, no further steps will be applied and `on_stop` has
+        run.  Returns False if playback had already ended.
+        """
+        with self._lock:
+            if self._done:
+                return False
+            self._done = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._stop()
+        return True
+
+    def is_done(self):
+        return self._done
+
+    def _stop(self):
+        if self._on_stop is not None:
+            self._on_stop()
+
+    def _schedule_next(self):
+        deadline, self._actions = next(self._steps, (None, None))
+        if deadline is not None and (self._end is None or deadline < self._end):
+            self._timer = self._scheduler.call_at(deadline, self._step)
+        elif self._end is not None:
+            self._timer = self._scheduler.call_at(self._end, self._finish)
+        else:
+            # A one-shot pattern with no duration holds its last state until
+            # cancelled.
+            self._timer = None
+
+    def _step(self):
+        with self._lock:
+            if self._done:
+                return
+            Pattern.apply(self._actions)
+            self._schedule_next()
+
+    def _finish(self):
+        with self._lock:
+            if self._done:
+                return
+            self._done = True
+            self._timer = None
+            self._stop()
+        if self._on_finish is not None:
+            self._on_finish(self)
@@ -0,0 +1,164 @@
+""" Single-threaded timer scheduler driving siren patterns and watchdogs. """
+
+import heapq
+import itertools
+import threading
+import traceback
+
+from .clock import Clock
+
+
+class Timer:
+    """ Handle for a callback scheduled on a `Scheduler`. """
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __repr__(self):
+        return '<Timer %.3f: %s%s>' % (
+            self.deadline, self.callback, self.cancelled and ' (cancelled)' or '')
+
+    def cancel(self):
+        """ Prevent the callback from running, if it hasn't already. """
+        self.cancelled = True
+
+
+class Scheduler:
+    """ Runs callbacks at monotonic deadlines from one long-lived thread.
+
+    Pending callbacks are kept in a heap ordered by deadline, and the thread
+    sleeps until the earliest one is due.  Cancelled timers are discarded
+    lazily when they reach the top of the heap.
+
+    Callbacks run on the scheduler thread one at a time, so they must not
+    block; anything that needs to wait should schedule a follow-up callback
+    instead.
+
+    With a `VirtualClock`, no thread is started and time only passes when
+    `advance` is called.
+    """
+
+    def __init__(self, clock=None):
+        self._clock = clock or Clock()
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+        self._running = False
+
+    @property
+    def clock(self):
+        return self._clock
+
+    def start(self):
+        """ Start the scheduler thread. """
+        if self._clock.virtual:
+            return
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the scheduler thread.  Pending callbacks are not run. """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def time(self):
+        """ The scheduler's notion of the current time. """
+        return self._clock.monotonic()
+
+    def in_scheduler_thread(self):
+        return self._thread is threading.current_thread()
+
+    def advance(self, seconds):
+        """ Move a virtual clock forward by `seconds`, running callbacks as they come due.
+
+        Each callback runs on the calling thread with the clock set to its
+        deadline, so callbacks that schedule further callbacks within the
+        window run too.
+        """
+        if not self._clock.virtual:
+            raise RuntimeError('Only a scheduler with a virtual clock can be advanced')
+        end = self.time() + seconds
+        while True:
+            with self._cond:
+                timer = None
+                while self._heap and self._heap[0][0] <= end:
+                    _, _, candidate = heapq.heappop(self._heap)
+                    if not candidate.cancelled:
+                        timer = candidate
+                        break
+            if timer is None:
+                break
+            self._clock.set(timer.deadline)
+            self._run_timer(timer)
+        self._clock.set(end)
+
+    def call_at(self, deadline, callback, *args):
+        """ Run `callback(*args)` at monotonic time `deadline`.
+
+        Returns:
+          A `Timer` that can be used to cancel the call.
+        """
+        timer = Timer(deadline, callback, args)
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, next(self._seq), timer))
+            if self._heap[0][2] is timer:
+                # New earliest deadline; wake the thread to re-arm its sleep.
+                self._cond.notify()
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """ Run `callback(*args)` after `delay` seconds. """
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def call_soon(self, callback, *args):
+        """ Run `callback(*args)` on the scheduler thread as soon as possible. """
+        return self.call_at(self.time(), callback, *args)
+
+    def _next_due(self):
+        """ Pop the next timer that is due, or return None if none is.
+
+        Must be called with `_cond` held.  Also returns how long to sleep
+        before checking again, or None to sleep until notified.
+        """
+        while self._heap:
+            deadline, _, timer = self._heap[0]
+            if timer.cancelled:
+                heapq.heappop(self._heap)
+                continue
+            delay = deadline - self.time()
+            if delay > 0:
+                return None, delay
+            heapq.heappop(self._heap)
+            return timer, 0
+        return None, None
+
+    def _run_timer(self, timer):
+        try:
+            timer.callback(*timer.args)
+        except Exception:
+            traceback.print_exc()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._running:
+                        return
+                    timer, delay = self._next_due()
+                    if timer is not None:
+                        break
+                    self._cond.wait(delay)
+            self._run_timer(timer)
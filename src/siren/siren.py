@@ -1,7 +1,7 @@
 """ Interface for any siren driven by the A11 AF Timer. """
 
-import threading
 from . import LED_ALARM
+from .pattern import Playback
 
 
 class Siren:
@@ -18,13 +18,14 @@ class Siren:
     implement whatever functionality makes sense.  The mode of operation
     of the siren can be customized as well.
 
-    Note that each event function is called in a thread that can be
-    cancelled.  To detect cancellation, use the `_wait_for_cancel` function.
+    Note that event functions must not block.  Each describes its signal as
+    a `Pattern` and returns a `Playback` of it from `_play`, which the AF
+    timer starts on the shared scheduler and cancels as needed.  Returning
+    None means the siren has no function for that event.
     """
 
-    def __init__(self, cancel_lock, cancel_cond):
-        self._cancel_cond = cancel_cond
-        self._cancel_lock = cancel_lock
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
 
     def _on_test(self, duration=None):
         """ Called when the "Test" button is pressed. """
@@ -47,16 +48,18 @@ class Siren:
     def _set_damper_low(self, closed):
         """ Close the low damper if `closed` is set. """
 
-    def _wait_for_cancel(self, timeout=None):
-        """ A utility function that implementations can use to interruptably sleep.
+    def _off(self):
+        """ Turn everything off. """
+
+    def _play(self, pattern, duration=None):
+        """ A utility function that implementations can use to play a pattern.
 
         Args:
-          timeout: Optional time in seconds to delay.
+          pattern: The `Pattern` to play.
+          duration: Optional time in seconds to play for.  If not given, the
+                    pattern plays until cancelled.
 
         Returns:
-          True if the "Cancel" button was pushed (or "Test" was released) before the timeout,
-          False if the timeout expired.
+          An unstarted `Playback`, which turns the siren off when it ends.
         """
-        with self._cancel_lock:
-            return self._cancel_cond.wait(timeout)
-
+        return Playback(self._scheduler, pattern, duration, on_stop=self._off)
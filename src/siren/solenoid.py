@@ -1,46 +1,54 @@
 """ Solenoid functionality. """
 
 import threading
-import time
+
+import journal
+import metrics
+
+_RELAY_WRITE = metrics.histogram('relay.solenoid')
+_TRIPS = metrics.counter('solenoid.watchdog_trips')
+
 
 class Solenoid:
     MAX_ON_TIME = 5
 
-    def __init__(self, relay):
+    def __init__(self, relay, watchdog, name='solenoid', gpio=0):
         self._relay = relay
+        self._gpio = gpio
         self._relay.off()
 
-        self._thread = None
-        self._cancel_lock = threading.Lock()
-        self._cancel_cond = threading.Condition(self._cancel_lock)
+        self._watchdog = watchdog
+        self._watchdog.register(self, name, self.MAX_ON_TIME)
+        self._lock = threading.Lock()
 
-    def on(self):
+    def on(self, how_long=None):
         """ Turn the solenoid on, optionally for `how_long` seconds.
 
         If not specified, the max runtime is used to protect the
-        solenoid.
+        solenoid.  Calling this while the solenoid is already on moves
+        its cutoff, but never past `MAX_ON_TIME` from when it came on.
         """
-        self._relay.on()
-
-        def watchdog():
-            for t in range(self.MAX_ON_TIME):
-                with self._cancel_lock:
-                    if self._cancel_cond.wait(1):
-                        break
-            self._relay.off()
-            self._thread = None
-
-        if self._thread is None:
-            self._thread = threading.Thread(target=watchdog)
-            self._thread.start()
+        with self._lock:
+            with metrics.Span(_RELAY_WRITE):
+                self._relay.on()
+            journal.record_relay(self._gpio, True)
+            self._watchdog.arm(self, how_long)
 
     def off(self):
-        """ Turn the siren motor off. """
-        self._relay.off()
-        with self._cancel_lock:
-            self._cancel_cond.notify_all()
-
-        if self._thread is not None:
-            self._thread.join()
-            self._thread = None
-
+        """ Turn the solenoid off. """
+        with self._lock:
+            with metrics.Span(_RELAY_WRITE):
+                self._relay.off()
+            journal.record_relay(self._gpio, False)
+            self._watchdog.disarm(self)
+
+    def _trip(self, deadline):
+        """ Called by the watchdog when the solenoid's deadline passes. """
+        with self._lock:
+            if not self._watchdog.expired(self, deadline):
+                return
+            with metrics.Span(_RELAY_WRITE):
+                self._relay.off()
+            journal.record_relay(self._gpio, False)
+            self._watchdog.disarm(self, tripped=True)
+            _TRIPS.inc()
@@ -0,0 +1,154 @@
+""" Shared on-time watchdog for relay-driven coils. """
+
+import heapq
+import itertools
+import threading
+
+
+class CoilStats:
+    """ On-time accounting for one coil. """
+    __slots__ = ('name', 'max_on_time', 'activations', 'trips', 'total_on_time',
+                 'longest_on_time', 'on_since', 'deadline')
+
+    def __init__(self, name, max_on_time):
+        self.name = name
+        self.max_on_time = max_on_time
+        self.activations = 0
+        self.trips = 0
+        self.total_on_time = 0.0
+        self.longest_on_time = 0.0
+        self.on_since = None
+        self.deadline = None
+
+    def as_dict(self, now):
+        """ Returns the stats as a dictionary, counting the current on period. """
+        current = 0.0 if self.on_since is None else now - self.on_since
+        return {
+            'max_on_time': self.max_on_time,
+            'activations': self.activations,
+            'trips': self.trips,
+            'total_on_time': self.total_on_time + current,
+            'longest_on_time': max(self.longest_on_time, current),
+            'on_for': current,
+            'off_in': None if self.deadline is None else max(0.0, self.deadline - now),
+        }
+
+
+class Watchdog:
+    """ Cuts power to coils that have been energized for too long.
+
+    Every energized coil has a deadline, kept in a single heap shared by all
+    coils.  Only the earliest deadline is armed on the scheduler, so the cost
+    doesn't grow with the number of coils and cutoffs land on the deadline
+    itself rather than on a polling tick.
+
+    A coil may be re-armed while it is on to move its deadline, but never past
+    `max_on_time` after it was first energized, which is the coil's thermal
+    limit.
+
+    Coils register with `register` and must implement `_trip(deadline)`,
+    which the watchdog calls on the scheduler thread when a deadline passes.
+    The coil should check `expired(coil, deadline)` before acting, since it
+    may have been re-armed in the meantime.
+    """
+
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+        self._lock = threading.Lock()
+        self._heap = []
+        self._seq = itertools.count()
+        self._timer = None
+        self._coils = {}
+
+    def register(self, coil, name, max_on_time):
+        """ Start tracking `coil`, which may stay on for at most `max_on_time` seconds. """
+        with self._lock:
+            self._coils[coil] = CoilStats(name, max_on_time)
+
+    def arm(self, coil, how_long=None):
+        """ Note that `coil` is on, and set its deadline.
+
+        Args:
+          coil: A registered coil.
+          how_long: Optional time in seconds, from now, to cut the coil off.
+                    Limited to the coil's remaining thermal budget; if not
+                    given, the coil may stay on for the full budget.
+
+        Returns:
+          The monotonic deadline at which the coil will be cut off.
+        """
+        now = self._scheduler.time()
+        with self._lock:
+            stats = self._coils[coil]
+            if stats.on_since is None:
+                stats.on_since = now
+                stats.activations += 1
+            limit = stats.on_since + stats.max_on_time
+            deadline = limit if how_long is None else min(now + how_long, limit)
+            if deadline != stats.deadline:
+                stats.deadline = deadline
+                heapq.heappush(self._heap, (deadline, next(self._seq), coil))
+                self._arm_timer()
+            return deadline
+
+    def disarm(self, coil, tripped=False):
+        """ Note that `coil` is off, and account for the time it was on. """
+        now = self._scheduler.time()
+        with self._lock:
+            stats = self._coils[coil]
+            if stats.on_since is None:
+                return
+            on_time = now - stats.on_since
+            stats.total_on_time += on_time
+            stats.longest_on_time = max(stats.longest_on_time, on_time)
+            stats.on_since = None
+            stats.deadline = None
+            if tripped:
+                stats.trips += 1
+            # The heap entry is left in place and discarded when it comes due.
+
+    def expired(self, coil, deadline):
+        """ True if `deadline` is still the current deadline for `coil`. """
+        with self._lock:
+            return self._coils[coil].deadline == deadline
+
+    def stats(self):
+        """ Returns on-time accounting for every coil, keyed by name. """
+        now = self._scheduler.time()
+        with self._lock:
+            return {stats.name: stats.as_dict(now) for stats in self._coils.values()}
+
+    def _arm_timer(self):
+        """ Point the scheduler timer at the earliest live deadline.
+
+        Must be called with `_lock` held.
+        """
+        while self._heap:
+            deadline, _, coil = self._heap[0]
+            if self._coils[coil].deadline == deadline:
+                break
+            heapq.heappop(self._heap)
+        else:
+            deadline = None
+
+        if self._timer is not None:
+            if self._timer.deadline == deadline:
+                return
+            self._timer.cancel()
+            self._timer = None
+        if deadline is not None:
+            self._timer = self._scheduler.call_at(deadline, self._expire)
+
+    def _expire(self):
+        now = self._scheduler.time()
+        due = []
+        with self._lock:
+            self._timer = None
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, coil = heapq.heappop(self._heap)
+                if self._coils[coil].deadline == deadline:
+                    due.append((coil, deadline))
+            self._arm_timer()
+
+        for coil, deadline in due:
+            coil._trip(deadline)
@@ -0,0 +1,84 @@
+""" Start-up profiling.
+
+Times are measured from when the process was exec'd, so they include the
+interpreter's own start-up and every import, not just what `main` does.
+For a per-module breakdown of the imports, run with `python3 -X importtime`.
+"""
+
+import importlib
+import os
+import time
+
+import metrics
+
+
+def process_age():
+    """ Seconds since this process started, or None if it can't be told. """
+    try:
+        with open('/proc/self/stat') as f:
+            # Field 22, counting from the state after the command name.
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+class StartupProfile:
+    """ Milestones of start-up, each timed from process start.
+
+        profile = StartupProfile()
+        ...
+        profile.mark('panel_ready')
+        websocket = profile.load('websocket')
+        print(profile.report())
+
+    Each milestone is also recorded in the `startup.<name>` histogram.
+    """
+
+    def __init__(self):
+        # Process age has clock-tick resolution; take it once and time the
+        # rest on the monotonic clock.
+        age = process_age()
+        self._origin = time.monotonic() - (age or 0.0)
+        self.exact = age is not None
+        self._marks = []
+
+    def elapsed(self):
+        """ Seconds since process start. """
+        return time.monotonic() - self._origin
+
+    def mark(self, name):
+        """ Record reaching milestone `name`.  Returns the time since start. """
+        at = self.elapsed()
+        self._marks.append((name, at))
+        metrics.histogram('startup.' + name).observe(at * 1000)
+        return at
+
+    def at(self, name):
+        """ When milestone `name` was reached, in seconds since start. """
+        for mark in self._marks:
+            if mark[0] == name:
+                return mark[1]
+        raise KeyError(name)
+
+    def load(self, module):
+        """ Import `module`, recording how long it took as `import:<module>`. """
+        started = time.monotonic()
+        result = importlib.import_module(module)
+        self._marks.append(('import:' + module, self.elapsed(), time.monotonic() - started))
+        return result
+
+    def report(self):
+        """ A table of milestones, with their time from start and from the one before. """
+        lines = ['%-28s %10s %10s' % ('startup (ms)', 'at', 'took')]
+        if not self.exact:
+            lines.append('(process start unknown; times are from profile creation)')
+        previous = 0.0
+        for mark in self._marks:
+            name, at = mark[:2]
+            took = mark[2] if len(mark) > 2 else at - previous
+            lines.append('%-28s %10.1f %10.1f' % (name, at * 1000, took * 1000))
+            previous = at
+        return '\n'.join(lines)
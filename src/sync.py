@@ -0,0 +1,189 @@
+""" Clock-synchronized activation across several AF timer nodes.
+
+One node acts as the coordinator.  It connects to the WebSocket API of each
+follower node, and estimates the offset between its clock and the
+follower's with an NTP-style exchange:
+
+    coordinator                      follower
+       t0  ---- clock_sync ---->        t1 (received)
+       t3  <------- reply ------        t2 (sent)
+
+    offset = ((t1 - t0) + (t2 - t3)) / 2
+    round trip = (t3 - t0) - (t2 - t1)
+
+Of several samples, the one with the shortest round trip is the least
+affected by queuing delays and is kept.
+
+Whenever the coordinator's own timer changes mode, it sends the same command
+to every follower with `start_at` set to the coordinator's pattern start
+translated onto that follower's clock.  Followers that receive it a few
+milliseconds late join the pattern mid-way, so every node's pattern runs
+on the same ticks.
+"""
+
+import asyncio
+import itertools
+import json
+
+import websockets
+import websockets.exceptions
+
+from config import SYNC_INTERVAL, SYNC_SAMPLES
+import log
+from timer.af_timer import Mode
+
+_log = log.get_logger('sync')
+
+# Modes mirrored on followers, and the tone that selects each.  Every other
+# mode turns the followers off.
+_TONES = {
+    Mode.alert() : 'alert',
+    Mode.fire() : 'fire',
+    Mode.attack() : 'attack',
+    Mode.fire_attack() : 'fire_attack',
+}
+
+
+class OffsetEstimate:
+    """ Best estimate of a remote clock's offset from a set of exchanges. """
+
+    def __init__(self):
+        self.offset = None
+        self.round_trip = None
+
+    def add(self, t0, t1, t2, t3):
+        """ Add a sample, keeping it if it has the shortest round trip so far. """
+        round_trip = (t3 - t0) - (t2 - t1)
+        if self.round_trip is None or round_trip < self.round_trip:
+            self.round_trip = round_trip
+            self.offset = ((t1 - t0) + (t2 - t3)) / 2
+        return round_trip
+
+
+class Follower:
+    """ Connection from the coordinator to one follower node. """
+
+    def __init__(self, uri, now):
+        self.uri = uri
+        self.estimate = None
+        self._now = now
+        self._websocket = None
+        self._ids = itertools.count()
+        self._pending = {}
+
+    def __repr__(self):
+        return '<Follower %s>' % self.uri
+
+    @property
+    def synced(self):
+        return self._websocket is not None and self.estimate is not None
+
+    def to_remote(self, local_time):
+        """ Translate a time on the coordinator's clock to the follower's clock. """
+        return local_time + self.estimate.offset
+
+    async def run(self):
+        """ Keep connected and synchronized, reconnecting as needed. """
+        while True:
+            try:
+                async with websockets.connect(self.uri) as websocket:
+                    self._websocket = websocket
+                    reader = asyncio.create_task(self._read(websocket))
+                    try:
+                        while True:
+                            await self.sync()
+                            await asyncio.sleep(SYNC_INTERVAL)
+                    finally:
+                        reader.cancel()
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+                # Including handshakes refused with an HTTP error.
+                _log.warning('Follower unreachable', uri=self.uri, error=e)
+            except Exception as e:
+                # Never let one follower stop coordination with the others.
+                _log.error('Follower connection failed', uri=self.uri, error=repr(e))
+            finally:
+                self._websocket = None
+                for future in self._pending.values():
+                    future.cancel()
+                self._pending.clear()
+            await asyncio.sleep(1)
+
+    async def sync(self, samples=SYNC_SAMPLES):
+        """ Re-estimate the follower's clock offset. """
+        estimate = OffsetEstimate()
+        for _ in range(samples):
+            request_id = next(self._ids)
+            reply = asyncio.get_running_loop().create_future()
+            self._pending[request_id] = reply
+            t0 = self._now()
+            await self._websocket.send(json.dumps({'request': 'clock_sync', 'id': request_id}))
+            message = await asyncio.wait_for(reply, 5)
+            t3 = self._now()
+            estimate.add(t0, message['received'], message['sent'], t3)
+        self.estimate = estimate
+        _log.info('Follower synchronized', uri=self.uri,
+                  offset=estimate.offset, round_trip=estimate.round_trip)
+
+    async def send(self, message):
+        if self._websocket is None:
+            _log.warning('Follower not connected; command not sent', uri=self.uri)
+            return
+        await self._websocket.send(json.dumps(message))
+
+    async def _read(self, websocket):
+        async for data in websocket:
+            message = json.loads(data)
+            if message.get('request') != 'clock_sync':
+                # Broadcast events from the follower; nothing to do with them.
+                continue
+            reply = self._pending.pop(message.get('id'), None)
+            if reply is not None and not reply.done():
+                reply.set_result(message)
+
+
+class Coordinator:
+    """ Mirrors an AF timer's activations onto follower nodes, in phase. """
+
+    def __init__(self, af_timer, uris):
+        self._af_timer = af_timer
+        self.followers = [Follower(uri, af_timer.time) for uri in uris]
+        self._loop = None
+
+    async def run(self):
+        """ Connect to the followers and forward activations until cancelled. """
+        self._loop = asyncio.get_running_loop()
+        self._af_timer.add_activation_handler(self._on_activation)
+        try:
+            await asyncio.gather(*(follower.run() for follower in self.followers))
+        finally:
+            self._af_timer.remove_activation_handler(self._on_activation)
+
+    def _on_activation(self, mode, duration, start):
+        # Called from whichever thread changed the mode.
+        self._loop.call_soon_threadsafe(
+            lambda: asyncio.ensure_future(self._forward(mode, duration, start)))
+
+    async def _forward(self, mode, duration, start):
+        # Any mode that isn't a tone, such as a test or lock-out, stopped the
+        # coordinator's signal, so it stops the followers' too.
+        tone = _TONES.get(mode)
+
+        sends = []
+        for follower in self.followers:
+            if tone is None:
+                message = {'request': 'turn_off'}
+            elif not follower.synced:
+                _log.warning('Follower not synchronized; starting unaligned', uri=follower.uri)
+                message = {'request': 'set_tone', 'tone': tone, 'duration': duration}
+            else:
+                message = {
+                    'request': 'set_tone',
+                    'tone': tone,
+                    'duration': duration,
+                    'start_at': follower.to_remote(start),
+                }
+            sends.append(follower.send(message))
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        for follower, result in zip(self.followers, results):
+            if isinstance(result, Exception):
+                _log.warning('Failed to forward activation', uri=follower.uri, error=result)
@@ -0,0 +1,147 @@
+""" Simulated check of command arbitration between the panel and remote sources.
+
+Runs on virtual time, so hold-offs and rate limits expire exactly when
+they should.  Checks that a button press preempts queued commands and holds
+off new ones, that presses the panel ignores do neither, and that each
+network client is rate limited on its own.  Run from the `src` directory:
+
+    python3 -m test.arbitration
+
+Exits non-zero if any check fails.
+"""
+
+import concurrent.futures
+import sys
+import threading
+
+from config import ARBITER_BURST, ARBITER_HOLD, ARBITER_RATE, COMMAND_COALESCE_WINDOW
+from model.fs3t22a import FS3T22A
+from test.simulation import Simulation
+from timer.af_timer import Button, Mode
+from timer.arbiter import Preempted, RateLimited, Source
+import log
+
+
+class _Client:
+    """ Stands in for a network client; the arbiter only needs to weakly reference it. """
+
+
+class _Checks:
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.af_timer = sim.af_timer
+        self.failures = 0
+
+    def check(self, ok, text):
+        print('%s: %s' % ('OK' if ok else 'FAIL', text))
+        if not ok:
+            self.failures += 1
+
+    def request(self, mode, source, client=None):
+        """ Request `mode` from `source`: a future, or the exception it was refused with. """
+        try:
+            return self.af_timer.request(self.af_timer.change_mode, mode, source=source, client=client)
+        except (Preempted, RateLimited) as e:
+            return e
+
+    def outcome(self, future):
+        """ What became of a request: None if it ran, or the exception it failed with. """
+        if isinstance(future, Exception):
+            return future
+        self.sim.advance(COMMAND_COALESCE_WINDOW)
+        try:
+            future.result(1)
+        except concurrent.futures.TimeoutError:
+            return 'timed out'
+        except (Preempted, RateLimited) as e:
+            return e
+        return None
+
+    def blocked(self):
+        """ Occupy the command thread until the returned event is set, so commands queue. """
+        gate = threading.Event()
+        self.af_timer.submit(gate.wait)
+        return gate
+
+    def settle(self):
+        """ Let every hold-off expire. """
+        self.sim.advance(ARBITER_HOLD)
+
+    def preemption(self):
+        gate = self.blocked()
+        queued = self.request(Mode.attack(), Source.SCHEDULE)
+        self.sim.press(Button.FIRE)
+        gate.set()
+        self.check(isinstance(self.outcome(queued), Preempted),
+                   'a button press preempts a queued schedule command')
+        self.check(self.af_timer.mode() is Mode.fire(), 'the button press took effect')
+
+    def hold_off(self):
+        self.check(isinstance(self.request(Mode.alert(), Source.NETWORK), Preempted),
+                   'a button press holds off network commands')
+        self.sim.advance(ARBITER_HOLD / 2)
+        self.check(isinstance(self.request(Mode.alert(), Source.NETWORK), Preempted),
+                   'the hold-off lasts ARBITER_HOLD')
+        self.sim.advance(ARBITER_HOLD / 2)
+        self.check(self.outcome(self.request(Mode.alert(), Source.NETWORK)) is None,
+                   'network commands run once the hold-off expires')
+        self.check(self.af_timer.mode() is Mode.alert(), 'the network command took effect')
+
+    def ignored_presses(self):
+        self.outcome(self.request(Mode.locked(), Source.CONSOLE))
+        self.settle()
+        gate = self.blocked()
+        queued = self.request(Mode.idle(), Source.SCHEDULE)
+        self.sim.press(Button.FIRE)
+        gate.set()
+        self.check(self.af_timer.mode() is Mode.locked(), 'the panel ignores presses while locked')
+        self.check(self.outcome(queued) is None,
+                   'an ignored press doesn\'t preempt queued commands')
+
+        self.af_timer.lock()
+        self.settle()
+        self.sim.press(Button.FIRE)
+        self.check(self.outcome(self.request(Mode.alert(), Source.NETWORK)) is None,
+                   'an ignored press doesn\'t hold off network commands')
+
+        self.settle()
+        self.sim.hold(Button.ALERT)
+        self.settle()
+        self.sim.release(Button.ALERT)
+        self.check(self.outcome(self.request(Mode.idle(), Source.NETWORK)) is None,
+                   'releasing a button that does nothing doesn\'t hold off network commands')
+
+    def rate_limit(self):
+        flooding, other = _Client(), _Client()
+        requests = [self.request(Mode.idle(), Source.NETWORK, flooding)
+                    for _ in range(ARBITER_BURST + 5)]
+        limited = sum(isinstance(r, RateLimited) for r in requests)
+        self.check(limited == 5, '%d of %d commands over the burst are rate limited' % (limited, 5))
+        self.check(not isinstance(self.request(Mode.idle(), Source.NETWORK, other), RateLimited),
+                   'other clients aren\'t limited by one flooding')
+
+        # Half a token over, so rounding in virtual time can't cost one.
+        self.sim.advance(1 + 0.5 / ARBITER_RATE)
+        requests = [self.request(Mode.idle(), Source.NETWORK, flooding)
+                    for _ in range(ARBITER_RATE + 1)]
+        limited = sum(isinstance(r, RateLimited) for r in requests)
+        self.check(limited == 1, 'a second later, ARBITER_RATE more commands are allowed')
+        self.check(all(self.outcome(r) is None for r in requests if not isinstance(r, Exception)),
+                   'every allowed command completes')
+
+
+def main():
+    log.set_level('ERROR')
+    checks = _Checks(Simulation(FS3T22A))
+    checks.preemption()
+    checks.hold_off()
+    checks.settle()
+    checks.ignored_presses()
+    checks.settle()
+    checks.rate_limit()
+    return 1 if checks.failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
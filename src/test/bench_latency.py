@@ -0,0 +1,254 @@
+""" Control-path latency benchmarks on the fake GPIO backend.
+
+Drives an `AFTimer` through its fake buttons and timestamps each stage of
+the control path:
+
+  - mode_switch: Attack button edge to the motor relay write.
+  - cancel: Cancel button edge to the motor relay being switched off.
+  - broadcast: `change_mode` entry to the WebSocket event being sent.
+
+Each is reported as p50/p99/max in milliseconds, along with the time from
+the button edge to `change_mode` and from `cancel` returning to the relay
+write.  Run from the `src` directory:
+
+    python3 -m test.bench_latency                   # compare to the baseline
+    python3 -m test.bench_latency --update-baseline # record a new baseline
+
+The process exits non-zero if any benchmark's p99 regresses past the stored
+baseline by more than the allowed tolerance, or if there is no baseline to
+compare to.  Baselines are only meaningful on the machine they were
+recorded on, so none is committed; record one before making changes.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+from model.fs3t22a import FS3T22A
+from timer.af_timer import AFTimer, Mode
+import log
+import websocket
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'bench_baseline.json')
+
+# A benchmark regresses if its p99 exceeds the baseline by this factor, and
+# by at least `SLACK_MS`, which keeps scheduler noise on tiny values from
+# tripping the check.
+TOLERANCE = 1.5
+SLACK_MS = 0.5
+
+
+class _Stamps:
+    """ Timestamps of the stages of one control-path traversal. """
+
+    def __init__(self):
+        self.events = {}
+        self.counts = {}
+        self.cond = threading.Condition()
+
+    def reset(self):
+        with self.cond:
+            self.events = {}
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        with self.cond:
+            self.events.setdefault(stage, now)
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+            self.cond.notify_all()
+
+    def wait_for(self, stage, timeout=1.0):
+        with self.cond:
+            if not self.cond.wait_for(lambda: stage in self.events, timeout):
+                raise RuntimeError('Timed out waiting for stage %s' % stage)
+            return self.events[stage]
+
+    def settle(self, stage, other, timeout=1.0):
+        """ Wait until `stage` has been marked as many times as `other`. """
+        with self.cond:
+            if not self.cond.wait_for(
+                    lambda: self.counts.get(stage, 0) == self.counts.get(other, 0), timeout):
+                raise RuntimeError('Timed out waiting for %s to settle' % stage)
+
+
+class _StampedRelay:
+    """ Wraps a fake relay, timestamping writes. """
+
+    def __init__(self, relay, stamps, name):
+        self._relay = relay
+        self._stamps = stamps
+        self._name = name
+
+    def on(self):
+        self._relay.on()
+        self._stamps.mark(self._name + '_on')
+
+    def off(self):
+        self._relay.off()
+        self._stamps.mark(self._name + '_off')
+
+
+class _FakeWebSocket:
+    """ Stands in for a connected client, timestamping sends. """
+
+    def __init__(self, stamps):
+        self._stamps = stamps
+
+    async def send(self, data):
+        self._stamps.mark('event_sent')
+
+    async def close(self):
+        pass
+
+
+def _wrap(stamps, stage, func, after=None):
+    """ Wrap `func` to mark `stage` on entry, and `after` on return. """
+    def wrapper(*args, **kwargs):
+        stamps.mark(stage)
+        result = func(*args, **kwargs)
+        if after is not None:
+            stamps.mark(after)
+        return result
+    return wrapper
+
+
+def _summarize(samples):
+    samples = sorted(samples)
+
+    def percentile(q):
+        return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+    return {
+        'p50': percentile(0.5) * 1000,
+        'p99': percentile(0.99) * 1000,
+        'max': samples[-1] * 1000,
+    }
+
+
+def run(iterations):
+    """ Run the benchmarks, returning `{name: {'p50':, 'p99':, 'max':}}` in ms. """
+    stamps = _Stamps()
+
+    af_timer = AFTimer(FS3T22A)
+    motor = af_timer._siren._motor
+    motor._relay = _StampedRelay(motor._relay, stamps, 'motor')
+    af_timer.change_mode = _wrap(stamps, 'change_mode', af_timer.change_mode)
+    af_timer.cancel = _wrap(stamps, 'cancel', af_timer.cancel, after='cancelled')
+
+    loop = asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+    hub = websocket.BroadcastHub(loop, queue_size=iterations * 4)
+    client = asyncio.run_coroutine_threadsafe(
+        _attach(hub, _FakeWebSocket(stamps)), loop).result()
+    af_timer.add_event_handler(hub.publish)
+    af_timer.add_event_handler(lambda event: stamps.mark('event_published'))
+
+    attack = af_timer._attack_button
+    cancel = af_timer._cancel_button
+    samples = {name: [] for name in (
+        'mode_switch', 'cancel', 'broadcast', 'edge_to_change_mode', 'cancel_to_relay')}
+
+    for i in range(iterations):
+        stamps.reset()
+        edge = time.perf_counter()
+        attack.hold()
+        relay = stamps.wait_for('motor_on')
+        sent = stamps.wait_for('event_sent')
+        attack.release()
+        _wait_until(lambda: af_timer._sampler.state == 0, 'Attack release')
+        samples['mode_switch'].append(relay - edge)
+        samples['edge_to_change_mode'].append(stamps.events['change_mode'] - edge)
+        samples['cancel_to_relay'].append(relay - stamps.events['cancelled'])
+        samples['broadcast'].append(sent - stamps.events['change_mode'])
+
+        stamps.reset()
+        edge = time.perf_counter()
+        cancel.hold()
+        relay = stamps.wait_for('motor_off')
+        cancel.release()
+        samples['cancel'].append(relay - edge)
+        _wait_until(lambda: af_timer.mode() is Mode.idle(), 'Return to idle')
+
+        # Let the events from returning to idle go out before the next round.
+        stamps.settle('event_sent', 'event_published')
+
+    af_timer.remove_event_handler(hub.publish)
+    asyncio.run_coroutine_threadsafe(_detach(hub, client), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    loop_thread.join()
+    loop.close()
+    return {name: _summarize(values) for name, values in samples.items()}
+
+
+def _wait_until(predicate, what, timeout=1.0):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            raise RuntimeError('Timed out waiting for: %s' % what)
+        time.sleep(0.001)
+
+
+async def _attach(hub, ws):
+    return hub.attach(ws)
+
+
+async def _detach(hub, client):
+    hub.detach(client)
+    # Let the sender task process its cancellation.
+    await asyncio.sleep(0)
+
+
+def check(results, baseline):
+    """ Returns a list of descriptions of benchmarks that regressed. """
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        limit = max(baseline[name]['p99'] * TOLERANCE, baseline[name]['p99'] + SLACK_MS)
+        if stats['p99'] > limit:
+            regressions.append('%s: p99 %.3fms exceeds limit %.3fms (baseline %.3fms)' % (
+                name, stats['p99'], limit, baseline[name]['p99']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AF timer control-path latency benchmarks.')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='Baseline file to compare to')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='Record the results as the new baseline')
+    args = parser.parse_args()
+
+    # The timer logs every transition; keep that out of the report.
+    log.set_level('ERROR')
+    results = run(args.iterations)
+
+    print('%-20s %10s %10s %10s' % ('benchmark (ms)', 'p50', 'p99', 'max'))
+    for name, stats in results.items():
+        print('%-20s %10.3f %10.3f %10.3f' % (name, stats['p50'], stats['p99'], stats['max']))
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Baseline written to %s' % args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline at %s; run with --update-baseline to record one.' % args.baseline)
+        return 1
+
+    with open(args.baseline) as f:
+        regressions = check(results, json.load(f))
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
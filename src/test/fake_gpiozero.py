@@ -1,15 +1,19 @@
 """ Fake class implementing the gpiozero functions used. """
 print("Using fake gpiozero")
 
+from array import array
+
+
 class Pin:
-    def __init__(self):
+    def __init__(self, number=None):
+        self.number = number
         self.bounce = None
 
 
 class LED:
     def __init__(self, gpio):
         self.gpio = gpio
-        self.pin = Pin()
+        self.pin = Pin(gpio)
         self._on = False
         
     def __repr__(self):
@@ -18,17 +22,83 @@ class LED:
             self._on and 'on' or 'off'
         )
 
+    @property
+    def is_lit(self):
+        return self._on
+
     def on(self):
         self._on = True
 
     def off(self):
         self._on = False
 
+    def blink(self, on_time=1, off_time=1):
+        self._on = True
+
+
+class Trace:
+    """ Timestamped record of output transitions, kept in flat arrays. """
+
+    def __init__(self, clock):
+        self._clock = clock
+        self.times = array('d')
+        self.gpios = array('B')
+        self.states = array('B')
+
+    def __len__(self):
+        return len(self.times)
+
+    def record(self, gpio, state):
+        self.times.append(self._clock.monotonic())
+        self.gpios.append(gpio)
+        self.states.append(state)
+
+    def transitions(self, gpio=None):
+        """ Returns `(time, gpio, state)` for every recorded write, optionally for one GPIO.
+
+        Writes that don't change the output's state are left out.
+        """
+        last = {}
+        result = []
+        for t, g, state in zip(self.times, self.gpios, self.states):
+            if last.get(g) == state:
+                continue
+            last[g] = state
+            if gpio is None or g == gpio:
+                result.append((t, g, bool(state)))
+        return result
+
+    def clear(self):
+        del self.times[:]
+        del self.gpios[:]
+        del self.states[:]
+
+
+class RecordingLED(LED):
+    """ A fake LED that records every write to a `Trace`. """
+
+    def __init__(self, gpio, trace):
+        self._trace = trace
+        super().__init__(gpio)
+
+    def on(self):
+        super().on()
+        self._trace.record(self.gpio, 1)
+
+    def off(self):
+        super().off()
+        self._trace.record(self.gpio, 0)
+
+    def blink(self, on_time=1, off_time=1):
+        super().blink(on_time, off_time)
+        self._trace.record(self.gpio, 1)
+
 
 class Button:
     def __init__(self, gpio):
         self.gpio = gpio
-        self.pin = Pin()
+        self.pin = Pin(gpio)
+        self.is_pressed = False
 
         self.when_pressed = None
         self.when_released = None
@@ -38,9 +108,11 @@ class Button:
         self.release()
 
     def hold(self):
+        self.is_pressed = True
         if self.when_pressed is not None:
             self.when_pressed()
 
     def release(self):
+        self.is_pressed = False
         if self.when_released is not None:
             self.when_released()
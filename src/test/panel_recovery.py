@@ -0,0 +1,52 @@
+""" Simulated check that the panel keeps responding after a handler fails.
+
+An activation handler raises on the first change the panel makes; the
+panel must still act on the buttons pressed after it.  Run from the `src`
+directory:
+
+    python3 -m test.panel_recovery
+
+Exits non-zero if the panel stops responding.
+"""
+
+import sys
+
+from model.fs3t22a import FS3T22A
+from test.simulation import Simulation
+from timer.af_timer import Button, Mode
+import log
+
+
+def main():
+    log.set_level('ERROR')
+    sim = Simulation(FS3T22A)
+    af_timer = sim.af_timer
+    failures = []
+
+    def handler(mode, duration, start):
+        if not failures:
+            failures.append(mode)
+            raise RuntimeError('Handler failed on %s' % mode.name)
+    af_timer.add_activation_handler(handler)
+
+    sim.press(Button.ALERT)
+    if not failures or af_timer.mode() is not Mode.alert():
+        print('FAIL: alert press not handled (mode %s)' % af_timer.mode().name)
+        return 1
+
+    sim.press(Button.CANCEL)
+    if af_timer.mode() is not Mode.idle():
+        print('FAIL: cancel ignored after a handler raised (mode %s)' % af_timer.mode().name)
+        return 1
+
+    sim.press(Button.FIRE)
+    if af_timer.mode() is not Mode.fire():
+        print('FAIL: fire ignored after a handler raised (mode %s)' % af_timer.mode().name)
+        return 1
+
+    print('OK: panel responded after a handler raised')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
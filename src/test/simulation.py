@@ -0,0 +1,51 @@
+""" Accelerated simulation of an AF timer on virtual time. """
+
+import functools
+
+from siren import VirtualClock
+from test.fake_gpiozero import RecordingLED, Trace
+from timer.af_timer import AFTimer
+
+
+class Simulation:
+    """ An `AFTimer` on a virtual clock, with every output write traced.
+
+    Nothing happens until the simulation is advanced, at which point every
+    pattern step and watchdog runs at exactly its deadline:
+
+        sim = Simulation(FS3T22A)
+        sim.press(Button.ATTACK)
+        sim.hold(Button.FIRE, Button.ATTACK)  # A chord
+        sim.advance(180)
+        sim.trace.transitions(MOTOR_GPIO)
+    """
+
+    def __init__(self, siren_cls, start=0.0):
+        self.clock = VirtualClock(start)
+        self.trace = Trace(self.clock)
+        self.af_timer = AFTimer(
+            siren_cls,
+            clock=self.clock,
+            led_factory=functools.partial(RecordingLED, trace=self.trace))
+
+    def now(self):
+        return self.clock.monotonic()
+
+    def advance(self, seconds=0):
+        """ Let `seconds` of virtual time pass. """
+        self.af_timer._scheduler.advance(seconds)
+
+    def hold(self, *buttons):
+        """ Hold down `buttons` together, and wait for the panel to act on them. """
+        for button in buttons:
+            self.af_timer._button_mapping[button].hold()
+        self.advance(self.af_timer._sampler.latency)
+
+    def release(self, *buttons):
+        for button in buttons:
+            self.af_timer._button_mapping[button].release()
+        self.advance(self.af_timer._sampler.latency)
+
+    def press(self, *buttons):
+        self.hold(*buttons)
+        self.release(*buttons)
@@ -0,0 +1,124 @@
+""" Multi-process check of clock-synchronized activation over loopback.
+
+Starts several follower nodes as separate processes, each on a clock skewed
+by a different amount, and coordinates them from this process.  After an
+attack signal, every node's motor transitions are converted back to the
+shared system clock and compared.  Run from the `src` directory:
+
+    python3 -m test.sync_loopback --followers 3
+
+Exits non-zero if any follower's transitions are further out of phase with
+the coordinator's than the tolerance.
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import subprocess
+import sys
+import time
+
+from config import MOTOR_GPIO
+from model.fs3t22a import FS3T22A
+from siren import Clock
+from test.fake_gpiozero import RecordingLED, Trace
+from timer.af_timer import AFTimer, Mode
+import log
+import sync
+import websocket
+
+BASE_PORT = 12360
+TRACE_MARKER = 'TRACE '
+
+
+class SkewedClock(Clock):
+    """ The system clock, offset by `skew` seconds. """
+
+    def __init__(self, skew):
+        self.skew = skew
+
+    def monotonic(self):
+        return time.monotonic() + self.skew
+
+
+def _make_timer(clock):
+    trace = Trace(clock)
+    af_timer = AFTimer(
+        FS3T22A, clock=clock, led_factory=functools.partial(RecordingLED, trace=trace))
+    return af_timer, trace
+
+
+def _motor_edges(trace, skew):
+    """ Motor transitions after start-up, on the unskewed system clock. """
+    return [t - skew for t, _, on in trace.transitions(MOTOR_GPIO)[1:]]
+
+
+async def follower(port, skew, run_for):
+    clock = SkewedClock(skew)
+    af_timer, trace = _make_timer(clock)
+    try:
+        await asyncio.wait_for(websocket.run_websocket(af_timer, port), run_for)
+    except asyncio.TimeoutError:
+        pass
+    print(TRACE_MARKER + json.dumps(_motor_edges(trace, skew)), flush=True)
+
+
+async def coordinator(count, signal_for, tolerance):
+    clock = SkewedClock(0)
+    af_timer, trace = _make_timer(clock)
+    run_for = signal_for + 10
+    processes = [
+        subprocess.Popen(
+            [sys.executable, '-m', 'test.sync_loopback',
+             '--follow', str(BASE_PORT + i), '--skew', str(100 * (i + 1) + 0.123),
+             '--run_for', str(run_for)],
+            stdout=subprocess.PIPE, text=True)
+        for i in range(count)]
+
+    coord = sync.Coordinator(af_timer, ['ws://127.0.0.1:%d' % (BASE_PORT + i) for i in range(count)])
+    task = asyncio.create_task(coord.run())
+    while not all(f.synced for f in coord.followers):
+        await asyncio.sleep(0.1)
+
+    af_timer.change_mode(Mode.attack(), signal_for)
+    await asyncio.sleep(signal_for + 1)
+    task.cancel()
+
+    expected = _motor_edges(trace, 0)
+    worst = 0.0
+    for process, f in zip(processes, coord.followers):
+        output, _ = await asyncio.get_running_loop().run_in_executor(None, process.communicate)
+        lines = [l for l in output.splitlines() if l.startswith(TRACE_MARKER)]
+        edges = json.loads(lines[-1][len(TRACE_MARKER):]) if lines else []
+        # The first edge may be late while the follower catches up; the rest
+        # must land on the coordinator's ticks.
+        errors = [abs(a - b) for a, b in zip(edges[1:], expected[1:])]
+        error = max(errors) if errors else float('inf')
+        worst = max(worst, error)
+        print('%s: offset %.6fs, round trip %.3fms, %d edges, max phase error %.3fms' % (
+            f.uri, f.estimate.offset, f.estimate.round_trip * 1000, len(edges), error * 1000))
+
+    print('Worst phase error: %.3fms (tolerance %.3fms)' % (worst * 1000, tolerance * 1000))
+    return 0 if worst <= tolerance else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loopback multi-node synchronization check.')
+    parser.add_argument('--followers', type=int, default=3)
+    parser.add_argument('--signal_for', type=float, default=17)
+    parser.add_argument('--tolerance', type=float, default=0.01, help='Seconds')
+    parser.add_argument('--follow', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--skew', type=float, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--run_for', type=float, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    log.set_level('error')
+    if args.follow:
+        asyncio.run(follower(args.follow, args.skew, args.run_for))
+        return 0
+    return asyncio.run(coordinator(args.followers, args.signal_for, args.tolerance))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
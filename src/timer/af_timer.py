@@ -5,10 +5,28 @@ try:
 except:
     from test.fake_gpiozero import LED, Button as GPIOButton
 from config import *
+from siren import Scheduler, SirenGroup, Watchdog
+from timer.arbiter import Arbiter, Source
+from timer.coalescer import Coalescer
+from timer.executor import CommandExecutor
+from timer.sampler import InputSampler
+from timer.state import StateModel
+from timer.telemetry import Telemetry
+from timer import snapshot
 import functools
-import threading
+import journal
+import log
+import metrics
+
+_log = log.get_logger('af_timer')
 
 class Mode:
+    """ AF timer operating mode.
+
+    Modes are interned: `Mode(Mode.FIRE)` and `Mode.fire()` always return the
+    same object, so modes can be compared by identity and used as dictionary
+    keys without allocating on the hot path.
+    """
     IDLE = 0
     TEST = 1
     ALERT = 2
@@ -18,56 +36,98 @@ class Mode:
     OFF_TEST = 6
     LOCKED = 7
 
-    def __init__(self, mode):
-        self._mode = mode
+    _NAMES = {
+        IDLE : 'IDLE',
+        TEST : 'TEST',
+        ALERT : 'ALERT',
+        FIRE : 'FIRE',
+        ATTACK : 'ATTACK',
+        FIRE_ATTACK : 'FIRE_ATTACK',
+        LOCKED : 'LOCKED',
+        OFF_TEST : 'OFF_TEST'
+    }
+    _interned = {}
+
+    def __new__(cls, mode):
+        try:
+            return cls._interned[mode]
+        except KeyError:
+            pass
+        if mode not in cls._NAMES:
+            raise ValueError('Invalid mode: %r' % mode)
+        instance = super().__new__(cls)
+        instance._mode = mode
+        cls._interned[mode] = instance
+        return instance
 
     def __repr__(self):
-        mapping = {
-            self.IDLE : 'IDLE',
-            self.TEST : 'TEST',
-            self.ALERT : 'ALERT',
-            self.FIRE : 'FIRE',
-            self.ATTACK : 'ATTACK',
-            self.FIRE_ATTACK : 'FIRE_ATTACK',
-            self.LOCKED : 'LOCKED',
-            self.OFF_TEST : 'OFF_TEST'
-        }
-        return '<Mode "%s">' % mapping[self._mode]
+        return '<Mode "%s">' % self._NAMES[self._mode]
+
+    @property
+    def name(self):
+        return self._NAMES[self._mode]
+
+    @property
+    def value(self):
+        return self._mode
 
     def __eq__(self, o):
-        return isinstance(o, self.__class__) and self._mode == o._mode
+        return self is o or (isinstance(o, self.__class__) and self._mode == o._mode)
+
+    def __hash__(self):
+        return self._mode
+
+    def __reduce__(self):
+        return (Mode, (self._mode,))
+
+    @classmethod
+    def all(cls):
+        """ Returns every mode, in numeric order. """
+        return [cls(mode) for mode in sorted(cls._NAMES)]
+
+    @classmethod
+    def from_name(cls, name):
+        """ Returns the mode called `name`, such as 'FIRE'. """
+        for mode, mode_name in cls._NAMES.items():
+            if mode_name == name:
+                return cls(mode)
+        raise ValueError('Invalid mode: %r' % name)
 
     @classmethod
     def idle(cls):
-        return Mode(cls.IDLE)
+        return cls._interned[cls.IDLE]
 
     @classmethod
     def test(cls):
-        return Mode(cls.TEST)
+        return cls._interned[cls.TEST]
 
     @classmethod
     def alert(cls):
-        return Mode(cls.ALERT)
+        return cls._interned[cls.ALERT]
 
     @classmethod
     def fire(cls):
-        return Mode(cls.FIRE)
+        return cls._interned[cls.FIRE]
 
     @classmethod
     def attack(cls):
-        return Mode(cls.ATTACK)
+        return cls._interned[cls.ATTACK]
 
     @classmethod
     def fire_attack(cls):
-        return Mode(cls.FIRE_ATTACK)
+        return cls._interned[cls.FIRE_ATTACK]
 
     @classmethod
     def off_test(cls):
-        return Mode(cls.OFF_TEST)
+        return cls._interned[cls.OFF_TEST]
 
     @classmethod
     def locked(cls):
-        return Mode(cls.LOCKED)
+        return cls._interned[cls.LOCKED]
+
+
+# Populate the interned instances up front so the accessors above never allocate.
+Mode.all()
 
 
 class Button:
@@ -77,55 +137,250 @@ class Button:
     ATTACK = 3
     CANCEL = 4
 
+    ALL = (TEST, ALERT, FIRE, ATTACK, CANCEL)
+
+    @staticmethod
+    def bit(button):
+        """ Returns the bit representing `button` in a pressed-button bitmask. """
+        return 1 << button
+
+
+class Edge:
+    """ Button edges, encoded as the button index with the low bit set on release. """
+
+    @staticmethod
+    def press(button):
+        return button << 1
+
+    @staticmethod
+    def release(button):
+        return (button << 1) | 1
+
+    @staticmethod
+    def button(edge):
+        return edge >> 1
+
+    @staticmethod
+    def is_press(edge):
+        return not edge & 1
+
+
+# Transition actions.  Each entry in the transition table is a tuple of one of
+# these and its argument.
+_SET_MODE = 0
+_DAMPER_LOW = 1
+_DAMPER_HIGH = 2
+
+
+def _resolve_press(mode, pressed, button):
+    """ Panel logic for a button press.
+
+    `pressed` is the bitmask of buttons held down, including `button`.  The
+    combinations are as follows:
+
+     - Test: When pressed, activate siren test.  Turns off when released.
+     - Alert: When pressed, activate siren alert mode.  Remains on when released.
+     - Fire: When pressed, activate siren fire mode.  Remains on when released.
+     - Attack: When pressed, activate siren attack mode.  Remains on when released.
+     - Test + Alert: When pressed, activate siren test, and actuate low damper.
+           Damper opens when Alert released; siren turns off when Test released.
+     - Test + Fire: When pressed, activate siren test, and actuate high damper.
+           Damper opens when Fire released; siren turns off when Test released.
+     - Alert + Fire: When pressed, activate fire alert mode.  Remains on when released.
+     - Cancel: Turn off all remain-on modes and move to idle.
+    """
+    if mode is Mode.locked():
+        # The buttons don't work when locked.
+        return None
+
+    def held(b):
+        return bool(pressed & Button.bit(b))
+
+    if (mode is Mode.test() and held(Button.TEST)) or (
+            mode is Mode.off_test() and held(Button.CANCEL)):
+        # Two additional buttons are allowed, and don't change modes, but do change what
+        # the siren does.
+        if button == Button.ALERT:
+            return (_DAMPER_LOW, True)
+        elif button == Button.FIRE:
+            return (_DAMPER_HIGH, True)
+        return None
+
+    elif mode is Mode.attack() and held(Button.ATTACK):
+        if button == Button.FIRE:
+            return (_SET_MODE, Mode.fire_attack())
+        return None
+
+    elif mode is Mode.fire() and held(Button.FIRE):
+        if button == Button.ATTACK:
+            return (_SET_MODE, Mode.fire_attack())
+        return None
+
+    elif mode is Mode.alert() and held(Button.ALERT):
+        return None
+    elif mode is Mode.fire_attack() and held(Button.FIRE) and held(Button.ATTACK):
+        return None
+
+    # From here, we got a single button push, meaning there's a first-level mode switch.
+    return (_SET_MODE, {
+        Button.TEST : Mode.test(),
+        Button.ALERT : Mode.alert(),
+        Button.FIRE : Mode.fire(),
+        Button.ATTACK : Mode.attack(),
+        Button.CANCEL : Mode.off_test(),
+    }[button])
+
+
+def _resolve_release(mode, pressed, button):
+    """ Panel logic for a button release.
+
+    `pressed` is the bitmask of buttons still held down, excluding `button`.
+    """
+    if mode is Mode.locked():
+        return None
+
+    if button == Button.CANCEL and pressed == 0:
+        # The cancel button was just released, and now no buttons are pressed.
+        return (_SET_MODE, Mode.idle())
+
+    if mode is Mode.test() and button == Button.TEST:
+        return (_SET_MODE, Mode.idle())
+    elif mode is Mode.test() or (
+            mode is Mode.off_test() and pressed & Button.bit(Button.CANCEL)):
+        if button == Button.ALERT:
+            return (_DAMPER_LOW, False)
+        elif button == Button.FIRE:
+            return (_DAMPER_HIGH, False)
+    elif button == Button.CANCEL:
+        return (_SET_MODE, Mode.idle())
+    return None
+
+
+def _compile_transitions():
+    """ Builds the panel transition table.
+
+    The table is keyed by `(mode, pressed-button bitmask, edge)`, where the
+    bitmask reflects the buttons held after the edge is applied.  Combinations
+    with no effect are left out, so a missing key means "do nothing".
+    """
+    table = {}
+    for mode in Mode.all():
+        for button in Button.ALL:
+            bit = Button.bit(button)
+            for pressed in range(1 << len(Button.ALL)):
+                if pressed & bit:
+                    key = (mode, pressed, Edge.press(button))
+                    action = _resolve_press(mode, pressed, button)
+                else:
+                    key = (mode, pressed, Edge.release(button))
+                    action = _resolve_release(mode, pressed, button)
+                if action is not None:
+                    table[key] = action
+    return table
+
+
+_TRANSITIONS = _compile_transitions()
+
+# Memoized `_chord_actions`, keyed the same way.
+_CHORDS = {}
+
+
+def _chord_actions(mode, previous, pressed):
+    """ The actions for the buttons held changing from `previous` to `pressed`.
+
+    The change is split into single-button edges, releases first and then
+    presses, each in button order, so simultaneous changes always resolve
+    the same way.  Consecutive mode changes collapse into the last: pressing
+    Fire + Attack together goes straight to fire attack.
+    """
+    key = (mode, previous, pressed)
+    actions = _CHORDS.get(key)
+    if actions is not None:
+        return actions
+
+    changed = previous ^ pressed
+    edges = [Edge.release(b) for b in Button.ALL if changed & previous & Button.bit(b)]
+    edges += [Edge.press(b) for b in Button.ALL if changed & pressed & Button.bit(b)]
+
+    actions = []
+    held = previous
+    for edge in edges:
+        held ^= Button.bit(Edge.button(edge))
+        action = _TRANSITIONS.get((mode, held, edge))
+        if action is None:
+            continue
+        if action[0] == _SET_MODE:
+            mode = action[1]
+            if actions and actions[-1][0] == _SET_MODE:
+                actions.pop()
+        actions.append(action)
+
+    actions = _CHORDS[key] = tuple(actions)
+    return actions
+
+_CHANGE_MODE = metrics.histogram('change_mode')
+_PLAY_START = metrics.histogram('play.start')
+_CANCEL = metrics.histogram('cancel')
+_CANCEL_PLAYBACK = metrics.histogram('cancel.playback')
+_EMIT_EVENT = metrics.histogram('emit_event')
+_MODE_CHANGES = metrics.counter('mode_changes')
+_RESUMED = metrics.counter('resumed')
+
+
+class _ObservedRelay:
+    """ Wraps a siren's output device, reporting its writes to the state model. """
+
+    def __init__(self, device, key, state):
+        self._device = device
+        self._key = key
+        self._state = state
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+    def on(self):
+        self._device.on()
+        self._state.update({self._key: True})
+
+    def off(self):
+        self._device.off()
+        self._state.update({self._key: False})
+
+# Modes that are picked up again after a restart.  Tests only last while
+# their button is held, so they aren't.
+_RESUMABLE = frozenset([
+    Mode.alert(), Mode.fire(), Mode.attack(), Mode.fire_attack(), Mode.locked()])
+_BUTTON_CHANGES = metrics.counter('button_changes')
+
 
 class AFTimer:
-    def __init__(self, siren_cls):
+    def __init__(self, siren_cls, clock=None, led_factory=LED, button_factory=GPIOButton,
+                 sirens=SIRENS, state_file=None):
+        """ Set up the panel and the sirens it drives.
+
+        Args:
+          siren_cls: The `Siren` implementation to drive.
+          clock: Optional `Clock` to time everything against.  Defaults to the
+                 system clock; pass a `VirtualClock` to simulate.
+          led_factory: Callable creating an output device for a GPIO number.
+          button_factory: Callable creating an input button for a GPIO number.
+          sirens: The (motor, high solenoid, low solenoid) GPIOs of each
+                  siren.  Several sirens are driven in phase as a group.
+          state_file: Optional file to snapshot the timer's state to on
+                      every transition, for `resume` after a restart.
+        """
         self._mode = Mode.idle()
         self._handlers = set()
+        self._activation_handlers = set()
 
-        self._led_alarm = LED(ALERT_LED_GPIO)
-        self._led_ready = LED(READY_LED_GPIO)
-
-        self._test_button = GPIOButton(TEST_BUTTON_GPIO)
-        self._test_button.pin.bounce = 0.05
-        self._test_button.when_pressed = functools.partial(self._button_pressed, Button.TEST)
-        self._test_button.when_released = functools.partial(self._button_released, Button.TEST)
-
-        self._alert_button = GPIOButton(ALERT_BUTTON_GPIO)
-        self._alert_button.pin.bounce = 0.05
-        self._alert_button.when_pressed = functools.partial(self._button_pressed, Button.ALERT)
-        self._alert_button.when_released = functools.partial(self._button_released, Button.ALERT)
-
-        self._fire_button = GPIOButton(FIRE_BUTTON_GPIO)
-        self._fire_button.pin.bounce = 0.05
-        self._fire_button.when_pressed = functools.partial(self._button_pressed, Button.FIRE)
-        self._fire_button.when_released = functools.partial(self._button_released, Button.FIRE)
+        self._led_alarm = led_factory(ALERT_LED_GPIO)
+        self._led_ready = led_factory(READY_LED_GPIO)
 
-        self._attack_button = GPIOButton(ATTACK_BUTTON_GPIO)
-        self._attack_button.pin.bounce = 0.05
-        self._attack_button.when_pressed = functools.partial(self._button_pressed, Button.ATTACK)
-        self._attack_button.when_released = functools.partial(self._button_released, Button.ATTACK)
-
-        self._cancel_button = GPIOButton(CANCEL_BUTTON_GPIO)
-        self._cancel_button.pin.bounce = 0.05
-        self._cancel_button.when_pressed = functools.partial(self._button_pressed, Button.CANCEL)
-        self._cancel_button.when_released = functools.partial(self._button_released, Button.CANCEL)
-
-        self._thread = None
-        self._cancel_lock = threading.Lock()
-        self._cancel_cond = threading.Condition(self._cancel_lock)
-
-        self._button_push_lock = threading.Lock()
-
-        self._siren = siren_cls(
-                MOTOR_GPIO,
-                HIGH_SOLENOID_GPIO,
-                LOW_SOLENOID_GPIO,
-                self._cancel_lock,
-                self._cancel_cond)
-
-        self._led_ready.on()
-        self._led_alarm.off()
+        self._test_button = button_factory(TEST_BUTTON_GPIO)
+        self._alert_button = button_factory(ALERT_BUTTON_GPIO)
+        self._fire_button = button_factory(FIRE_BUTTON_GPIO)
+        self._attack_button = button_factory(ATTACK_BUTTON_GPIO)
+        self._cancel_button = button_factory(CANCEL_BUTTON_GPIO)
 
         self._button_mapping = {
             Button.TEST : self._test_button,
@@ -135,170 +390,299 @@ class AFTimer:
             Button.CANCEL : self._cancel_button,
         }
 
-        print('AF timer configured with siren %s' % self._siren)
-        print('Panel ready.')
-
-    def _get_buttons_pushed(self):
-        """ Returns a set containing the button that are currently pressed. """
-        buttons_pushed = set()
-        buttons = []
-        for button, obj in self._button_mapping.items():
-            if obj.is_pressed:
-                buttons_pushed.add(button)
-
-        return buttons_pushed
-
-    def _button_released(self, button):
-        with self._button_push_lock:
-            if self._mode == Mode.locked():
-                return
-
-            pressed = self._get_buttons_pushed()
-            if button == Button.CANCEL and len(pressed) == 0:
-                # The cancel button was just released, and now no buttons are pressed.
-                self.change_mode(Mode.idle())
-                return
+        self._scheduler = Scheduler(clock)
+        self._scheduler.start()
+        self._state = StateModel(self.time, STATE_HISTORY)
+        self._watchdog = Watchdog(self._scheduler)
+        self._playback = None
+        self._dampers = {'high': False, 'low': False}
+        self._snapshots = snapshot.SnapshotWriter(state_file) if state_file else None
+
+        self._executor = CommandExecutor(COMMAND_QUEUE_SIZE)
+        self._executor.start()
+        self._coalescer = Coalescer(self._executor, self._scheduler, COMMAND_COALESCE_WINDOW)
+        self._arbiter = Arbiter(
+            self._executor, self._coalescer, self.time, ARBITER_HOLD, ARBITER_RATE, ARBITER_BURST)
+
+        self._relays = {}
+        members = [
+            siren_cls(
+                motor_gpio,
+                high_gpio,
+                low_gpio,
+                self._scheduler,
+                self._watchdog,
+                led_factory=self._relay_factory(led_factory))
+            for motor_gpio, high_gpio, low_gpio in sirens]
+        if len(members) == 1:
+            self._siren = members[0]
+        else:
+            self._siren = SirenGroup(members, self._scheduler)
 
-            if self._mode == Mode.test() and button == Button.TEST:
-                self.change_mode(Mode.idle())
-            elif self._mode == Mode.test() or (
-                    self._mode == Mode.off_test() and Button.CANCEL in pressed):
-                if button == Button.ALERT:
-                    self._siren._set_damper_low(False)
-                elif button == Button.FIRE:
-                    self._siren._set_damper_high(False)
-            elif button == Button.CANCEL:
-                self.change_mode(Mode.idle())
-
-    def _button_pressed(self, button):
-        """ Called whenever a button push event is called.
-
-        This can be called from multiple threads, and so needs to be thread-safe.
+        self._led_ready.on()
+        self._led_alarm.off()
+        self._publish_state()
+
+        # All buttons are sampled together, so chords arrive as one change.
+        self._sampler = InputSampler(
+            self._scheduler,
+            {Button.bit(b): device for b, device in self._button_mapping.items()},
+            self._buttons_changed,
+            BUTTON_SAMPLE_INTERVAL,
+            BUTTON_DEBOUNCE)
+        for device in self._button_mapping.values():
+            device.when_pressed = self._sampler.wake
+            device.when_released = self._sampler.wake
+
+        # Siren n's relays are bits 3n to 3n+2 of the telemetry relay mask.
+        self._relay_bits = [
+            (1 << (3 * n + i), self._relays[gpio])
+            for n, gpios in enumerate(sirens)
+            for i, gpio in enumerate(gpios)
+            if gpio in self._relays]
+        self._telemetry = Telemetry(
+            self._scheduler, self._read_telemetry, TELEMETRY_INTERVAL, TELEMETRY_CAPACITY,
+            3 * len(sirens))
+
+        _log.info('AF timer configured', siren=self._siren)
+        _log.info('Panel ready')
+
+    def _buttons_changed(self, previous, pressed):
+        """ Called on the scheduler thread when the debounced buttons change.
+
+        `previous` and `pressed` are bitmasks of the buttons held before and
+        after.  Several buttons may have changed at once.
         """
-        # Take the lock so we ensure we're only processing one mode change at a time.
-        with self._button_push_lock:
-            # Figure out what combination of buttons is pushed, and switch to the appropriate mode.
-            #
-            # The combinations are as follows:
-            #
-            #  - Test: When pressed, activate siren test.  Turns off when released.
-            #  - Alert: When pressed, activate siren alert mode.  Remains on when released.
-            #  - Fire: When pressed, activate siren fire mode.  Remains on when released.
-            #  - Attack: When pressed, activate siren attack mode.  Remains on when released.
-            #  - Test + Alert: When pressed, activate siren test, and actuate low damper.
-            #        Damper opens when Alert released; siren turns off when Test released.
-            #  - Test + Fire: When pressed, activate siren test, and actuate high damper.
-            #        Damper opens when Fire released; siren turns off when Test released.
-            #  - Alert + Fire: When pressed, activate fire alert mode.  Remains on when released.
-            #  - Cancel: Turn off all remain-on modes and move to idle.
-            if self._mode == Mode.locked():
-                # The buttons don't work when locked.
+        _BUTTON_CHANGES.inc()
+        with self._arbiter.locked(Source.PANEL):
+            actions = _chord_actions(self._mode, previous, pressed)
+            if not actions:
+                # Releases and ignored presses mustn't hold anyone off.
                 return
-
-            pressed = self._get_buttons_pushed()
-            if (self._mode == Mode.test() and Button.TEST in pressed) or (
-                    self._mode == Mode.off_test() and Button.CANCEL in pressed):
-                # Two additional buttons are allowed, and don't change modes, but do change what
-                # the siren does.
-                if button == Button.ALERT:
-                    self._siren._set_damper_low(True)
-                elif button == Button.FIRE:
-                    self._siren._set_damper_high(True)
-
-            elif self._mode == Mode.attack() and Button.ATTACK in pressed:
-                if button == Button.FIRE:
-                    self.change_mode(Mode.fire_attack())
-
-            elif self._mode == Mode.fire() and Button.FIRE in pressed:
-                if button == Button.ATTACK:
-                    self.change_mode(Mode.fire_attack())
-
-            elif self._mode == Mode.alert() and Button.ALERT in pressed:
-                pass
-            elif self._mode == Mode.fire_attack() and Button.FIRE in pressed and Button.ATTACK in pressed:
-                pass
-            else:
-                # From here, we got a single button push, meaning there's a first-level mode switch.
-                if button == Button.TEST:
-                    self.change_mode(Mode.test())
-                elif button == Button.ALERT:
-                    self.change_mode(Mode.alert())
-                elif button == Button.FIRE:
-                    self.change_mode(Mode.fire())
-                elif button == Button.ATTACK:
-                    self.change_mode(Mode.attack())
-                elif button == Button.CANCEL:
-                    self.change_mode(Mode.off_test())
-
-    def _run_in_thread(self, callable, duration=None):
+            self._arbiter.act(Source.PANEL)
+            for kind, arg in actions:
+                if kind == _SET_MODE:
+                    self.change_mode(arg)
+                elif kind == _DAMPER_LOW:
+                    self.set_damper('low', arg)
+                else:
+                    self.set_damper('high', arg)
+
+    def _play(self, callable, mode, duration=None, start_at=None):
+        """ Start the siren pattern returned by `callable` and enter `mode`.
+
+        The pattern runs on the shared scheduler, so this returns as soon as
+        the first step is armed.  See `change_mode` for `start_at`.
+        """
         self.cancel()
 
-        def wrapper():
+        with metrics.Span(_PLAY_START):
+            playback = callable(duration)
+            if playback is None:
+                _log.warning('Siren has no function for mode', siren=self._siren, mode=mode)
+                return
+
+            _log.debug('Playing', playback=playback)
             self._led_alarm.on()
-            callable(duration)
+            self._playback = playback
+            self._mode = mode
+            playback.start(on_finish=self._playback_finished, start=start_at)
+
+    def _playback_finished(self, playback):
+        """ Called on the scheduler thread when a pattern plays its full duration. """
+        with self._arbiter.lock:
+            if self._playback is not playback:
+                return
+            self._playback = None
             self._led_alarm.off()
-            self._thread = None
             self.change_mode(Mode.idle())
 
-        print("Run in thread: %s", callable.__repr__())
-        self._thread = threading.Thread(target=wrapper)
-        self._thread.start()
-
-    def change_mode(self, mode: Mode, duration=None):
-        """ Change to the specified mode, actuating the siren accordingly. """
-        print(f"Change mode: {mode} from {self._mode} (duration: {duration})")
-        if mode == Mode.idle():
-            self.cancel()
-        elif mode == Mode.off_test():
-            self.cancel(Mode.off_test())
-        elif mode == Mode.alert():
-            self.alert(duration)
-        elif mode == Mode.fire():
-            self.fire(duration)
-        elif mode == Mode.fire_attack():
-            self.fire_attack(duration)
-        elif mode == Mode.attack():
-            self.attack(duration)
-        elif mode == Mode.test():
-            self.test()
-        elif mode == Mode.locked():
-            self.lock()
-        else:
-            print("Invalid mode: ", mode)
-        print("Mode now ", self._mode)
-        self._emit_mode_change_event(self._mode)
+    def change_mode(self, mode: Mode, duration=None, start_at=None):
+        """ Change to the specified mode, actuating the siren accordingly.
+
+        Args:
+          mode: The mode to change to.
+          duration: Optional time in seconds to signal for.
+          start_at: Optional time, on this timer's clock (see `time()`), that
+                    the signal's pattern starts at.  If it's in the past, the
+                    pattern joins mid-way, in phase with that start time.
+        """
+        _MODE_CHANGES.inc()
+        with metrics.Span(_CHANGE_MODE):
+            _log.info('Change mode', mode=mode, previous=self._mode, duration=duration)
+            if mode == Mode.idle():
+                self.cancel()
+            elif mode == Mode.off_test():
+                self.cancel(Mode.off_test())
+            elif mode == Mode.alert():
+                self.alert(duration, start_at)
+            elif mode == Mode.fire():
+                self.fire(duration, start_at)
+            elif mode == Mode.fire_attack():
+                self.fire_attack(duration, start_at)
+            elif mode == Mode.attack():
+                self.attack(duration, start_at)
+            elif mode == Mode.test():
+                self.test()
+            elif mode == Mode.locked():
+                self.lock()
+            else:
+                _log.error('Invalid mode', mode=mode)
+            _log.debug('Mode now', mode=self._mode)
+            self._save_state()
+            self._publish_state()
+            self._emit_mode_change_event(self._mode)
+            self._emit_activation()
 
     def test(self):
-        self._run_in_thread(self._siren._on_test)
-        self._mode = Mode.test()
+        self._play(self._siren._on_test, Mode.test())
 
-    def alert(self, duration=None):
-        self._run_in_thread(self._siren._on_alert, duration)
-        self._mode = Mode.alert()
+    def alert(self, duration=None, start_at=None):
+        self._play(self._siren._on_alert, Mode.alert(), duration, start_at)
 
-    def fire(self, duration=None):
-        self._run_in_thread(self._siren._on_fire, duration)
-        self._mode = Mode.fire()
+    def fire(self, duration=None, start_at=None):
+        self._play(self._siren._on_fire, Mode.fire(), duration, start_at)
 
-    def attack(self, duration=None):
-        self._run_in_thread(self._siren._on_attack, duration)
-        self._mode = Mode.attack()
+    def attack(self, duration=None, start_at=None):
+        self._play(self._siren._on_attack, Mode.attack(), duration, start_at)
 
-    def fire_attack(self, duration=None):
-        self._run_in_thread(self._siren._on_fire_attack, duration)
-        self._mode = Mode.fire_attack()
+    def fire_attack(self, duration=None, start_at=None):
+        self._play(self._siren._on_fire_attack, Mode.fire_attack(), duration, start_at)
 
     def cancel(self, mode=None):
-        with self._cancel_lock:
-            print("Cancelling")
-            self._cancel_cond.notify_all()
-
-        if self._thread is not None:
-            self._thread.join()
-            print("cancelled")
-            self._thread = None
-        self._led_ready.on()
-        self._mode = mode or Mode.idle()
+        with metrics.Span(_CANCEL):
+            _log.debug('Cancelling')
+            playback, self._playback = self._playback, None
+            if playback is not None:
+                with metrics.Span(_CANCEL_PLAYBACK):
+                    cancelled = playback.cancel()
+                if cancelled:
+                    _log.debug('Cancelled', playback=playback)
+                    self._led_alarm.off()
+                    # Stopping the pattern turns everything off.
+                    self._dampers = {'high': False, 'low': False}
+            self._led_ready.on()
+            self._mode = mode or Mode.idle()
+
+    def set_damper(self, damper, closed):
+        """ Close the 'high' or 'low' damper if `closed` is set, else open it. """
+        if damper == 'high':
+            self._siren._set_damper_high(closed)
+        elif damper == 'low':
+            self._siren._set_damper_low(closed)
+        else:
+            raise ValueError('Invalid damper: %s' % damper)
+        self._dampers[damper] = bool(closed)
+        self._save_state()
+        self._state.update({'damper.' + damper: bool(closed)})
+
+    def _relay_factory(self, led_factory):
+        """ Wraps `led_factory` so the devices it makes report to the state model. """
+        def factory(gpio):
+            relay = _ObservedRelay(led_factory(gpio), 'relay.%d' % gpio, self._state)
+            self._relays[gpio] = relay
+            return relay
+        return factory
+
+    def _read_telemetry(self):
+        relays = 0
+        for bit, relay in self._relay_bits:
+            if relay.is_lit:
+                relays |= bit
+        return relays, self._sampler.read(), self._sampler.state
+
+    def _publish_state(self):
+        playback = self._playback
+        started = duration = ends = period = None
+        if playback is not None and playback.start_time is not None:
+            started = playback.start_time
+            duration = playback.duration
+            ends = None if duration is None else started + duration
+            period = playback.pattern.period
+        self._state.update({
+            'mode': self._mode.name,
+            'is_on': self.is_on(),
+            'locked': self._mode is Mode.locked(),
+            'started': started,
+            'duration': duration,
+            'ends': ends,
+            'period': period,
+            'damper.high': self._dampers['high'],
+            'damper.low': self._dampers['low'],
+        })
+
+    def _save_state(self):
+        if not self._snapshots:
+            return
+        playback = self._playback
+        clock = self._scheduler.clock
+        started = None
+        if playback is not None and playback.start_time is not None:
+            # Snapshots outlive the monotonic clock, so store wall-clock times.
+            started = clock.time() - (clock.monotonic() - playback.start_time)
+        self._snapshots.save({
+            'mode': self._mode.name,
+            'started': started,
+            'duration': playback and playback.duration,
+            'dampers': dict(self._dampers),
+        })
+
+    def resume(self, state=None):
+        """ Pick up where the last run left off, from its state snapshot.
+
+        A pattern that was playing restarts in phase with when it originally
+        started, as if it had never stopped, unless its duration has run
+        out since or it started more than `RESUME_MAX_AGE` seconds ago.
+
+        Args:
+          state: The snapshot to resume from; defaults to the state file's.
+
+        Returns:
+          The mode resumed, or None if there was nothing to resume.
+        """
+        if state is None:
+            if not self._snapshots:
+                return None
+            state = snapshot.load(self._snapshots.path)
+            if state is None:
+                return None
+
+        try:
+            mode = Mode.from_name(state['mode'])
+        except ValueError as e:
+            _log.warning('Unknown mode in snapshot; not resuming', error=e)
+            return None
+        if mode not in _RESUMABLE:
+            return None
+        if mode is Mode.locked():
+            self.change_mode(mode)
+            _RESUMED.inc()
+            return mode
+
+        if state.get('started') is None:
+            return None
+        clock = self._scheduler.clock
+        elapsed = max(0.0, clock.time() - state['started'])
+        duration = state.get('duration')
+        if duration is not None and elapsed >= duration:
+            _log.info('Snapshot expired; not resuming', mode=mode, elapsed=elapsed)
+            return None
+        if RESUME_MAX_AGE is not None and elapsed > RESUME_MAX_AGE:
+            _log.warning('Snapshot too old; not resuming', mode=mode, elapsed=elapsed,
+                         max_age=RESUME_MAX_AGE)
+            return None
+
+        _log.warning('Resuming', mode=mode, elapsed=elapsed, duration=duration)
+        self.change_mode(mode, duration, clock.monotonic() - elapsed)
+        for damper, closed in state.get('dampers', {}).items():
+            if closed:
+                self.set_damper(damper, True)
+        _RESUMED.inc()
+        return mode
+
+    def flush_state(self, timeout=None):
+        """ Wait for the latest state snapshot to be written. """
+        return not self._snapshots or self._snapshots.flush(timeout)
 
     def lock(self):
         self.cancel()
@@ -308,6 +692,59 @@ class AFTimer:
     def unlock(self):
         self.cancel(Mode.idle())
 
+    def submit(self, command, *args):
+        """ Run `command(*args)` on the timer's command thread.
+
+        For callers, such as event loops, that mustn't block on the sirens.
+
+        Returns:
+          A `concurrent.futures.Future` for the command's result.
+        """
+        return self._executor.submit(command, *args)
+
+    def request(self, command, *args, source=Source.NETWORK, client=None):
+        """ Like `submit`, for commands that change mode, from `source`.
+
+        Commands are arbitrated by source; see `Arbiter`.  A burst of network
+        commands collapses into running only the latest; see `Coalescer`.
+        Every caller's future completes once it has run.
+
+        Raises:
+          Preempted: If `source` is being held off by a higher-priority one.
+          RateLimited: If network `client` is sending too many commands.
+        """
+        return self._arbiter.submit(source, command, *args, client=client)
+
+    def mode(self):
+        """ The current mode. """
+        return self._mode
+
+    @property
+    def state(self):
+        """ The timer's `StateModel`.
+
+        Keys are `mode`, `is_on` and `locked`; the playing pattern's
+        `started`, `duration`, `ends` (on the timer's clock, see `time()`)
+        and `period`, from which clients can tell its phase and time left;
+        `damper.high` and `damper.low`; and `relay.<gpio>` for each of the
+        sirens' outputs.
+        """
+        return self._state
+
+    @property
+    def telemetry(self):
+        """ The timer's `Telemetry` of relay and button states. """
+        return self._telemetry
+
+    @property
+    def scheduler(self):
+        """ The `Scheduler` running the timer's patterns. """
+        return self._scheduler
+
+    def time(self):
+        """ The current time on this timer's monotonic clock. """
+        return self._scheduler.time()
+
     def is_on(self):
         return self._mode != Mode.idle()
 
@@ -317,10 +754,32 @@ class AFTimer:
     def remove_event_handler(self, handler):
         self._handlers.remove(handler)
 
+    def add_activation_handler(self, handler):
+        """ Call `handler(mode, duration, start)` after every mode change.
+
+        `start` is when the active pattern started, on this timer's clock, or
+        None if no pattern is playing.
+        """
+        self._activation_handlers.add(handler)
+
+    def remove_activation_handler(self, handler):
+        self._activation_handlers.remove(handler)
+
+    def _emit_activation(self):
+        playback = self._playback
+        if playback is None:
+            mode, duration, start = self._mode, None, None
+        else:
+            mode, duration, start = self._mode, playback.duration, playback.start_time
+        for handler in self._activation_handlers:
+            handler(mode, duration, start)
+
     def _emit_mode_change_event(self, new_mode):
-        event = {'is_on': self.is_on()}
-        for handler in self._handlers:
-            handler(event)
+        with metrics.Span(_EMIT_EVENT):
+            journal.record_mode(new_mode)
+            event = {'is_on': self.is_on()}
+            for handler in self._handlers:
+                handler(event)
 
     def generate_api_mappings(self):
         mappings = {
@@ -335,27 +794,32 @@ class AFTimer:
                 'unlock': functools.partial(self.change_mode, Mode.idle()),
             },
             'debug': {
-                'high': self._siren._set_damper_high,
-                'low': self._siren._set_damper_low,
+                'high': functools.partial(self.set_damper, 'high'),
+                'low': functools.partial(self.set_damper, 'low'),
                 'test': functools.partial(self.change_mode, Mode.test()),
             },
             'on': functools.partial(self.change_mode, Mode.alert()),
             'off': functools.partial(self.change_mode, Mode.idle()),
             'is_on': self.is_on,
+            'mode': self.mode,
         }
         return mappings
 
     def generate_console_mappings(self):
+        def console(command, *args):
+            return functools.partial(self._arbiter.run, Source.CONSOLE, command, *args)
+
         mappings = {
-            'high': self._siren._set_damper_high,
-            'low': self._siren._set_damper_low,
-            'test': functools.partial(self.change_mode, Mode.test()),
-            'alert': functools.partial(self.change_mode, Mode.alert()),
-            'fire': functools.partial(self.change_mode, Mode.fire()),
-            'attack': functools.partial(self.change_mode, Mode.attack()),
-            'fire_attack': functools.partial(self.change_mode, Mode.fire_attack()),
-            'cancel': functools.partial(self.change_mode, Mode.idle()),
-            'lock': functools.partial(self.change_mode, Mode.locked()),
-            'unlock': functools.partial(self.change_mode, Mode.idle()),
+            'high': console(self.set_damper, 'high'),
+            'low': console(self.set_damper, 'low'),
+            'test': console(self.change_mode, Mode.test()),
+            'alert': console(self.change_mode, Mode.alert()),
+            'fire': console(self.change_mode, Mode.fire()),
+            'attack': console(self.change_mode, Mode.attack()),
+            'fire_attack': console(self.change_mode, Mode.fire_attack()),
+            'cancel': console(self.change_mode, Mode.idle()),
+            'lock': console(self.change_mode, Mode.locked()),
+            'unlock': console(self.change_mode, Mode.idle()),
+            'coil_stats': self._watchdog.stats,
         }
         return mappings
@@ -0,0 +1,190 @@
+""" Arbitration of control commands between the panel, console, schedule and network. """
+
+import contextlib
+import functools
+import threading
+import time
+import weakref
+
+import metrics
+
+_PREEMPTED = metrics.counter('arbiter.preempted')
+_HELD_OFF = metrics.counter('arbiter.held_off')
+_RATE_LIMITED = metrics.counter('arbiter.rate_limited')
+
+
+class Source:
+    """ Where a command came from.  Lower values take precedence. """
+    PANEL = 0
+    CONSOLE = 1
+    SCHEDULE = 2
+    NETWORK = 3
+
+    ALL = (PANEL, CONSOLE, SCHEDULE, NETWORK)
+    NAMES = ('panel', 'console', 'schedule', 'network')
+
+
+# Waits for the transition lock, by source.
+_WAIT = [metrics.histogram('arbiter.wait.' + name) for name in Source.NAMES]
+
+
+class Preempted(Exception):
+    """ A command gave way to one from a higher-priority source. """
+
+
+class RateLimited(Exception):
+    """ A client sent commands faster than it's allowed to. """
+
+
+class _Bucket:
+    """ Token bucket for one client. """
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+
+
+class Arbiter:
+    """ Decides which source's commands get to change the timer's state.
+
+    Every command runs holding one transition lock, so commands from
+    different threads never interleave.  The panel runs its commands right
+    away on its own thread, so it waits for at most the one command already
+    running, however many are queued behind it.  Beyond that:
+
+     - Commands still queued when a higher-priority source acts are
+       dropped, failing with `Preempted`.
+     - For `hold` seconds after a source acts, commands from lower-priority
+       sources are refused with `Preempted`, so a flood of remote commands
+       can't undo a button press.
+     - Each network client may queue `rate` commands a second, in bursts of
+       up to `burst`; more are refused with `RateLimited`.
+    """
+
+    def __init__(self, executor, coalescer, now, hold, rate, burst):
+        """
+        Args:
+          executor: The `CommandExecutor` to queue commands on.
+          coalescer: The `Coalescer` that network commands go through.
+          now: Callable returning the current time, in seconds.
+          hold: Seconds a source's commands hold off lower-priority ones.
+          rate: Commands a second each network client may queue; 0 for no limit.
+          burst: Commands a network client may queue at once.
+        """
+        self._executor = executor
+        self._coalescer = coalescer
+        self._now = now
+        self._hold = hold
+        self._rate = rate
+        self._burst = burst
+
+        self._lock = threading.RLock()
+        self._actions = 0
+        # The number, and time, of each source's latest action.
+        self._acted = [0] * len(Source.ALL)
+        self._acted_at = [None] * len(Source.ALL)
+
+        self._buckets_lock = threading.Lock()
+        self._buckets = weakref.WeakKeyDictionary()
+        self._anonymous = _Anonymous()
+
+    @property
+    def lock(self):
+        """ The transition lock, for the timer's own transitions. """
+        return self._lock
+
+    def run(self, source, command, *args):
+        """ Run `command(*args)` on this thread, on behalf of `source`.
+
+        Raises:
+          Preempted: If `source` is being held off.
+        """
+        with self.locked(source):
+            self.act(source)
+            return command(*args)
+
+    def submit(self, source, command, *args, client=None):
+        """ Queue `command(*args)` on the timer's command thread.
+
+        Network commands, which should give the `client` they came from,
+        are rate limited and coalesced.
+
+        Returns:
+          A `concurrent.futures.Future` for the command's result.  It fails
+          with `Preempted` if a higher-priority source acts first.
+
+        Raises:
+          Preempted: If `source` is being held off.
+          RateLimited: If `client` is over its rate.
+          queue.Full: If too many commands are already waiting.
+        """
+        # Read without the lock, so the event loop never waits on a
+        # transition.  A stale count only makes preemption more eager.
+        self._check_hold(source)
+        queued = self._actions
+        run = functools.partial(self._run_queued, source, queued, command, args)
+        if source == Source.NETWORK:
+            self._limit(client)
+            return self._coalescer.submit(run)
+        return self._executor.submit(run)
+
+    def _run_queued(self, source, queued, command, args):
+        with self.locked(source):
+            if any(self._acted[s] > queued for s in range(source)):
+                _PREEMPTED.inc()
+                raise Preempted('Preempted by a higher-priority command')
+            self.act(source)
+            return command(*args)
+
+    @contextlib.contextmanager
+    def locked(self, source):
+        """ Hold the transition lock on behalf of `source`, e.g. to decide whether to `act`. """
+        started = time.perf_counter()
+        with self._lock:
+            _WAIT[source].observe((time.perf_counter() - started) * 1000)
+            yield
+
+    def _check_hold(self, source):
+        now = self._now()
+        for s in range(source):
+            at = self._acted_at[s]
+            if at is not None and now - at < self._hold:
+                _HELD_OFF.inc()
+                raise Preempted('Held off by %s' % Source.NAMES[s])
+
+    def act(self, source):
+        """ Record that `source` is about to change the timer's state.
+
+        Must be called holding the lock, only for commands that do change
+        something: it preempts queued lower-priority commands and holds
+        off new ones.
+
+        Raises:
+          Preempted: If `source` is being held off.
+        """
+        self._check_hold(source)
+        self._actions += 1
+        self._acted[source] = self._actions
+        self._acted_at[source] = self._now()
+
+    def _limit(self, client):
+        if not self._rate:
+            return
+        if client is None:
+            client = self._anonymous
+        now = self._now()
+        with self._buckets_lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = self._buckets[client] = _Bucket(self._burst, now)
+            bucket.tokens = min(self._burst, bucket.tokens + (now - bucket.updated) * self._rate)
+            bucket.updated = now
+            if bucket.tokens < 1:
+                _RATE_LIMITED.inc()
+                raise RateLimited('Too many commands; limit is %g a second' % self._rate)
+            bucket.tokens -= 1
+
+
+class _Anonymous:
+    """ Stands in for network commands that don't say which client sent them. """
@@ -0,0 +1,111 @@
+""" Collapses bursts of mode change commands into one transition. """
+
+import concurrent.futures
+import queue
+import threading
+
+import metrics
+
+_REQUESTED = metrics.counter('coalescer.requested')
+_COALESCED = metrics.counter('coalescer.coalesced')
+_APPLIED = metrics.counter('coalescer.applied')
+
+
+class Coalescer:
+    """ Last-writer-wins stage in front of a `CommandExecutor`.
+
+    The first command of a burst goes to the executor right away, and opens
+    a window of `window` seconds.  Commands arriving while it's still
+    queued replace it; those arriving after it's run, before the window
+    closes, are held and replace each other, and the latest runs when the
+    window closes, opening another.  A lone command is never delayed, and a
+    burst results in at most one call a window.  Every submission still
+    gets its own future, completed with the result of the command that was
+    actually run.
+
+    With a `window` of 0, commands are only collapsed while they wait
+    behind others on the executor.
+    """
+
+    def __init__(self, executor, scheduler, window):
+        self._executor = executor
+        self._scheduler = scheduler
+        self._window = window
+        self._lock = threading.Lock()
+        self._pending = None
+        # Whether the pending command is on the executor, and whether a
+        # window is open.
+        self._queued = False
+        self._open = False
+
+    def submit(self, command, *args):
+        """ Queue `command(*args)`, superseding any command still pending.
+
+        Returns:
+          A `concurrent.futures.Future` for the result of whichever command
+          the burst resolved to.
+        """
+        _REQUESTED.inc()
+        future = concurrent.futures.Future()
+        with self._lock:
+            pending = self._pending
+            if pending is not None:
+                pending[0] = command
+                pending[1] = args
+                pending[2].append(future)
+                _COALESCED.inc()
+                return future
+            self._pending = [command, args, [future]]
+            if self._open:
+                # Held until the window closes.
+                return future
+            self._queued = True
+            self._open = opened = self._window > 0
+
+        self._flush()
+        if opened:
+            self._scheduler.call_later(self._window, self._close)
+        return future
+
+    def _close(self):
+        """ End the window, running any command held during it in a new one. """
+        with self._lock:
+            if self._pending is None or self._queued:
+                self._open = False
+                return
+            self._queued = True
+        self._flush()
+        self._scheduler.call_later(self._window, self._close)
+
+    def _flush(self):
+        """ Hand the pending command to the executor. """
+        try:
+            self._executor.submit(self._run)
+        except queue.Full as e:
+            with self._lock:
+                _, _, futures = self._pending
+                self._pending = None
+                self._queued = False
+            for future in futures:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+
+    def _run(self):
+        """ Run the latest pending command, on the executor. """
+        with self._lock:
+            command, args, futures = self._pending
+            self._pending = None
+            self._queued = False
+
+        _APPLIED.inc()
+        try:
+            result = command(*args)
+        except Exception as e:
+            for future in futures:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            raise
+        for future in futures:
+            if future.set_running_or_notify_cancel():
+                future.set_result(result)
+        return result
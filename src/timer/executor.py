@@ -0,0 +1,87 @@
+""" Runs control commands off the caller's thread. """
+
+import concurrent.futures
+import queue
+import threading
+import time
+
+import metrics
+
+_QUEUE_WAIT = metrics.histogram('executor.queue_wait')
+_RUN = metrics.histogram('executor.run')
+_REJECTED = metrics.counter('executor.rejected')
+
+_STOP = object()
+
+
+class CommandExecutor:
+    """ Runs commands in submission order on one dedicated worker thread.
+
+    Network front ends submit control calls here rather than making them
+    on their event loop, which must never block on relays, logging or the
+    timer's handlers.  Each submission returns a
+    `concurrent.futures.Future`, which asyncio callers can await with
+    `asyncio.wrap_future`.
+
+    Since there's only one worker, commands never run concurrently with
+    each other, and a burst of them is carried out in the order received.
+    """
+
+    def __init__(self, queue_size, name='commands'):
+        self._queue = queue.Queue(queue_size)
+        self._name = name
+        self._thread = None
+
+    def start(self):
+        """ Start the worker thread. """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the worker once the commands already queued have run. """
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def submit(self, fn, *args, **kwargs):
+        """ Queue `fn(*args, **kwargs)` to run on the worker.
+
+        Never blocks.
+
+        Returns:
+          A `Future` for the command's result.
+
+        Raises:
+          queue.Full: If too many commands are already waiting.
+        """
+        future = concurrent.futures.Future()
+        try:
+            self._queue.put_nowait((future, time.perf_counter(), fn, args, kwargs))
+        except queue.Full:
+            _REJECTED.inc()
+            raise
+        return future
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            future, queued, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            started = time.perf_counter()
+            _QUEUE_WAIT.observe((started - queued) * 1000)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            _RUN.observe((time.perf_counter() - started) * 1000)
@@ -0,0 +1,110 @@
+""" Debounced sampling of the panel buttons. """
+
+import threading
+
+import log
+import metrics
+
+_log = log.get_logger('sampler')
+
+_SAMPLES = metrics.counter('sampler.samples')
+_BOUNCES = metrics.counter('sampler.bounces')
+
+
+class InputSampler:
+    """ Reads every panel button at once into one pressed-button bitmask.
+
+    Button edges only wake the sampler.  Once awake, it reads all the
+    buttons together every `interval` seconds on the scheduler.  The first
+    change from a bitmask that had held steady for `debounce` seconds is
+    reported straight away with `on_change(previous, pressed)`.  Changes
+    within `debounce` of another are bounces, and aren't reported until the
+    bitmask has held steady for `debounce` again, if it ends up different.
+    Once steady, the sampler sleeps until the next edge.
+
+    Bounces never reach `on_change`.  A button pressed within `debounce` of
+    another, such as Attack just after Fire, is reported as a second change
+    once both have settled.
+    """
+
+    def __init__(self, scheduler, buttons, on_change, interval, debounce):
+        """
+        Args:
+          scheduler: The `Scheduler` to sample on.
+          buttons: Dict of bitmask bit to the input device setting it, which
+                   must have an `is_pressed` attribute.
+          on_change: Called on the scheduler thread with the old and new
+                     bitmasks whenever the debounced state changes.
+          interval: Seconds between samples while awake.
+          debounce: Seconds the bitmask must be stable to be accepted.
+        """
+        self._scheduler = scheduler
+        self._buttons = tuple(buttons.items())
+        self._on_change = on_change
+        self._interval = interval
+        self._debounce = debounce
+
+        self._lock = threading.Lock()
+        self._timer = None
+        self._woken = False
+
+        # Buttons already held at start-up don't count as presses.
+        self._state = self._raw = self.read()
+        self._stable_at = 0
+
+    @property
+    def latency(self):
+        """ The most time between an edge and its report, if it bounces. """
+        return self._debounce + self._interval
+
+    @property
+    def state(self):
+        """ The debounced bitmask of pressed buttons. """
+        return self._state
+
+    def read(self):
+        """ Sample the raw bitmask of pressed buttons. """
+        pressed = 0
+        for bit, button in self._buttons:
+            if button.is_pressed:
+                pressed |= bit
+        return pressed
+
+    def wake(self):
+        """ Start sampling, if not already.  Safe to call from any thread. """
+        with self._lock:
+            self._woken = True
+            if self._timer is None:
+                self._timer = self._scheduler.call_soon(self._sample)
+
+    def _sample(self):
+        with self._lock:
+            self._woken = False
+
+        _SAMPLES.inc()
+        now = self._scheduler.time()
+        raw = self.read()
+        settled = now >= self._stable_at
+        if raw != self._raw:
+            if not settled:
+                # Changed again before settling.
+                _BOUNCES.inc()
+            self._raw = raw
+            self._stable_at = now + self._debounce
+
+        try:
+            # A change from a settled state is reported at once; after a
+            # bounce, only once the buttons have settled again.
+            if (settled or now >= self._stable_at) and raw != self._state:
+                previous, self._state = self._state, raw
+                self._on_change(previous, raw)
+        except Exception as e:
+            # The change is still taken as handled; the panel must keep
+            # responding to the next one.
+            _log.error('Button change handler failed', previous=previous, pressed=raw, error=e)
+        finally:
+            with self._lock:
+                if now >= self._stable_at and raw == self._state and not self._woken:
+                    self._timer = None
+                else:
+                    self._timer = self._scheduler.call_later(self._interval, self._sample)
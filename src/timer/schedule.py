@@ -0,0 +1,318 @@
+""" Scheduled activations, such as monthly siren tests. """
+
+import calendar
+import datetime
+import heapq
+import itertools
+import queue
+import threading
+import uuid
+
+from config import ARBITER_HOLD, SCHEDULE_FILE, SCHEDULE_GRACE, SCHEDULE_MAX_SLEEP
+import log
+import metrics
+from timer import snapshot, storage
+from timer.af_timer import Mode
+from timer.arbiter import Preempted, Source
+
+_log = log.get_logger('schedule')
+
+_FIRED = metrics.counter('schedule.fired')
+_MISSED = metrics.counter('schedule.missed')
+
+# Modes that can be scheduled, by the name used in the API and the store.
+MODES = {
+    'test' : Mode.test(),
+    'alert' : Mode.alert(),
+    'fire' : Mode.fire(),
+    'attack' : Mode.attack(),
+    'fire_attack' : Mode.fire_attack(),
+}
+
+REPEATS = (None, 'daily', 'weekly', 'monthly')
+
+
+class Entry:
+    """ One scheduled activation.
+
+    `at` is a naive local `datetime` of the first occurrence.  Repeating
+    entries recur at the same local time each day, week or month; monthly
+    entries on days a month doesn't have fall on its last day.
+    """
+    __slots__ = ('id', 'mode', 'duration', 'at', 'repeat')
+
+    def __init__(self, mode, duration, at, repeat=None, id=None):
+        if mode not in MODES:
+            raise ValueError('Invalid mode: %s' % mode)
+        if duration is None or not duration > 0:
+            raise ValueError('Scheduled activations need a positive duration')
+        if repeat not in REPEATS:
+            raise ValueError('Invalid repeat: %s' % repeat)
+        self.id = id or uuid.uuid4().hex[:8]
+        self.mode = mode
+        self.duration = float(duration)
+        self.at = at
+        self.repeat = repeat
+
+    def __repr__(self):
+        return '<Entry %s: %s at %s%s>' % (
+            self.id, self.mode, self.at.isoformat(), self.repeat and ' ' + self.repeat or '')
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['mode'], d.get('duration'), parse_time(d['at']), d.get('repeat'), d.get('id'))
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'mode': self.mode,
+            'duration': self.duration,
+            'at': self.at.isoformat(),
+            'repeat': self.repeat,
+        }
+
+    def next_after(self, when):
+        """ The first occurrence at or after local `datetime` `when`, or None. """
+        if self.at >= when:
+            return self.at
+        if self.repeat is None:
+            return None
+        if self.repeat != 'monthly':
+            step = datetime.timedelta(days=1 if self.repeat == 'daily' else 7)
+            return self.at + step * -((self.at - when) // step)
+
+        months = (when.year - self.at.year) * 12 + when.month - self.at.month
+        while True:
+            occurrence = self._month(months)
+            if occurrence >= when:
+                return occurrence
+            months += 1
+
+    def _month(self, months):
+        year, month = divmod(self.at.year * 12 + self.at.month - 1 + months, 12)
+        month += 1
+        day = min(self.at.day, calendar.monthrange(year, month)[1])
+        return self.at.replace(year=year, month=month, day=day)
+
+
+def parse_time(text):
+    """ Parse an ISO 8601 date and time to a naive local `datetime`. """
+    when = datetime.datetime.fromisoformat(text)
+    if when.tzinfo is not None:
+        when = when.astimezone().replace(tzinfo=None)
+    return when
+
+
+class Store:
+    """ Schedule entries persisted as a JSON file.
+
+    Saves are written by a `SnapshotWriter` in the background, so they never
+    hold up the scheduler or command thread; failures are logged there.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._writer = snapshot.SnapshotWriter(path, 'schedule-store')
+
+    def load(self):
+        try:
+            return [Entry.from_dict(d) for d in storage.read_json(self.path)]
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            _log.error('Unreadable schedule store; starting empty', path=self.path, error=e)
+            return []
+
+    def save(self, entries):
+        """ Replace the stored entries with a copy of `entries`. """
+        self._writer.save([e.to_dict() for e in entries])
+
+    def flush(self, timeout=None):
+        """ Wait for the latest save to be written.  Returns False on timeout. """
+        return self._writer.flush(timeout)
+
+
+class ActivationSchedule:
+    """ Fires scheduled activations of an AF timer.
+
+    Upcoming occurrences are kept in a heap ordered by time, and a single
+    timer on the AF timer's scheduler is armed for the earliest, so nothing
+    runs between activations.  Occurrences are in wall-clock time; waits
+    are capped at `SCHEDULE_MAX_SLEEP` so clock adjustments are caught up
+    with.
+
+    Occurrences missed while the runtime was down still fire on start-up
+    if they are less than `SCHEDULE_GRACE` seconds late.
+    """
+
+    def __init__(self, af_timer, path=SCHEDULE_FILE):
+        self._af_timer = af_timer
+        self._scheduler = af_timer.scheduler
+        self._store = Store(path)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._timer = None
+
+    def start(self):
+        """ Load the stored entries and start firing them. """
+        with self._lock:
+            since = self._now() - datetime.timedelta(seconds=SCHEDULE_GRACE)
+            expired = False
+            for entry in self._store.load():
+                if entry.next_after(since) is None:
+                    _log.warning('Missed scheduled activation', entry=entry)
+                    _MISSED.inc()
+                    expired = True
+                    continue
+                self._entries[entry.id] = entry
+                self._push(entry, since)
+            if expired:
+                self._store.save(self._entries.values())
+            _log.info('Schedule loaded', entries=len(self._entries), path=self._store.path)
+            self._arm()
+
+    def flush(self, timeout=None):
+        """ Wait for the entries to be written to the store. """
+        return self._store.flush(timeout)
+
+    def stop(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def entries(self):
+        """ Every entry, as dicts with the time of its next occurrence added. """
+        with self._lock:
+            now = self._now()
+            result = []
+            for entry in sorted(self._entries.values(), key=lambda e: e.next_after(now) or e.at):
+                d = entry.to_dict()
+                upcoming = entry.next_after(now)
+                d['next'] = upcoming and upcoming.isoformat()
+                result.append(d)
+            return result
+
+    def add(self, mode, at, duration, repeat=None):
+        """ Schedule `mode` for `duration` seconds at local time `at`.
+
+        Args:
+          mode: One of `MODES`.
+          at: A naive local `datetime`, or an ISO 8601 string.
+          duration: Seconds to signal for.
+          repeat: One of `REPEATS`.
+
+        Returns:
+          The new entry, as a dict.
+
+        Raises:
+          ValueError: If the entry is invalid, or would never fire.
+        """
+        if isinstance(at, str):
+            at = parse_time(at)
+        entry = Entry(mode, duration, at, repeat)
+        with self._lock:
+            if entry.next_after(self._now()) is None:
+                raise ValueError('%s is in the past' % at.isoformat())
+            self._entries[entry.id] = entry
+            self._store.save(self._entries.values())
+            self._push(entry, self._now())
+            self._arm()
+        _log.info('Scheduled', entry=entry)
+        return entry.to_dict()
+
+    def remove(self, entry_id):
+        """ Remove an entry.  Returns False if there was no such entry. """
+        with self._lock:
+            entry = self._entries.pop(entry_id, None)
+            if entry is None:
+                return False
+            # Its heap slot is skipped when it comes up.
+            self._store.save(self._entries.values())
+            self._arm()
+        _log.info('Unscheduled', entry=entry)
+        return True
+
+    def _now(self):
+        return datetime.datetime.fromtimestamp(self._scheduler.clock.time())
+
+    def _push(self, entry, since):
+        upcoming = entry.next_after(since)
+        if upcoming is not None:
+            heapq.heappush(self._heap, (upcoming, next(self._seq), entry))
+
+    def _arm(self):
+        """ Arm the timer for the earliest occurrence.  Called with the lock held. """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._heap and self._entries.get(self._heap[0][2].id) is not self._heap[0][2]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return
+        delay = (self._heap[0][0] - self._now()).total_seconds()
+        self._timer = self._scheduler.call_later(
+            min(max(delay, 0), SCHEDULE_MAX_SLEEP), self._wake)
+
+    def _wake(self):
+        """ Fire whatever is due.  Runs on the scheduler thread. """
+        with self._lock:
+            try:
+                now = self._now()
+                changed = False
+                while self._heap and self._heap[0][0] <= now:
+                    when, _, entry = heapq.heappop(self._heap)
+                    if self._entries.get(entry.id) is not entry:
+                        continue
+                    late = (now - when).total_seconds()
+                    if late > SCHEDULE_GRACE:
+                        _log.warning('Missed scheduled activation', entry=entry, late=late)
+                        _MISSED.inc()
+                    else:
+                        self._fire(entry)
+                    if entry.repeat is None:
+                        del self._entries[entry.id]
+                        changed = True
+                    else:
+                        self._push(entry, max(
+                            when + datetime.timedelta(seconds=1),
+                            now - datetime.timedelta(seconds=SCHEDULE_GRACE)))
+                if changed:
+                    self._store.save(self._entries.values())
+            finally:
+                # Whatever went wrong, later activations must still fire.
+                self._arm()
+
+    def _fire(self, entry):
+        _log.info('Scheduled activation', entry=entry)
+        _FIRED.inc()
+        mode = MODES[entry.mode]
+        af_timer = self._af_timer
+        try:
+            af_timer.request(af_timer.change_mode, mode, entry.duration, source=Source.SCHEDULE)
+        except (Preempted, queue.Full) as e:
+            _log.warning('Scheduled activation refused', entry=entry, error=e)
+            return
+        if mode is Mode.test():
+            # Tests run for as long as the button's held, so end them here.
+            self._scheduler.call_later(entry.duration, self._end_test)
+
+    def _end_test(self):
+        af_timer = self._af_timer
+        if af_timer.mode() is not Mode.test():
+            return
+        try:
+            future = af_timer.request(af_timer.change_mode, Mode.idle(), source=Source.SCHEDULE)
+        except (Preempted, queue.Full):
+            future = None
+        if future is None:
+            self._scheduler.call_later(ARBITER_HOLD, self._end_test)
+        else:
+            # If held off by the panel or console, try again once they let go.
+            future.add_done_callback(self._test_ended)
+
+    def _test_ended(self, future):
+        if isinstance(future.exception(), Preempted):
+            self._scheduler.call_later(ARBITER_HOLD, self._end_test)
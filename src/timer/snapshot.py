@@ -0,0 +1,77 @@
+""" Crash-safe snapshots of the AF timer's state. """
+
+import threading
+
+import log
+import metrics
+from timer import storage
+
+_log = log.get_logger('snapshot')
+
+_WRITE = metrics.histogram('snapshot.write')
+_COALESCED = metrics.counter('snapshot.coalesced')
+
+
+def load(path):
+    """ The last snapshot saved to `path`, or None if there isn't a usable one. """
+    try:
+        state = storage.read_json(path)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        _log.error('Unreadable state snapshot', path=path, error=e)
+        return None
+    if not isinstance(state, dict) or 'mode' not in state:
+        _log.error('Invalid state snapshot', path=path)
+        return None
+    return state
+
+
+class SnapshotWriter:
+    """ Writes state snapshots to `path` from a background thread.
+
+    `save` only swaps the snapshot into a slot, so it's cheap enough for the
+    scheduler thread; the writer thread then replaces the file atomically.
+    Snapshots saved faster than they can be written are coalesced, and only
+    the latest is written.
+    """
+
+    def __init__(self, path, name='snapshot'):
+        self.path = path
+        self._cond = threading.Condition()
+        self._pending = None
+        self._saved = 0
+        self._written = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def save(self, state):
+        with self._cond:
+            if self._pending is not None:
+                _COALESCED.inc()
+            self._pending = state
+            self._saved += 1
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """ Wait until everything saved so far is on disk.  Returns False on timeout. """
+        with self._cond:
+            saved = self._saved
+            return self._cond.wait_for(lambda: self._written >= saved, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None)
+                state, self._pending = self._pending, None
+                saved = self._saved
+
+            try:
+                with metrics.Span(_WRITE):
+                    storage.write_json(self.path, state)
+            except OSError as e:
+                _log.error('Failed to write snapshot', path=self.path, error=e)
+
+            with self._cond:
+                self._written = saved
+                self._cond.notify_all()
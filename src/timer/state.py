@@ -0,0 +1,70 @@
+""" Versioned model of the AF timer's state, published as deltas. """
+
+import collections
+import threading
+
+
+class StateModel:
+    """ The timer's observable state, as a flat dict, with a sequence number.
+
+    Every change that actually alters a value bumps the sequence number and
+    is sent to listeners as a delta message:
+
+        {'type': 'state_delta', 'seq': 42, 'at': 1234.5, 'changes': {'mode': 'FIRE'}}
+
+    The last `history` deltas are kept, so a client that notices a gap in
+    sequence numbers can catch up with `since` instead of starting over
+    from a `snapshot`.  `at` is the time of the change on the timer's clock.
+    """
+
+    def __init__(self, now, history):
+        self._now = now
+        self._lock = threading.Lock()
+        self._state = {}
+        self._seq = 0
+        self._history = collections.deque(maxlen=history)
+        self._listeners = set()
+
+    @property
+    def seq(self):
+        return self._seq
+
+    def update(self, changes):
+        """ Apply `changes`, a dict of keys to new values, publishing what differs. """
+        with self._lock:
+            delta = {
+                k: v for k, v in changes.items() if k not in self._state or self._state[k] != v}
+            if not delta:
+                return
+            self._state.update(delta)
+            self._seq += 1
+            message = {'type': 'state_delta', 'seq': self._seq, 'at': self._now(), 'changes': delta}
+            self._history.append(message)
+            # Listeners are called with the lock held so they see deltas in order.
+            for listener in self._listeners:
+                listener(message)
+
+    def snapshot(self):
+        """ The whole state, as of sequence number `seq`. """
+        with self._lock:
+            return {'type': 'state', 'seq': self._seq, 'at': self._now(), 'state': dict(self._state)}
+
+    def since(self, seq):
+        """ The deltas after sequence number `seq`, or None if they're no longer kept. """
+        with self._lock:
+            if seq > self._seq:
+                return None
+            if seq == self._seq:
+                return []
+            if not self._history or self._history[0]['seq'] > seq + 1:
+                return None
+            return [m for m in self._history if m['seq'] > seq]
+
+    def add_listener(self, listener):
+        """ Call `listener(message)` with every delta, from whichever thread made it. """
+        with self._lock:
+            self._listeners.add(listener)
+
+    def remove_listener(self, listener):
+        with self._lock:
+            self._listeners.discard(listener)
@@ -0,0 +1,31 @@
+""" Crash-safe JSON files. """
+
+import json
+import os
+
+
+def read_json(path):
+    """ The JSON value stored at `path`.
+
+    Raises:
+      FileNotFoundError: If there's nothing stored.
+      ValueError: If the file isn't valid JSON.
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json(path, value):
+    """ Store `value` as JSON at `path`, atomically.
+
+    The value is written to a temporary file, synced, and renamed over
+    `path`, so after a crash `path` holds either the old value or the new
+    one, never a mix.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(value, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
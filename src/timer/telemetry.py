@@ -0,0 +1,122 @@
+""" High-rate sampling of relay and button states, for diagnostics. """
+
+import threading
+
+import metrics
+from protocol import relay_bytes, telemetry_header, telemetry_sample
+
+_SAMPLE = metrics.histogram('telemetry.sample')
+_DROPPED = metrics.counter('telemetry.dropped')
+
+
+class Telemetry:
+    """ Samples the panel's inputs and outputs into a ring buffer while anyone's watching.
+
+    Every `interval` seconds, `read()` is called on the scheduler and its
+    `(relays, raw_buttons, buttons)` stored, already packed for the wire
+    with a bitmap wide enough for `relays` relays,
+    in a ring of the latest `capacity` samples.  Sampling only runs while
+    there are subscriptions, so it costs nothing otherwise.
+
+    Each `Subscription` reads the ring at its own pace, limited to its own
+    rate.  One that falls more than `capacity` samples behind skips the
+    samples it missed.
+    """
+
+    def __init__(self, scheduler, read, interval, capacity, relays):
+        """
+        Raises:
+          ValueError: If there are too many relays to sample.
+        """
+        self.interval = interval
+        self._scheduler = scheduler
+        self._read = read
+        self._capacity = capacity
+        self._format = telemetry_sample(relays)
+        self._ring = bytearray(capacity * self._format.size)
+        self._lock = threading.Lock()
+        self._count = 0
+        self._subscriptions = set()
+        self._timer = None
+        self._deadline = None
+        # Bumped each time sampling starts, so a sample already running
+        # when it was stopped doesn't carry on alongside the new ones.
+        self._run = 0
+
+    def subscribe(self, rate=None):
+        """ Start watching, at up to `rate` samples a second (default: all of them). """
+        subscription = Subscription(self, rate)
+        with self._lock:
+            subscription._cursor = self._count
+            self._subscriptions.add(subscription)
+            if self._timer is None:
+                self._run += 1
+                self._deadline = self._scheduler.time()
+                self._timer = self._scheduler.call_at(self._deadline, self._sample, self._run)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            if not self._subscriptions and self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _sample(self, run):
+        with metrics.Span(_SAMPLE):
+            at = self._scheduler.time()
+            relays, raw_buttons, buttons = self._read()
+            with self._lock:
+                if run != self._run or self._timer is None:
+                    return
+                self._format.pack_into(
+                    self._ring, (self._count % self._capacity) * self._format.size,
+                    at, relay_bytes(relays, self._format), raw_buttons, buttons)
+                self._count += 1
+                # Deadlines advance by whole intervals, so the rate doesn't drift.
+                self._deadline += self.interval
+                if self._deadline < at:
+                    self._deadline = at + self.interval
+                self._timer = self._scheduler.call_at(self._deadline, self._sample, run)
+
+    def _take(self, subscription):
+        with self._lock:
+            count = self._count
+            cursor = subscription._cursor
+            if count - cursor > self._capacity:
+                _DROPPED.inc(count - self._capacity - cursor)
+                cursor = count - self._capacity
+            subscription._cursor = count
+
+            view = memoryview(self._ring)
+            samples = []
+            for i in range(cursor, count):
+                offset = (i % self._capacity) * self._format.size
+                if subscription._period:
+                    at = self._format.unpack_from(self._ring, offset)[0]
+                    # Allow half a sampling interval of jitter, or a rate
+                    # that divides the sampling rate would be undershot.
+                    if at < subscription._next - self.interval / 2:
+                        continue
+                    subscription._next = max(subscription._next, at) + subscription._period
+                samples.append(view[offset:offset + self._format.size])
+            if not samples:
+                return None
+            return telemetry_header(len(samples), self._format) + b''.join(samples)
+
+
+class Subscription:
+    """ One watcher of a `Telemetry`. """
+
+    def __init__(self, telemetry, rate):
+        self._telemetry = telemetry
+        self._period = 1 / rate if rate else 0
+        self._next = 0
+        self._cursor = 0
+
+    def read(self):
+        """ A telemetry frame of the samples since the last read, or None if there are none. """
+        return self._telemetry._take(self)
+
+    def close(self):
+        self._telemetry._unsubscribe(self)
@@ -1,60 +1,462 @@
 import asyncio
 import functools
 import websockets
+import websockets.exceptions
 import json
-import threading
+import time
 
-_loop = asyncio.new_event_loop()
-_thread = threading.Thread(target=_loop.run_forever)
+from config import (
+    TELEMETRY_FRAME_INTERVAL, WEBSOCKET_PORT, WEBSOCKET_QUEUE_SIZE, WEBSOCKET_SLOW_CLIENT_POLICY)
+import journal
+import log
+import metrics
+import protocol
+from timer.af_timer import Mode
+from timer.arbiter import Preempted, RateLimited
 
+_log = log.get_logger('websocket')
 
-def post_event(websocket, event: dict):
-    print(f'Event: {event}')
-    if not _thread.is_alive():
-        _thread.start()
-    future = asyncio.run_coroutine_threadsafe(
-        websocket.send(json.dumps(event)), _loop)
-    return future.result()
+# Most journal records sent in reply to one `get_history`.
+HISTORY_LIMIT = 1000
 
-async def status_handler(af_timer, websocket):
+_PUBLISH = metrics.histogram('websocket.publish')
+_EVENTS_PUBLISHED = metrics.counter('websocket.events_published')
+_EVENTS_DROPPED = metrics.counter('websocket.events_dropped')
+_CLIENTS_DISCONNECTED = metrics.counter('websocket.slow_clients_disconnected')
+_TELEMETRY_DROPPED = metrics.counter('websocket.telemetry_dropped')
+
+
+class _Client:
+    """ A connected client and its queue of pending outgoing messages.
+
+    `channels` names the hub channels the client receives.  Telemetry
+    frames don't queue: the client holds only the latest one not yet sent,
+    which goes out once the queue is empty, so telemetry never crowds out
+    events.
+    """
+
+    def __init__(self, hub, websocket, queue_size):
+        self.websocket = websocket
+        self.channels = {'events'}
+        self.telemetry = None
+        self.dropped = 0
+        self._hub = hub
+        self._queue = asyncio.Queue(queue_size)
+        self._frame = None
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self._sender())
+
+    def offer(self, data):
+        """ Queue `data` for sending without blocking.
+
+        Returns False if the client is too slow and should be disconnected.
+        """
+        self._ready.set()
+        try:
+            self._queue.put_nowait(data)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        if self._hub.policy == BroadcastHub.DISCONNECT:
+            return False
+
+        # Coalesce: the oldest pending event is superseded by the newest.
+        self._queue.get_nowait()
+        self._queue.put_nowait(data)
+        self.dropped += 1
+        _EVENTS_DROPPED.inc()
+        return True
+
+    def offer_telemetry(self, data):
+        """ Send telemetry frame `data` in place of any that's still pending. """
+        if self._frame is not None:
+            _TELEMETRY_DROPPED.inc()
+        self._frame = data
+        self._ready.set()
+
+    def room(self):
+        """ How many more messages can be queued without dropping any. """
+        return self._queue.maxsize - self._queue.qsize()
+
+    async def _sender(self):
+        try:
+            while True:
+                if not self._queue.empty():
+                    data = self._queue.get_nowait()
+                elif self._frame is not None:
+                    data, self._frame = self._frame, None
+                else:
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                await self.websocket.send(data)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    def close(self):
+        self._task.cancel()
+        if self.telemetry is not None:
+            self.telemetry.cancel()
+
+
+class BroadcastHub:
+    """ Fans events out to every connected WebSocket client.
+
+    Events are serialized once, then handed to a bounded per-client queue
+    drained by that client's own sender task.  `publish` never waits on a
+    client, so a slow dashboard can't hold up the AF timer or other clients.
+    When a client's queue is full, `policy` decides what happens: with
+    `DROP_OLDEST` its oldest pending event is discarded, with `DISCONNECT`
+    the client is dropped.
+
+    Events are published on a channel, and only go to clients that have
+    joined it.  Every client is on `events`, the original `is_on` events;
+    clients join `state` by subscribing to the state stream.
+    """
+    DROP_OLDEST = 'drop_oldest'
+    DISCONNECT = 'disconnect'
+
+    def __init__(self, loop, queue_size=WEBSOCKET_QUEUE_SIZE,
+                 policy=WEBSOCKET_SLOW_CLIENT_POLICY):
+        if policy not in (self.DROP_OLDEST, self.DISCONNECT):
+            raise ValueError('Invalid slow client policy: %s' % policy)
+        self.policy = policy
+        self._loop = loop
+        self._queue_size = queue_size
+        self._clients = set()
+
+    def publish(self, event: dict, channel='events'):
+        """ Broadcast `event` to the clients on `channel`.  Safe to call from any thread. """
+        with metrics.Span(_PUBLISH):
+            _log.debug('Event', channel=channel, **event)
+            data = json.dumps(event)
+            self._loop.call_soon_threadsafe(self._fan_out, data, channel)
+        _EVENTS_PUBLISHED.inc()
+
+    def attach(self, websocket):
+        """ Start delivering events to `websocket`.  Must run on the hub's loop. """
+        client = _Client(self, websocket, self._queue_size)
+        self._clients.add(client)
+        return client
+
+    def detach(self, client):
+        """ Stop delivering events to `client`. """
+        self._clients.discard(client)
+        client.close()
+
+    def _fan_out(self, data, channel):
+        for client in list(self._clients):
+            if channel not in client.channels:
+                continue
+            if not client.offer(data):
+                _log.warning('Disconnecting slow client', dropped=client.dropped)
+                _CLIENTS_DISCONNECTED.inc()
+                self.detach(client)
+                asyncio.create_task(client.websocket.close())
+
+
+def _tone(api_mappings, message):
+    """ The tone requested by `message`, by name or, from binary frames, by mode. """
+    tone = message.get('tone', None)
+    if tone is None and isinstance(message.get('mode'), int):
+        try:
+            tone = Mode(message['mode']).name.lower()
+        except ValueError:
+            pass
+    return tone
+
+
+# Mode changes, which go to the timer in order and may run while earlier
+# ones are in flight, so bursts can coalesce.  Every other request waits
+# for everything before it.
+_PIPELINED = frozenset(['turn_on', 'turn_off', 'set_tone'])
+
+# Error statuses for commands the arbiter turned down.
+_STATUSES = {
+    Preempted: protocol.STATUS_PREEMPTED,
+    RateLimited: protocol.STATUS_RATE_LIMITED,
+}
+
+
+async def _run(af_timer, client, command, *args):
+    """ Run a mode change on the timer's command thread, without blocking the loop. """
+    await asyncio.wrap_future(af_timer.request(command, *args, client=client))
+
+
+async def _schedule_request(af_timer, schedule, message):
+    """ Carry out a request managing scheduled activations.
+
+    Returns:
+      The data to reply with.  Entries are added and removed on the command
+      thread; the store is written in the background.
+    """
+    request = message['request']
+    if request == 'list_schedules':
+        return {'schedules': schedule.entries()}
+    elif request == 'add_schedule':
+        entry = await asyncio.wrap_future(af_timer.submit(
+            schedule.add,
+            message.get('mode'),
+            message.get('at'),
+            message.get('duration'),
+            message.get('repeat')))
+        return {'schedule': entry}
+    else:
+        schedule_id = message.get('schedule_id')
+        if not await asyncio.wrap_future(af_timer.submit(schedule.remove, schedule_id)):
+            raise ValueError(f'No such schedule: {schedule_id}')
+        return {'schedule_id': schedule_id}
+
+
+def _subscribe_state(client, state, since=None):
+    """ Start sending `client` the state stream.
+
+    The client is first brought up to date, through the same queue as the
+    deltas that follow so that none arrive out of order: with the deltas
+    after sequence number `since` if they're still kept and fit in its
+    queue, else with a snapshot.
+
+    Returns:
+      The sequence number the client is brought up to.
+    """
+    missed = None if since is None else state.since(since)
+    if missed is None or len(missed) > client.room():
+        missed = [state.snapshot()]
+    client.channels.add('state')
+    for message in missed:
+        client.offer(json.dumps(message))
+    return missed[-1]['seq'] if missed else since
+
+
+async def _stream_telemetry(client, subscription):
+    """ Send `client` its telemetry every `TELEMETRY_FRAME_INTERVAL` seconds, until cancelled. """
+    try:
+        while True:
+            await asyncio.sleep(TELEMETRY_FRAME_INTERVAL)
+            data = subscription.read()
+            if data is not None:
+                client.offer_telemetry(data)
+    finally:
+        subscription.close()
+
+
+def _subscribe_telemetry(client, telemetry, rate=None):
+    """ Start sending `client` telemetry at up to `rate` samples a second.
+
+    Returns:
+      The rate it'll be sent at.
+    """
+    if rate is not None and (not isinstance(rate, (int, float)) or not rate > 0):
+        raise ValueError(f'Invalid telemetry rate: {rate}')
+    most = 1 / telemetry.interval
+    rate = most if rate is None else min(rate, most)
+    if client.telemetry is not None:
+        client.telemetry.cancel()
+    client.telemetry = asyncio.create_task(
+        _stream_telemetry(client, telemetry.subscribe(None if rate == most else rate)))
+    return rate
+
+
+async def handle_request(af_timer, api_mappings, message, received, schedule=None, client=None):
+    """ Carry out one request.
+
+    Args:
+      af_timer: The timer to control.
+      api_mappings: The timer's API mappings.
+      message: The decoded request.
+      received: When the frame holding the request arrived, on the timer's clock.
+      schedule: The `ActivationSchedule`, if scheduling is enabled.
+      client: The requester's hub client, for requests that subscribe it
+        to a channel.
+
+    Returns:
+      The reply to send, or None if there isn't one.  Version 1 requests
+      only get replies to queries; version 2 requests are always answered.
+    """
+    request = message.get('request', '')
+    v2 = protocol.version(message) >= protocol.VERSION
+    started = time.perf_counter()
+
+    if request == 'clock_sync':
+        # Timestamps for the requester to estimate our clock offset.
+        # `start_at` in commands below is on this same clock.
+        response = {
+            'request': 'clock_sync',
+            'id': message.get('id'),
+            'received': received,
+            'sent': af_timer.time(),
+        }
+        return protocol.ack(message, **response) if v2 else response
+    elif request == 'get_tones':
+        response = {
+            'tones': list(api_mappings['tone'].keys()),
+            'is_on': api_mappings['is_on'](),
+        }
+        return protocol.ack(message, **response) if v2 else response
+    elif request == 'get_metrics':
+        response = {'metrics': metrics.snapshot()}
+        return protocol.ack(message, **response) if v2 else response
+    elif request in ('list_schedules', 'add_schedule', 'remove_schedule') and schedule:
+        try:
+            response = await _schedule_request(af_timer, schedule, message)
+        except (ValueError, TypeError) as e:
+            return protocol.error(message, str(e))
+        return protocol.ack(message, **response) if v2 else response
+    elif request == 'get_history':
+        limit = min(message.get('limit') or HISTORY_LIMIT, HISTORY_LIMIT)
+        history = journal.query(message.get('start'), message.get('end'), limit)
+        for record in history:
+            if record['kind'] == 'mode':
+                record['mode'] = Mode(record['value']).name
+        response = {'history': history}
+        return protocol.ack(message, **response) if v2 else response
+    elif request == 'subscribe_state' and client is not None:
+        response = {'seq': _subscribe_state(client, af_timer.state, message.get('since'))}
+        return protocol.ack(message, **response) if v2 else response
+    elif request == 'unsubscribe_state' and client is not None:
+        client.channels.discard('state')
+        if not v2:
+            return None
+    elif request == 'subscribe_telemetry' and client is not None:
+        try:
+            response = {'rate': _subscribe_telemetry(client, af_timer.telemetry, message.get('rate'))}
+        except ValueError as e:
+            return protocol.error(message, str(e))
+        return protocol.ack(message, **response) if v2 else response
+    elif request == 'unsubscribe_telemetry' and client is not None:
+        if client.telemetry is not None:
+            client.telemetry.cancel()
+            client.telemetry = None
+        if not v2:
+            return None
+    elif request == 'get_state':
+        if not v2:
+            return None
+    elif request == 'turn_on':
+        duration = message.get('duration', None)
+        await _run(af_timer, client, api_mappings['on'], duration, message.get('start_at', None))
+    elif request == 'turn_off':
+        await _run(af_timer, client, api_mappings['off'])
+    elif request == 'set_tone':
+        tone = _tone(api_mappings, message)
+        duration = message.get('duration', None)
+        if tone not in api_mappings['tone']:
+            return protocol.error(
+                message, f'Invalid tone: {tone}', protocol.STATUS_INVALID_TONE)
+        await _run(af_timer, client, api_mappings['tone'][tone], duration, message.get('start_at', None))
+    elif v2:
+        return protocol.error(
+            message, f'Unsupported request: {request}', protocol.STATUS_UNSUPPORTED)
+    else:
+        return None
+
+    if not v2:
+        return None
+    return protocol.ack(
+        message,
+        mode=api_mappings['mode'](),
+        at=af_timer.time(),
+        elapsed_ms=(time.perf_counter() - started) * 1000)
+
+
+async def _reply(websocket, frame, requests, previous):
+    """ Send the replies to one frame's requests, after the previous frame's. """
+    responses = []
+    for message, request in zip(frame.messages, requests):
+        try:
+            response = await request
+        except (Preempted, RateLimited) as e:
+            response = protocol.error(message, str(e), _STATUSES[type(e)])
+        except Exception as e:
+            _log.error('Request failed', request=message.get('request'), error=e)
+            response = protocol.error(message, str(e))
+        if response is not None:
+            responses.append(response)
+
+    if previous is not None:
+        await previous
+    if responses:
+        await websocket.send(protocol.encode(frame, responses))
+
+
+async def _ordered(after, handler, *args):
+    """ Run `handler(*args)` once the requests in `after` are done, however they ended. """
+    if after:
+        await asyncio.wait(after)
+    return await handler(*args)
+
+
+async def _reject(websocket, error, previous):
+    if previous is not None:
+        await previous
+    await websocket.send(json.dumps({'v': protocol.VERSION, 'ok': False, 'error': str(error)}))
+
+
+async def status_handler(af_timer, hub, schedule, websocket):
     api_mappings = af_timer.generate_api_mappings()
-    handler = functools.partial(post_event, websocket)
-    af_timer.add_event_handler(handler)
+    client = hub.attach(websocket)
 
+    # Requests are handled in the order they arrive.  Mode changes are
+    # pipelined: each is handed to the timer as soon as it arrives, without
+    # waiting for earlier ones to complete, so bursts can coalesce.  Any
+    # other request, such as a query, waits until every request before it
+    # is done, and the mode changes after it wait for it in turn.  Replies
+    # go out in the order requests came in.
+    previous = None
+    barrier = None
+    in_flight = []
     try:
         async for data in websocket:
-            message = json.loads(data)
-            request = message.get('request', '')
-            response = {}
-
-            if request == 'get_tones':
-                response = {
-                    'tones': list(api_mappings['tone'].keys()),
-                    'is_on': api_mappings['is_on'](),
-                }
-                await websocket.send(json.dumps(response))
-            elif request == 'turn_on':
-                duration = message.get('duration', None)
-                api_mappings['on'](duration)
-            elif request == 'turn_off':
-                api_mappings['off']()
-            elif request == 'set_tone':
-                tone = message.get('tone', None)
-                duration = message.get('duration', None)
-                if tone not in api_mappings['tone']:
-                    await websocket.send(
-                            json.dumps({'error': f'Invalid tone: {tone}'}))
-                api_mappings['tone'][tone](duration)
-    except websockets.exceptions.ConnectionClosedError as e:
+            received = af_timer.time()
+            try:
+                frame = protocol.decode(data)
+            except protocol.ProtocolError as e:
+                previous = asyncio.create_task(_reject(websocket, e, previous))
+                continue
+
+            requests = []
+            for message in frame.messages:
+                args = (af_timer, api_mappings, message, received, schedule, client)
+                if message.get('request') in _PIPELINED:
+                    after = [barrier] if barrier is not None else []
+                    request = asyncio.ensure_future(_ordered(after, handle_request, *args))
+                    in_flight = [r for r in in_flight if not r.done()]
+                    in_flight.append(request)
+                else:
+                    after = in_flight + ([barrier] if barrier is not None else [])
+                    request = barrier = asyncio.ensure_future(
+                        _ordered(after, handle_request, *args))
+                    in_flight = []
+                requests.append(request)
+            previous = asyncio.create_task(_reply(websocket, frame, requests, previous))
+        if previous is not None:
+            await previous
+    except websockets.exceptions.ConnectionClosed as e:
         # Pass this, we'll just close the connection.
-        print('Connection closed')
+        _log.info('Connection closed')
+    finally:
+        hub.detach(client)
 
-    af_timer.remove_event_handler(handler)
 
+async def run_websocket(af_timer, port=WEBSOCKET_PORT, schedule=None, ready=None):
+    """ Serve the WebSocket API until cancelled.
 
-async def run_websocket(af_timer):
-    async with websockets.serve(
-            functools.partial(status_handler, af_timer),
-            '0.0.0.0', 12346):
-        print('WebSocket server started on 0.0.0.0:12346')
-        await asyncio.Future()
+    Args:
+      ready: Optional `asyncio.Future`, resolved once the server is listening.
+    """
+    hub = BroadcastHub(asyncio.get_running_loop())
+    publish_state = functools.partial(hub.publish, channel='state')
+    af_timer.add_event_handler(hub.publish)
+    af_timer.state.add_listener(publish_state)
+    try:
+        async with websockets.serve(
+                functools.partial(status_handler, af_timer, hub, schedule),
+                '0.0.0.0', port):
+            _log.info('WebSocket server started', host='0.0.0.0', port=port)
+            if ready is not None:
+                ready.set_result(None)
+            await asyncio.Future()
+    finally:
+        af_timer.state.remove_listener(publish_state)
+        af_timer.remove_event_handler(hub.publish)